@@ -2,7 +2,7 @@
 A more sophisticated example of config for Promnesia
 '''
 
-from promnesia.common import Source
+from promnesia.common import DomainFilter, Source
 
 # now, let's import some indexers
 # NOTE: you might need extra dependencies before using some of the indexers
@@ -60,6 +60,16 @@ SOURCES = [
         name='notes',
     ),
     #
+    # if you declare the files/directories a source reads, it's only reindexed when any of them change (by size/mtime)
+    # otherwise its visits are kept from the previous run. Use 'promnesia index --force' to reindex everything anyway
+    # NOTE: custom function FILTERS disable this, since there is no way to tell whether they changed
+    # same for sources taking functions (or other objects without a stable repr) as arguments
+    Source(
+        takeout.index,
+        # can be glob patterns too, or a function returning the paths (e.g. if they are configured in HPI)
+        inputs=['/data/takeout/*.zip'],
+    ),
+    #
     # we can index Logseq graph: extract links from Org-mode and Markdown files
     Source(
         auto.index,
@@ -152,9 +162,73 @@ FILTERS = [
     #
     # you can use regexes too!
     'redditmedia.com.*.(jpg|png|gif)',
+    #
+    # or block whole domains (including subdomains), e.g. from an ad/tracker blocklist
+    # files can have one domain per line, or be in hosts/adblock format
+    DomainFilter(['doubleclick.net'], files=['/path/to/blocklist.txt']),
 ]
 
 
+'''
+Optional setting.
+Canonified URLs are cached in memory during indexing, since the same URLs tend to repeat a lot.
+This is the max number of URLs kept in the cache. Set to 0 to disable the cache.
+NOTE: the server doesn't read the config, use 'promnesia serve --canonify-cache-size' for it.
+'''
+CANONIFY_CACHE_SIZE = 100_000
+
+'''
+Optional setting.
+If True, canonified URLs are also kept in a database in CACHE_DIR (canonify.sqlite), so reindexing mostly doesn't need to canonify them again.
+The cache is reset automatically whenever canonify rules change.
+'''
+PERSISTENT_CANONIFY_CACHE = False
+
+'''
+Optional setting.
+Number of sources extracted at the same time, each in a separate process. Set to 0 to use the number of CPUs.
+Useful if you have lots of independent sources (or some of them are mostly waiting on IO).
+If not specified, sources are extracted one after another.
+'''
+CONCURRENT_SOURCES = 4
+
+'''
+Optional setting.
+Max memory (in bytes) used to detect duplicate visits while indexing a source (~25 bytes per visit).
+For sources with more visits than that, the rest is kept in a temporary database on disk, which is slower.
+If not specified, everything is kept in memory.
+'''
+DEDUP_MEMORY_BUDGET = 256 * 1024 * 1024
+
+'''
+Optional setting.
+If True, sources, locators and contexts are stored once in lookup tables instead of in every visit,
+which makes the database considerably smaller if lots of visits share them (e.g. links from the same file/paragraph).
+Lookups are slightly slower because of the extra joins.
+The existing database is converted on the next 'promnesia index' when this setting changes (False converts it back).
+If not specified, the schema of the existing database is kept (new databases aren't normalized).
+'''
+NORMALIZED_DB = True
+
+'''
+Optional setting.
+If True, sources are split between 9 database files (in promnesia.sqlite.shards directory, by hash of the source name),
+and the server reads them all together. Reindexing a source only rewrites its own file, so it's cheaper,
+and indexing sources from different files (e.g. 'promnesia index --sources ...' in parallel) doesn't have to wait for each other.
+Switching this setting requires 'promnesia index --overwrite'.
+'''
+SHARDED_DB = False
+
+'''
+Optional setting.
+If True, large contexts (e.g. rendered markdown/org-mode blocks, chat messages) are compressed with zstd, which makes the database several times smaller.
+Needs 'zstandard' package (pip3 install --user zstandard).
+Only the visits indexed after enabling it are compressed, use 'promnesia index --overwrite' to compress everything.
+Search over contexts is a bit slower, since they have to be decompressed.
+'''
+COMPRESS_CONTEXT = False
+
+
 # Optional setting.
 # Can be useful to hack (e.g. rewrite/filter/etc) the visits before inserting in the database.
 def HOOK(v):
@@ -164,3 +238,14 @@ def HOOK(v):
             return
     # otherwise keep intact
     yield v
+
+
+# Optional setting.
+# Same as HOOK, but receives a list of visits at once (up to 10K), which makes it cheaper for millions of visits,
+# and lets you process them in bulk (e.g. lookup tables). Returns the visits to keep, as a list or any iterable.
+# If both are set, HOOK is applied first.
+# If it crashes, the visits are retried one by one, so only the ones it crashes on are lost.
+# NOTE: so it has to be idempotent, since retried visits have already been passed to it as part of the batch
+# (e.g. don't rely on it being called exactly once per visit for counting or writing somewhere).
+def BATCH_HOOK(visits):
+    return [v for v in visits if 'github.com' not in v.norm_url or v.context is not None]
@@ -7,31 +7,47 @@ import inspect
 import os
 import shlex
 import shutil
+import sqlite3
 import sys
-from collections.abc import Callable, Iterable, Iterator, Sequence
+from collections import Counter
+from collections.abc import Callable, Collection, Iterable, Iterator, Sequence
+from hashlib import sha256
+from multiprocessing.process import BaseProcess
 from pathlib import Path
 from subprocess import Popen, check_call, run
 from tempfile import TemporaryDirectory, gettempdir
+from timeit import default_timer as timer
+
+from more_itertools import chunked
 
 from . import config, server
+from .cannon import CanonifyStore, canonify_cache, rules_fingerprint
 from .common import (
     DbVisit,
     Extractor,
     PathIsh,
     Res,
     Source,
+    SourceName,
     default_config_path,
     get_system_tz,
     get_tmpdir,
     logger,
+    mp_context,
     user_config_file,
 )
-from .database.dump import visits_to_sqlite
+from .config import BatchHookT, HookT
+from .database.dump import SRC_ERROR, get_source_fingerprints, visits_to_sqlite
 from .extract import extract_visits
 from .misc import install_server
+from .perf import perf
 
 
-def iter_all_visits(sources_subset: Iterable[str | int] = ()) -> Iterator[Res[DbVisit]]:
+def iter_all_visits(
+    sources_subset: Iterable[str | int] = (),
+    *,
+    unchanged: Collection[SourceName] = (),  # sources to skip since their inputs didn't change
+) -> Iterator[Res[DbVisit]]:
     cfg = config.get()
     output_dir = cfg.output_dir
     # not sure if belongs here??
@@ -39,14 +55,14 @@ def iter_all_visits(sources_subset: Iterable[str | int] = ()) -> Iterator[Res[Db
         logger.warning("OUTPUT_DIR '%s' didn't exist, creating", output_dir)
         output_dir.mkdir(exist_ok=True, parents=True)
 
-    hook = cfg.hook
-
     sources = list(cfg.sources)
 
     is_subset_sources = bool(sources_subset)
     if is_subset_sources:
         sources_subset = set(sources_subset)
 
+    # index in cfg.sources (so worker processes can find the same source) or error
+    selected: list[tuple[int, Source] | Exception] = []
     for i, source in enumerate(sources):
         # TODO why would it not be present??
         name: str | None = getattr(source, "name", None)
@@ -59,64 +75,342 @@ def iter_all_visits(sources_subset: Iterable[str | int] = ()) -> Iterator[Res[Db
                 continue
 
         if isinstance(source, Exception):
-            yield source
+            selected.append(source)
             continue
 
         if not isinstance(source, Source):
             # just in case cause previously it was technically possible to be something else
             # but I think that was a dead codepath
-            yield RuntimeError(f"Shouldn't have gotten this as a source: {source}")
+            selected.append(RuntimeError(f"Shouldn't have gotten this as a source: {source}"))
             continue
 
-        _einfo = source.description  # FIXME hmm it's not even used?? add as exception notes?
-        for v in extract_visits(source, src=source.name):
-            if hook is None:
-                yield v
-            else:
-                try:
-                    yield from hook(v)
-                except Exception as e:
-                    yield e
+        if source.name in unchanged:
+            logger.info("skipping '%s': inputs didn't change since it was last indexed", source.name)
+            continue
+
+        selected.append((i, source))
+
+    workers = cfg.concurrent_sources
+    vit: Iterable[Res[DbVisit]]
+    if workers > 1 and config.instance_path is None:
+        # workers need to load the config themselves
+        logger.warning("config wasn't loaded from a file, extracting sources sequentially")
+        workers = 1
+    if workers > 1 and sum(not isinstance(s, Exception) for s in selected) > 1:
+        vit = _extract_concurrently(selected, workers=workers)
+    else:
+        vit = _extract_sequentially(selected)
+
+    hook = cfg.hook
+    if hook is not None:
+        vit = _apply_hook(vit, hook)
+    batch_hook = cfg.batch_hook
+    if batch_hook is not None:
+        vit = _apply_batch_hook(vit, batch_hook)
+    yield from vit
 
     if sources_subset:  # type: ignore[truthy-iterable]
         logger.warning("unknown --sources: %s", ", ".join(repr(i) for i in sources_subset))
 
 
+def _visit_src(v: Res[DbVisit]) -> SourceName:
+    return (v.src or '') if isinstance(v, DbVisit) else SRC_ERROR
+
+
+def _apply_hook(vit: Iterable[Res[DbVisit]], hook: HookT) -> Iterator[Res[DbVisit]]:
+    for v in vit:
+        stats = perf.source(_visit_src(v))
+        try:
+            yield from stats.timed('hook', hook(v))
+        except Exception as e:
+            stats.errors += 1
+            yield e
+
+
+# number of visits passed to BATCH_HOOK at once
+_HOOK_BATCH = 10_000
+
+
+def _apply_batch_hook(vit: Iterable[Res[DbVisit]], hook: BatchHookT) -> Iterator[Res[DbVisit]]:
+    for batch in chunked(vit, n=_HOOK_BATCH):
+        srcs = Counter(map(_visit_src, batch))
+        start = timer()
+        try:
+            res = list(hook(batch))
+        except Exception as e:
+            logger.exception(e)
+            logger.warning('BATCH_HOOK failed on a batch of %d visits, retrying them one by one', len(batch))
+            # retry visit by visit, so only the visits it actually crashes on are lost (same as with per visit hook)
+            # NOTE: so the hook sees these visits twice, that's documented in the example config
+            # the errors are counted per visit, so fingerprints of the sources these visits belong to aren't saved
+            res = []
+            for v in batch:
+                try:
+                    res.extend(hook([v]))
+                except Exception as ve:
+                    perf.source(_visit_src(v)).errors += 1
+                    res.append(ve)
+        finally:
+            # the batch might contain several sources, just split the time evenly between visits
+            per_visit = (timer() - start) / len(batch)
+            for src, count in srcs.items():
+                perf.source(src).add('hook', per_visit * count)
+        yield from res
+
+
+def _extract_sequentially(selected: Sequence[tuple[int, Source] | Exception]) -> Iterator[Res[DbVisit]]:
+    for s in selected:
+        if isinstance(s, Exception):
+            yield s
+            continue
+        _, source = s
+        _einfo = source.description  # FIXME hmm it's not even used?? add as exception notes?
+        yield from extract_visits(source, src=source.name)
+
+
+# visits are sent from workers in chunks, and at most this many chunks are waiting to be consumed
+_WORKER_CHUNK = 1000
+_QUEUE_CHUNKS = 32
+
+
+def _extract_concurrently(selected: Sequence[tuple[int, Source] | Exception], *, workers: int) -> Iterator[Res[DbVisit]]:
+    '''
+    Extracts each source in a separate process, at most 'workers' at once.
+    Visits of different sources are interleaved, but visits within a source keep their order.
+    If a worker crashes, that's reported as an error for its source only.
+    NOTE: hooks are applied in the main process, so they don't have to be picklable.
+    '''
+    from queue import Empty
+
+    ctx = mp_context()
+    queue = ctx.Queue(maxsize=_QUEUE_CHUNKS)
+
+    pending: list[tuple[int, Source]] = []
+    for s in selected:
+        if isinstance(s, Exception):
+            yield s
+        else:
+            pending.append(s)
+    pending.reverse()  # so pop() takes them in order
+
+    running: dict[int, tuple[BaseProcess, Source]] = {}
+    try:
+        while len(pending) > 0 or len(running) > 0:
+            while len(pending) > 0 and len(running) < workers:
+                i, source = pending.pop()
+                logger.info('starting worker for %s', source.description)
+                proc = ctx.Process(target=_extract_worker, args=(i, queue, config.instance_path), name=f'promnesia-{source.name}')
+                proc.start()
+                running[i] = (proc, source)
+
+            try:
+                kind, i, payload = queue.get(timeout=1)
+            except Empty:
+                for j, (wproc, wsource) in list(running.items()):
+                    # exited normally -- then 'done' message is still in the queue, so only handle crashes here
+                    if not wproc.is_alive() and wproc.exitcode != 0:
+                        del running[j]
+                        perf.source(wsource.name).errors += 1
+                        err = RuntimeError(f'worker for {wsource.description} exited with code {wproc.exitcode}')
+                        logger.error(err)
+                        yield err
+                continue
+
+            if kind == 'visits':
+                yield from payload
+            else:
+                assert kind == 'done', kind
+                if payload is not None:
+                    perf.merge(payload)
+                # could be missing if we already reported the crash
+                finished = running.pop(i, None)
+                if finished is not None:
+                    finished[0].join()
+    finally:
+        for wproc, _ in running.values():
+            wproc.terminate()
+            wproc.join()
+
+
+def _extract_worker(idx: int, queue, config_path: Path | None) -> None:
+    perf.reset()
+    try:
+        # worker isn't forked from the main process, so has to load the config again
+        assert config_path is not None, "config wasn't loaded from a file, can't extract concurrently"
+        config.load_from(config_path)
+        canonify_cache.resize(config.get().canonify_cache_size)
+        store_path = config.get().canonify_store_path
+        store = None
+        if store_path is not None:
+            try:
+                store = CanonifyStore(store_path)
+            except sqlite3.Error as e:
+                # e.g. locked by other workers for too long, it's only a cache anyway
+                logger.warning("couldn't open canonify store %s, not using it: %r", store_path, e)
+        canonify_cache.attach_store(store)
+
+        source = list(config.get().sources)[idx]
+        assert isinstance(source, Source), source
+
+        chunk: list[Res[DbVisit]] = []
+        try:
+            for v in extract_visits(source, src=source.name):
+                chunk.append(_picklable(v) if isinstance(v, Exception) else v)
+                if len(chunk) >= _WORKER_CHUNK:
+                    queue.put(('visits', idx, chunk))
+                    chunk = []
+        finally:
+            canonify_cache.attach_store(None)
+            if store is not None:
+                store.close()
+        if len(chunk) > 0:
+            queue.put(('visits', idx, chunk))
+    except Exception as e:
+        logger.exception(e)
+        queue.put(('visits', idx, [_picklable(e)]))
+    finally:
+        queue.put(('done', idx, perf.report()['sources']))
+
+
+def _picklable(e: Exception) -> Exception:
+    import pickle
+
+    try:
+        pickle.loads(pickle.dumps(e))
+    except Exception:
+        return RuntimeError(f'{type(e).__name__}: {e}')
+    return e
+
+
 def _do_index(
-    *, dry: bool = False, sources_subset: Iterable[str | int] = (), overwrite_db: bool = False
+    *, dry: bool = False, sources_subset: Iterable[str | int] = (), overwrite_db: bool = False, force: bool = False
 ) -> Iterable[Exception]:
+    perf.reset()
+    canonify_cache.resize(config.get().canonify_cache_size)
+    store_path = config.get().canonify_store_path
+    store = None if store_path is None else CanonifyStore(store_path)
+    if store is not None:
+        if store.invalidated:
+            logger.info('canonify rules changed, persistent canonify cache %s was reset', store_path)
+        canonify_cache.attach_store(store)
+    try:
+        errors = _index_visits(dry=dry, sources_subset=sources_subset, overwrite_db=overwrite_db, force=force)
+    finally:
+        if store is not None:
+            canonify_cache.attach_store(None)
+            store.close()
+    logger.info('canonify cache: %s', canonify_cache.stats())
+    for line in perf.summary():
+        logger.info('perf: %s', line)
+    if not dry:
+        report_path = config.get().index_report_path
+        perf.write(report_path)
+        logger.info('perf: report written to %s', report_path)
+    return errors
+
+
+def _index_visits(*, dry: bool, sources_subset: Iterable[str | int], overwrite_db: bool, force: bool) -> list[Exception]:
     # also keep & return errors for further display
     errors: list[Exception] = []
 
+    cfg = config.get()
+    fingerprints: dict[SourceName, str] = {}
+    unchanged: set[SourceName] = set()
+    if not dry:
+        fingerprints = _source_fingerprints(cfg.sources)
+        if not force:
+            recorded = get_source_fingerprints(cfg.db)
+            unchanged = {name for name, fp in fingerprints.items() if recorded.get(name) == fp}
+
     def it() -> Iterable[Res[DbVisit]]:
-        for v in iter_all_visits(sources_subset):
+        for v in iter_all_visits(sources_subset, unchanged=unchanged):
             if isinstance(v, Exception):
                 errors.append(v)
             yield v
 
+    def reindexed() -> dict[SourceName, str]:
+        # only the sources extracted during this run and without errors, others are retried next time
+        return {
+            name: fp
+            for name, fp in fingerprints.items()
+            if name not in unchanged and name in perf.sources and perf.sources[name].errors == 0
+        }
+
     if dry:
         res = list(it())
         logger.warning("DRY MODE: won't modify the database. Printing the results out")
         for v in res:
             print(v)
     else:
-        dump_errors = visits_to_sqlite(it(), overwrite_db=overwrite_db)
+        dump_errors = visits_to_sqlite(
+            it(),
+            overwrite_db=overwrite_db,
+            keep_srcs=unchanged,
+            fingerprints=reindexed,
+            normalized=cfg.normalized_db,
+            sharded=cfg.sharded_db,
+            compress_context=cfg.compress_context,
+        )
         for e in dump_errors:
             logger.exception(e)
             errors.append(e)
     return errors
 
 
+def _source_fingerprints(sources: Iterable[Res[Source]]) -> dict[SourceName, str]:
+    '''
+    Sources can share the same name (and hence visits in the database), so these can only be skipped together,
+    and only if all of them declare their inputs.
+    Canonify rules and FILTERS are part of the fingerprint too, since they affect the indexed visits.
+    Callable filters can only be compared if they have a fingerprint() method (e.g. DomainFilter), otherwise nothing is skipped.
+    NOTE: changes to HOOK/BATCH_HOOK aren't detected, need to use --force in that case.
+    '''
+    filters: list[str | tuple[str, str]] = []
+    for f in config.get().FILTERS:
+        if isinstance(f, str):
+            filters.append(f)
+            continue
+        fingerprint = getattr(f, 'fingerprint', None)
+        if fingerprint is None:
+            logger.info("can't tell if filter %r changed, won't skip unchanged sources", f)
+            return {}
+        try:
+            filters.append((type(f).__qualname__, fingerprint()))
+        except Exception as e:
+            logger.warning("couldn't compute fingerprint of filter %r, won't skip unchanged sources: %r", f, e)
+            return {}
+
+    by_name: dict[SourceName, list[str | None]] = {}
+    for source in sources:
+        if not isinstance(source, Source):
+            continue
+        fp: str | None
+        try:
+            fp = source.fingerprint()
+        except Exception as e:
+            logger.warning("couldn't compute inputs fingerprint of %s, will reindex it: %r", source.description, e)
+            fp = None
+        by_name.setdefault(source.name, []).append(fp)
+
+    res = {}
+    for name, fps in by_name.items():
+        if any(fp is None for fp in fps):
+            continue
+        res[name] = sha256(repr((rules_fingerprint(), filters, fps)).encode('utf8')).hexdigest()
+    return res
+
+
 def do_index(
     config_file: Path,
     *,
     dry: bool = False,
     sources_subset: Iterable[str | int] = (),
     overwrite_db: bool = False,
+    force: bool = False,
 ) -> Sequence[Exception]:
     config.load_from(config_file)  # meh.. should be cleaner
     try:
-        errors = list(_do_index(dry=dry, sources_subset=sources_subset, overwrite_db=overwrite_db))
+        errors = list(_do_index(dry=dry, sources_subset=sources_subset, overwrite_db=overwrite_db, force=force))
     finally:
         # this reset is mainly for tests, so we don't end up reusing the same config by accident
         config.reset()
@@ -163,6 +457,7 @@ def do_demo(
     name: str = 'demo',
     sources_subset: Iterable[str | int] = (),
     overwrite_db: bool = False,
+    force: bool = False,
 ) -> None:
     with TemporaryDirectory() as tdir:
         outdir = Path(tdir)
@@ -178,7 +473,7 @@ def do_demo(
             )
             config.instance = cfg
 
-        errors = list(_do_index(dry=dry, sources_subset=sources_subset, overwrite_db=overwrite_db))
+        errors = list(_do_index(dry=dry, sources_subset=sources_subset, overwrite_db=overwrite_db, force=force))
         if len(errors) > 0:
             logger.error('%d errors during indexing (see logs above for backtraces)', len(errors))
         for e in errors:
@@ -196,7 +491,11 @@ def do_demo(
                 host='127.0.0.1',
                 port=port,
                 quiet=False,
-                config=ServerConfig(db=dbp, timezone=get_system_tz()),
+                config=ServerConfig(
+                    db=dbp,
+                    timezone=get_system_tz(),
+                    canonify_cache_size=config.get().canonify_cache_size,
+                ),
             )
 
         if sys.stdin.isatty():
@@ -293,7 +592,8 @@ def cli_doctor_db(args: argparse.Namespace) -> None:
     else:
         logger.info(f'OK, database exists: {db}')
 
-    cmd = ['sqlite3', str(db), 'select src, COUNT(*) from visits GROUP BY src']
+    # source_stats is maintained by the indexer, so this is quick even for huge databases
+    cmd = ['sqlite3', '-header', str(db), 'SELECT src, visits, indexed_at, seconds FROM source_stats ORDER BY src']
     logger.info(f'Querying database summary: {cmd}')
     check_call(cmd)
 
@@ -350,6 +650,12 @@ def main() -> None:
             action="store_true",
             help="Empty db before populating it with newly indexed visits.  If interrupted, db is left untouched.",
         )
+        parser.add_argument(
+            '--force',
+            required=False,
+            action="store_true",
+            help="Reindex all sources, even the ones with declared inputs which didn't change since the last run.",
+        )
 
     F = lambda prog: argparse.ArgumentDefaultsHelpFormatter(prog, width=120)
     p = argparse.ArgumentParser(formatter_class=F)
@@ -430,6 +736,7 @@ def main() -> None:
                 dry=args.dry,
                 sources_subset=args.sources,
                 overwrite_db=args.overwrite,
+                force=args.force,
             )
             if len(errors) > 0:
                 sys.exit(1)
@@ -447,6 +754,7 @@ def main() -> None:
                 name=args.name,
                 sources_subset=args.sources,
                 overwrite_db=args.overwrite,
+                force=args.force,
             )
         elif mode == 'install-server':  # todo rename to 'autostart' or something?
             install_server.install(args)
@@ -13,12 +13,19 @@ Also some experiments to establish 'URL hierarchy'.
 from __future__ import annotations
 
 import re
+import sqlite3
+import threading
 import typing
 import urllib.parse
-from collections.abc import Collection, Iterable, Sequence
+from collections import OrderedDict
+from collections.abc import Collection, Iterable, Iterator, Mapping, Sequence
+from contextlib import contextmanager
+from functools import lru_cache
 
 # TODO eh?? they fixed mobile.twitter.com?
 from itertools import chain
+from pathlib import Path
+from types import MappingProxyType
 from typing import Any, NamedTuple
 from urllib.parse import SplitResult, parse_qsl, urlencode, urlsplit, urlunsplit
 
@@ -105,25 +112,93 @@ class Spec(NamedTuple):
     fkeep: bool = False
 
     def keep_query(self, q: str) -> int | None:  # returns order
-        if self.qkeep is True:
-            return 1
-        qkeep = {q: i for i, q in enumerate(chain(default_qkeep, self.qkeep or []))}
+        # NOTE: canonify uses precompiled specs, this is mostly kept for backwards compatibility
+        return self.compile().keep_query(q)
+
+    def compile(self) -> CompiledSpec:
+        extra = () if isinstance(self.qkeep, bool) or self.qkeep is None else self.qkeep
+        qkeep = {q: i for i, q in enumerate(chain(default_qkeep, extra))}
         qremove = default_qremove.union(self.qremove or {})
-        # I suppose 'remove' is only useful for logging. we remove by default anyway
+        return CompiledSpec(
+            spec=self,
+            keep_all=self.qkeep is True,
+            qkeep=MappingProxyType(qkeep),
+            # I suppose 'remove' is only useful for logging. we remove by default anyway
+            qremove=frozenset(qremove),
+        )
+
+    @classmethod
+    def make(cls, **kwargs) -> Spec:
+        return cls(**kwargs)
+
+
+class CompiledSpec(NamedTuple):
+    '''
+    Immutable lookup tables for a Spec, so canonify doesn't have to build them for every query parameter.
+    '''
 
-        qk = qkeep.get(q)
-        if qk is not None:
-            return qk
+    spec: Spec
+    keep_all: bool
+    qkeep: Mapping[str, int]
+    qremove: frozenset[str]
+
+    def keep_query(self, q: str) -> int | None:  # returns order
+        if self.keep_all:
+            return 1
         # todo later, check if spec tells both to keep and remove?
-        if q in qremove:
-            return None
-        # by default drop all
+        # by default drop all (including qremove)
         # it's a better default, since if it's *too* unified, the user would notice it. but not vice versa!
+        return self.qkeep.get(q)
+
+
+class _TrieNode[V]:
+    __slots__ = ('children', 'value')
+
+    def __init__(self) -> None:
+        self.children: dict[str, _TrieNode[V]] = {}
+        self.value: V | None = None
+
+
+class DomainTrie[V]:
+    '''
+    Maps domains to values, keyed by reversed labels (e.g. com -> youtube -> m).
+    Lookup returns the value for the shortest matching suffix of the domain, and costs O(number of labels).
+    '''
+
+    def __init__(self, items: Iterable[tuple[str, V]] = ()) -> None:
+        self._root: _TrieNode[V] = _TrieNode()
+        self._size = 0
+        for dom, value in items:
+            self.add(dom, value)
+
+    def add(self, dom: str, value: V) -> None:
+        node = self._root
+        for label in reversed(dom.split('.')):
+            child = node.children.get(label)
+            if child is None:
+                child = _TrieNode()
+                node.children[label] = child
+            node = child
+        if node.value is None:
+            self._size += 1
+        node.value = value
+
+    def lookup(self, dom: str) -> V | None:
+        node = self._root
+        for label in reversed(dom.split('.')):
+            child = node.children.get(label)
+            if child is None:
+                return None
+            node = child
+            if node.value is not None:
+                return node.value
         return None
 
-    @classmethod
-    def make(cls, **kwargs) -> Spec:
-        return cls(**kwargs)
+    def __contains__(self, dom: str) -> bool:
+        return self.lookup(dom) is not None
+
+    def __len__(self) -> int:
+        return self._size
 
 
 S = Spec
@@ -181,21 +256,18 @@ specs: dict[str, Spec] = {
 
 _def_spec = S()
 
+# compiled once on import, see CompiledSpec
+_spec_trie: DomainTrie[CompiledSpec] = DomainTrie((dom, spec.compile()) for dom, spec in specs.items())
+_def_spec_compiled = _def_spec.compile()
+
+
+def get_compiled_spec(dom: str) -> CompiledSpec:
+    sp = _spec_trie.lookup(dom)
+    return _def_spec_compiled if sp is None else sp
+
 
-# TODO use cache?
 def get_spec(dom: str) -> Spec:
-    # ugh. a bit ugly way of getting stuff without subdomain...
-    parts = dom.split('.')
-    cur = None
-    for p in reversed(parts):
-        if cur is None:
-            cur = p
-        else:
-            cur = p + '.' + cur
-        sp = specs.get(cur)
-        if sp is not None:
-            return sp
-    return _def_spec
+    return get_compiled_spec(dom).spec
 
 
 # ideally we'd just be able to reference the domain name and use it in the subst?
@@ -222,10 +294,13 @@ def _yc(domain: str, path: str, qq: Parts, frag: Frag) -> tuple[Any, Any, Parts,
     return (domain, path, qq, frag)
 
 
+_specs2: dict[str, Spec2] = {
+    'news.ycombinator.com': _yc,
+}
+
+
 def get_spec2(dom: str) -> Spec2 | None:
-    return {
-        'news.ycombinator.com': _yc,
-    }.get(dom)
+    return _specs2.get(dom)
 
 
 class CanonifyException(Exception):
@@ -252,9 +327,13 @@ def _quote_path(path: str) -> str:
 
 
 # TODO wtf is it doing???
+_google_amp_re = re.compile(r'google\..*/amp/s/')
+
+
 def _prenormalise(url: str) -> str:
     # meh..
-    url = re.sub(r'google\..*/amp/s/', '', url)
+    if '/amp/s/' in url:  # cheap check to avoid running the regex on every url
+        url = _google_amp_re.sub('', url)
 
     if '?' not in url:
         # sometimes urls have not ? but do have query parameters starting with & for some reason; urlsplit chokes over it
@@ -269,6 +348,48 @@ def _prenormalise(url: str) -> str:
 Left = str | Sequence[str]
 Right = tuple[str, str, str]
 
+_ID = r'(?P<id>[^/]+)'
+# _REST = r'(?P<rest>.*)'
+
+# the idea is that we can unify certain URLs here and map them to the 'canonical' one
+# this is a dict only for grouping but should be a list really.. todo
+transform_rules: dict[Left, Right] = {
+    # TODO m. handling might be quite common
+    # f'm.youtube.com/{_REST}': ('youtube.com', '{rest}'),
+    (
+        f'youtu.be/{_ID}',
+        f'youtube.com/embed/{_ID}',
+    ): ('youtube.com', '/watch', 'v={id}'),
+    # TODO wonder if there is a better candidate for canonical video link?
+    # {DOMAIN} pattern? implicit?
+    (
+        'twitter.com/home',
+        'twitter.com/explore',
+    ): ('twitter.com', '', ''),
+}
+
+
+CompiledRules = dict[str, list[tuple[re.Pattern[str], Right]]]
+
+
+def compile_rules(rules: dict[Left, Right]) -> CompiledRules:
+    '''
+    Groups the rules by domain, so each url is only matched against the rules for its own netloc.
+    Order of the rules within the same domain is preserved (first match wins).
+    '''
+    res: CompiledRules = {}
+    for frs, to in rules.items():
+        if len(to) == 2:
+            to = (*to, '')
+        for fr in (frs,) if isinstance(frs, str) else frs:
+            dom, rest = fr.split('/', maxsplit=1)
+            rest = '/' + rest  # path seems to always start with /
+            res.setdefault(dom, []).append((re.compile(rest), to))
+    return res
+
+
+_compiled_rules = compile_rules(transform_rules)
+
 
 def transform_split(split: SplitResult):
     netloc = canonify_domain(split.netloc)
@@ -278,46 +399,11 @@ def transform_split(split: SplitResult):
 
     fragment = split.fragment
 
-    ID = r'(?P<id>[^/]+)'
-    # REST = r'(?P<rest>.*)'
-
-    # the idea is that we can unify certain URLs here and map them to the 'canonical' one
-    # this is a dict only for grouping but should be a list really.. todo
-    rules: dict[Left, Right] = {
-        # TODO m. handling might be quite common
-        # f'm.youtube.com/{REST}': ('youtube.com', '{rest}'),
-        (
-            f'youtu.be/{ID}',
-            f'youtube.com/embed/{ID}',
-        ): ('youtube.com', '/watch', 'v={id}'),
-        # TODO wonder if there is a better candidate for canonical video link?
-        # {DOMAIN} pattern? implicit?
-        (
-            'twitter.com/home',
-            'twitter.com/explore',
-        ): ('twitter.com', '', ''),
-    }
-
-    def iter_rules():
-        for fr, to in rules.items():
-            if isinstance(fr, str):
-                fr = (fr,)
-            for f in fr:
-                yield f, to
-
-    for fr, to in iter_rules():
-        # TODO precache by domain?
-        dom, rest = fr.split('/', maxsplit=1)
-        if dom != netloc:
-            continue
-
-        rest = '/' + rest  # path seems to always start with /
-        m = re.fullmatch(rest, path)
+    for rx, to in _compiled_rules.get(netloc, ()):
+        m = rx.fullmatch(path)
         if m is None:
             continue
         gd = m.groupdict()
-        if len(to) == 2:
-            to = (*to, '')
 
         (netloc, path, qq) = (t.format(**gd) for t in to)
         qparts.extend(parse_qsl(qq, keep_blank_values=True))  # TODO hacky..
@@ -356,9 +442,11 @@ def myunsplit(domain: str, path: str, query: str, fragment: str) -> str:
 #     for re in regexes:
 
 
+_archive_org_re = re.compile(r'web.archive.org/web/(?P<timestamp>\d+)/(?P<rest>.*)')
+
+
 def handle_archive_org(url: str) -> str | None:
-    are = r'web.archive.org/web/(?P<timestamp>\d+)/(?P<rest>.*)'
-    m = re.fullmatch(are, url)
+    m = _archive_org_re.fullmatch(url)
     if m is None:
         return None
     else:
@@ -368,6 +456,40 @@ def handle_archive_org(url: str) -> str | None:
 # TODO ok, I suppose even though we can't distinguish + and space, likelihood of them overlapping in normalised url is so low, that it doesn't matter much
 # TODO actually, might be easier for most special charaters
 def canonify(url: str) -> str:
+    res = _canonify_simple(url)
+    if res is not None:
+        return res
+    return _canonify_full(url)
+
+
+# optional scheme, plain ascii domain, and path that consists only of characters quote() keeps intact
+# (so no query/fragment/port/percent-encoding etc.)
+_simple_url_re = re.compile(r'(?:[A-Za-z][A-Za-z0-9+.-]*://)?([A-Za-z0-9.-]+)(/[A-Za-z0-9_.~/-]*)?')
+
+
+def _canonify_simple(url: str) -> str | None:
+    '''
+    Fast path for urls that don't need any rewriting apart from the domain, e.g. https://example.com/some/page.html
+    Returns None if the url has to go through the full canonify.
+    Must give exactly the same results as _canonify_full, see test_fast_path_*
+    '''
+    m = _simple_url_re.fullmatch(url)
+    if m is None:
+        return None
+    if '/amp/s/' in url:  # see _prenormalise
+        return None
+    netloc = m.group(1)
+    path = m.group(2) or ''
+    domain = canonify_domain(netloc)
+    if domain == '' or domain in _compiled_rules or domain in _specs2:
+        return None
+    if _archive_org_re.fullmatch(netloc + path) is not None:
+        return None
+    # this is what myunsplit + _quote_path boil down to for such urls
+    return (domain + path).removesuffix('/')
+
+
+def _canonify_full(url: str) -> str:
     # TODO check for invalid charaters?
     url = _prenormalise(url)
 
@@ -393,7 +515,7 @@ def canonify(url: str) -> str:
     res = handle_archive_org(no_protocol)
     if res is not None:
         assert len(res) < len(no_protocol)  # just a paranoia to avoid infinite recursion...
-        return canonify(res)
+        return _canonify_full(res)
 
     domain, path, qq, _frag = transform_split(parts)
 
@@ -402,7 +524,7 @@ def canonify(url: str) -> str:
         # meh
         domain, path, qq, _frag = spec2(domain, path, qq, _frag)
 
-    spec = get_spec(domain)
+    spec = get_compiled_spec(domain)
 
     # TODO FIXME turn this logic back on?
     # frag = parts.fragment if spec.fkeep else ''
@@ -425,6 +547,302 @@ def canonify(url: str) -> str:
     return uns
 
 
+# bump this when canonify logic changes in a way not reflected by the rule tables below
+# (it's part of rules_fingerprint, so persistent caches get invalidated)
+CANONIFY_VERSION = 1
+
+
+def _stable(x: Any) -> Any:
+    # deterministic representation (sets/dicts are unordered, functions repr as addresses)
+    if isinstance(x, Mapping):
+        return sorted((repr(k), _stable(v)) for k, v in x.items())
+    if isinstance(x, (set, frozenset)):
+        return sorted(repr(i) for i in x)
+    if isinstance(x, (list, tuple)):
+        return [_stable(i) for i in x]
+    if callable(x):
+        return f'{x.__module__}.{x.__qualname__}'
+    return repr(x)
+
+
+@lru_cache(1)
+def rules_fingerprint() -> str:
+    '''
+    Hash of the rule set canonify is using, changes whenever the rules do
+    '''
+    import hashlib
+
+    stuff = {
+        'version': CANONIFY_VERSION,
+        'dom_subst': dom_subst,
+        'default_qremove': default_qremove,
+        'default_qkeep': default_qkeep,
+        'specs': specs,
+        'specs2': _specs2,
+        'transform_rules': transform_rules,
+    }
+    return hashlib.sha256(repr(_stable(stuff)).encode('utf8')).hexdigest()
+
+
+class CanonifyStore:
+    '''
+    Persistent orig_url -> norm_url mapping (sqlite file), so reindexing doesn't have to canonify the same urls again.
+
+    The database is stamped with rules_fingerprint() and gets wiped automatically if the rules changed.
+    Writes are buffered, call flush() (or close()) to persist them.
+    Several processes (e.g. concurrent source workers) can share the store. Since it's just a cache,
+    if the database is locked for too long or fails otherwise, reads return nothing and writes are dropped.
+    '''
+
+    _FLUSH_EVERY = 10_000
+    # seconds to wait for other processes holding the write lock
+    _BUSY_TIMEOUT = 30.0
+
+    def __init__(self, path: Path, *, fingerprint: str | None = None) -> None:
+        self.path = path
+        self.fingerprint = rules_fingerprint() if fingerprint is None else fingerprint
+        self._lock = threading.Lock()
+        self._pending: dict[str, str] = {}
+        # autocommit mode, transactions are managed explicitly
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=self._BUSY_TIMEOUT, isolation_level=None)
+        # it's just a cache, fine to lose it on crash
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=OFF')
+        # take the write lock straightaway, otherwise concurrent processes could both decide to reset the cache
+        with self._transaction():
+            self._conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'fingerprint'").fetchone()
+            stored = None if row is None else row[0]
+            if stored != self.fingerprint:
+                self._conn.execute('DROP TABLE IF EXISTS urls')
+                self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('fingerprint', ?)", (self.fingerprint,))
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS urls (orig_url TEXT PRIMARY KEY, norm_url TEXT NOT NULL) WITHOUT ROWID'
+            )
+        # i.e. there was a cache, but for different rules
+        self.invalidated = stored is not None and stored != self.fingerprint
+
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self._conn.execute('ROLLBACK')
+            raise
+        self._conn.execute('COMMIT')
+
+    def get_many(self, urls: Collection[str]) -> dict[str, str]:
+        res: dict[str, str] = {}
+        chunk = 500  # sqlite limits number of query parameters
+        ulist = list(urls)
+        with self._lock:
+            for url in ulist:
+                nurl = self._pending.get(url)
+                if nurl is not None:
+                    res[url] = nurl
+            try:
+                for i in range(0, len(ulist), chunk):
+                    part = ulist[i : i + chunk]
+                    qs = ','.join('?' * len(part))
+                    res.update(self._conn.execute(f'SELECT orig_url, norm_url FROM urls WHERE orig_url IN ({qs})', part))
+            except sqlite3.Error as e:
+                _store_error(self.path, 'read', e)
+        return res
+
+    def get(self, url: str) -> str | None:
+        return self.get_many([url]).get(url)
+
+    def put(self, url: str, nurl: str) -> None:
+        with self._lock:
+            self._pending[url] = nurl
+            if len(self._pending) >= self._FLUSH_EVERY:
+                self._flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush()
+
+    def _flush(self) -> None:
+        if len(self._pending) == 0:
+            return
+        try:
+            with self._transaction():
+                self._conn.executemany('INSERT OR REPLACE INTO urls VALUES (?, ?)', self._pending.items())
+        except sqlite3.Error as e:
+            _store_error(self.path, 'write', e)
+        # dropped on errors too, it's just a cache
+        self._pending.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._flush()
+            [(count,)] = self._conn.execute('SELECT COUNT(*) FROM urls')
+        return count
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush()
+            self._conn.close()
+
+
+def _store_error(path: Path, what: str, e: Exception) -> None:
+    from .common import logger  # common depends on this module
+
+    logger.warning("canonify store %s: %s failed, ignoring: %r", path, what, e)
+
+
+class CacheStats(NamedTuple):
+    hits: int
+    misses: int
+    evictions: int
+    size: int
+    maxsize: int
+    # misses in memory which were found in the persistent store
+    store_hits: int = 0
+
+
+DEFAULT_CACHE_SIZE = 100_000
+
+
+class CanonifyCache:
+    '''
+    Bounded LRU cache in front of canonify.
+
+    The same URLs show up over and over (e.g. in browser history or in the links on a page),
+    so memoizing saves quite a lot of work both during indexing and in the server.
+    Can be backed by a persistent CanonifyStore, which is consulted on misses.
+    Errors aren't cached, they are simply reraised.
+    maxsize=0 disables in-memory caching.
+    '''
+
+    def __init__(self, maxsize: int = DEFAULT_CACHE_SIZE) -> None:
+        self.maxsize = maxsize
+        self._cache: OrderedDict[str, str] = OrderedDict()
+        # server calls it from multiple threads
+        self._lock = threading.Lock()
+        self.store: CanonifyStore | None = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.store_hits = 0
+
+    def canonify(self, url: str) -> str:
+        res = self.lookup_many([url]).get(url)
+        if res is not None:
+            return res
+        res = canonify(url)
+        self.add(url, res)
+        return res
+
+    def lookup_many(self, urls: Iterable[str]) -> dict[str, str]:
+        '''
+        Cached results for whichever urls are present in memory or in the store
+        '''
+        found: dict[str, str] = {}
+        missing: list[str] = []
+        with self._lock:
+            for url in urls:
+                res = self._cache.get(url)
+                if res is None:
+                    missing.append(url)
+                    continue
+                self._cache.move_to_end(url)
+                found[url] = res
+            self.hits += len(found)
+            self.misses += len(missing)
+        store = self.store
+        if store is not None and len(missing) > 0:
+            stored = store.get_many(missing)
+            with self._lock:
+                self.store_hits += len(stored)
+                self._put_many(stored)
+            found.update(stored)
+        return found
+
+    def add(self, url: str, nurl: str) -> None:
+        with self._lock:
+            self._put_many({url: nurl})
+        store = self.store
+        if store is not None:
+            store.put(url, nurl)
+
+    def _put_many(self, items: Mapping[str, str]) -> None:
+        if self.maxsize <= 0:
+            return
+        self._cache.update(items)
+        self._evict()
+
+    def _evict(self) -> None:
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+            self.evictions += 1
+
+    def resize(self, maxsize: int) -> None:
+        with self._lock:
+            self.maxsize = maxsize
+            self._evict()
+
+    def attach_store(self, store: CanonifyStore | None) -> None:
+        '''
+        Pass None to detach, the caller is responsible for closing the store
+        '''
+        if self.store is not None:
+            self.store.flush()
+        self.store = store
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.store_hits = 0
+
+    def stats(self) -> CacheStats:
+        return CacheStats(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            size=len(self._cache),
+            maxsize=self.maxsize,
+            store_hits=self.store_hits,
+        )
+
+
+# shared between the indexer and the server
+canonify_cache = CanonifyCache()
+
+
+def canonify_cached(url: str) -> str:
+    return canonify_cache.canonify(url)
+
+
+def canonify_many(urls: Iterable[str], *, cache: CanonifyCache | None = None) -> list[str | Exception]:
+    '''
+    Canonifies a batch of urls, each distinct url is only processed once.
+    Results are aligned with the input, and errors are returned in place of the result rather than raised.
+    '''
+    ulist = list(urls)
+    unique = dict.fromkeys(ulist)
+    done: dict[str, str | Exception] = {}
+    if cache is not None:
+        done.update(cache.lookup_many(unique))
+    for url in unique:
+        if url in done:
+            continue
+        r: str | Exception
+        try:
+            r = canonify(url)
+        except Exception as e:
+            r = e
+        else:
+            if cache is not None:
+                cache.add(url, r)
+        done[url] = r
+    return [done[url] for url in ulist]
+
+
 # TODO wonder if lisp could be convenient for this. lol
 TW_PATTERNS = [
     {
@@ -670,84 +1088,218 @@ def get_patterns():  # pragma: no cover
     return {k: list(handle(v)) for k, v in PATTERNS.items()}
 
 
-def domains(it):  # pragma: no cover
-    from collections import Counter
+class PatternIndex:
+    '''
+    Picks the pattern group by domain labels and matches against all patterns of the group with a single regex.
+    The first matching pattern wins, same as trying them one by one.
+    '''
+
+    def __init__(self, patterns: Mapping[str, Sequence[str]]) -> None:
+        # first label -> (priority, labels, group name)
+        self._by_label: dict[str, list[tuple[int, tuple[str, ...], str]]] = {}
+        self._regexes: dict[str, tuple[re.Pattern[str], Sequence[str]]] = {}
+        for prio, (name, pats) in enumerate(patterns.items()):
+            labels = tuple(name.split('.'))
+            self._by_label.setdefault(labels[0], []).append((prio, labels, name))
+            combined = '|'.join(f'(?P<p{i}>{p})' for i, p in enumerate(pats))
+            self._regexes[name] = (re.compile(combined), pats)
+        self.group = lru_cache(maxsize=100_000)(self._group)
+
+    def _group(self, domain: str) -> str | None:
+        '''
+        Group whose name is a contiguous subsequence of domain labels (e.g. 'twitter' for mobile.twitter.com)
+        '''
+        labels = domain.split('.')
+        best: tuple[int, str] | None = None
+        for i, label in enumerate(labels):
+            for prio, glabels, name in self._by_label.get(label, ()):
+                if tuple(labels[i : i + len(glabels)]) == glabels and (best is None or prio < best[0]):
+                    best = (prio, name)
+        return None if best is None else best[1]
+
+    def match(self, nurl: str) -> tuple[str | None, str | None]:
+        '''
+        Returns (group, matched pattern) for a normalised url
+        '''
+        group = self.group(nurl.split('/', maxsplit=1)[0])
+        if group is None:
+            return (None, None)
+        regex, pats = self._regexes[group]
+        m = regex.fullmatch(nurl)
+        if m is None or m.lastgroup is None:
+            return (group, None)
+        return (group, pats[int(m.lastgroup[1:])])
+
+
+@lru_cache(1)
+def _pattern_index() -> PatternIndex:
+    return PatternIndex(get_patterns())
+
+
+class Analysis(NamedTuple):
+    domains: typing.Counter[str]
+    patterns: typing.Counter[str | None]
+    # domain + first path component of urls which didn't match any pattern in their group
+    unmatched: typing.Counter[str]
+    unmatched_examples: list[str]
+    error_examples: list[str]
+    total: int
 
-    c: typing.Counter[str] = Counter()
-    for line in it:
+    @classmethod
+    def empty(cls) -> Analysis:
+        from collections import Counter
+
+        return cls(domains=Counter(), patterns=Counter(), unmatched=Counter(), unmatched_examples=[], error_examples=[], total=0)
+
+    def merge(self, other: Analysis, *, examples: int = 20) -> Analysis:
+        '''
+        Updates the counters and examples of self in place (copying them on every merge would be quadratic),
+        returns the merged analysis since total can't be updated in place.
+        Same as analyse, keeps the first examples.
+        '''
+        self.domains.update(other.domains)
+        self.patterns.update(other.patterns)
+        self.unmatched.update(other.unmatched)
+        for mine, theirs in [
+            (self.unmatched_examples, other.unmatched_examples),
+            (self.error_examples, other.error_examples),
+        ]:
+            mine.extend(theirs[: max(0, examples - len(mine))])
+        return self._replace(total=self.total + other.total)
+
+
+def analyse(lines: Iterable[str], *, patterns: bool = True, examples: int = 20) -> Analysis:
+    res = Analysis.empty()
+    index = _pattern_index()
+    total = 0
+    for line in lines:
+        total += 1
         url = line.strip()
         try:
             nurl = canonify(url)
         except CanonifyException as e:
-            print(f"ERROR while normalising! {url} {e}")
-            c['ERROR'] += 1
+            res.domains['ERROR'] += 1
+            if len(res.error_examples) < examples:
+                res.error_examples.append(f'{url} {e}')
             continue
+        res.domains[nurl[: nurl.find('/')]] += 1
+        if not patterns:
+            continue
+        group, pat = index.match(nurl)
+        if group is None:
+            continue
+        res.patterns[pat] += 1
+        if pat is None:
+            res.unmatched['/'.join(nurl.split('/')[:2])] += 1
+            if len(res.unmatched_examples) < examples:
+                res.unmatched_examples.append(nurl)
+    return res._replace(total=total)
+
+
+def analyse_stream(
+    it: Iterable[str],
+    *,
+    patterns: bool = True,
+    jobs: int = 1,
+    shard_size: int = 10_000,
+    report_every: int | None = None,
+    on_report: typing.Callable[[Analysis], None] | None = None,
+    examples: int = 20,
+) -> Analysis:
+    '''
+    Analyses the input in shards of shard_size lines, in jobs worker processes if jobs > 1.
+    Calls on_report with the counts so far roughly every report_every lines.
+    '''
+    from collections import deque
+    from concurrent.futures import Future, ProcessPoolExecutor
+    from contextlib import ExitStack
+    from itertools import islice
+
+    def shards() -> Iterator[list[str]]:
+        lines = iter(it)
+        while shard := list(islice(lines, shard_size)):
+            yield shard
+
+    res = Analysis.empty()
+    reported = 0
+
+    def add(a: Analysis) -> None:
+        nonlocal res, reported
+        res = res.merge(a, examples=examples)
+        if report_every is not None and on_report is not None and res.total - reported >= report_every:
+            reported = res.total
+            on_report(res)
+
+    with ExitStack() as stack:
+        if jobs <= 1:
+            for shard in shards():
+                add(analyse(shard, patterns=patterns, examples=examples))
         else:
-            udom = nurl[: nurl.find('/')]
-            c[udom] += 1
+            pool = stack.enter_context(ProcessPoolExecutor(max_workers=jobs))
+            # bounded, so we don't read the whole input in memory
+            pending: deque[Future[Analysis]] = deque()
+            for shard in shards():
+                pending.append(pool.submit(analyse, shard, patterns=patterns, examples=examples))
+                if len(pending) >= 2 * jobs:
+                    add(pending.popleft().result())
+            while pending:
+                add(pending.popleft().result())
+    return res
+
+
+def _print_domains(a: Analysis, *, top: int = 20, file=None) -> None:
     from pprint import pprint
 
-    pprint(c.most_common(20))
+    print(f'--- {a.total} urls', file=file)
+    pprint(a.domains.most_common(top), stream=file)
 
 
-def groups(it, args):  # pragma: no cover
-    all_pats = get_patterns()
+def _print_groups(a: Analysis, *, top: int = 20, file=None) -> None:
+    from pprint import pprint
 
-    from collections import Counter
+    print(f'--- {a.total} urls', file=file)
+    pprint(a.patterns.most_common(top), stream=file)
+    print('   ' + str(a.unmatched_examples[:10]), file=file)
+    matched = sum(a.patterns.values())
+    if matched > 0:
+        print(f"Unmatched: {a.patterns[None] / matched * 100:.1f}%", file=file)
+    pprint(a.unmatched.most_common(10), stream=file)
 
-    c: typing.Counter[str | None] = Counter()
-    unmatched: list[str] = []
 
-    def dump():
-        print(c)
-        print('   ' + str(unmatched[-10:]))
+def _lines(path: Path) -> Iterator[str]:  # pragma: no cover
+    with path.open() as fo:
+        yield from fo
 
-    def reg(url, pat):
-        c[pat] += 1
-        if pat is None:
-            unmatched.append(nurl)
 
-    for i, line in enumerate(it):
-        if i % 10000 == 0:
-            pass
-            # dump()
-        url = line.strip()
-        try:
-            nurl = canonify(url)
-        except CanonifyException as e:
-            print(f"ERROR while normalising! {url} {e}")
-            continue
-        udom = nurl[: nurl.find('/')]
-        usplit = udom.split('.')
-        patterns = None
-        for dom, pats in all_pats.items():
-            dsplit = dom.split('.')
-            if '$'.join(dsplit) in '$'.join(usplit):  # meh
-                patterns = pats
-                break
-        else:
-            # TODO should just be ignored?
-            # reg(nurl, None)
-            continue
+def domains(it, args):  # pragma: no cover
+    import sys
 
-        pat = None
-        for p in patterns:
-            m = re.fullmatch(p, nurl)
-            if m is None:
-                continue
-            pat = p
-            break
-        reg(nurl, pat)
-    for u in sorted(unmatched):
-        print(u)
-    dump()
-    nones = c[None]
-    # TODO print link examples alongside?
-    print(f"Unmatched: {nones / sum(c.values()) * 100:.1f}%")
-    uc = Counter([u.split('/')[:2][-1] for u in unmatched]).most_common(10)
-    from pprint import pprint
+    a = analyse_stream(
+        it,
+        patterns=False,
+        jobs=args.jobs,
+        report_every=args.report_every,
+        on_report=lambda a: _print_domains(a, file=sys.stderr),
+    )
+    for e in a.error_examples:
+        print(f"ERROR while normalising! {e}")
+    _print_domains(a)
 
-    pprint(uc)
+
+def groups(it, args):  # pragma: no cover
+    import sys
+
+    a = analyse_stream(
+        it,
+        jobs=args.jobs,
+        report_every=args.report_every,
+        on_report=lambda a: _print_groups(a, file=sys.stderr),
+    )
+    for e in a.error_examples:
+        print(f"ERROR while normalising! {e}")
+    for u in sorted(a.unmatched_examples):
+        print(u)
+    _print_groups(a)
 
 
 def display(it, args) -> None:
@@ -815,6 +1367,9 @@ def main() -> None:  # pragma: no cover
         epilog='''
 - sqlite3 promnesia.sqlite 'select distinct orig_url from visits' | cannon.py --domains
 
+- pattern analysis over big url dumps, in 4 processes
+  cannon.py --groups --jobs 4 --file urls.0.txt --file urls.1.txt
+
 - running comparison
   sqlite3 promnesia.sqlite 'select distinct orig_url from visits where norm_url like "%twitter%" order by orig_url' | src/promnesia/cannon.py
 ''',
@@ -824,10 +1379,15 @@ def main() -> None:  # pragma: no cover
     p.add_argument('--human', action='store_true')
     p.add_argument('--groups', action='store_true')
     p.add_argument('--domains', action='store_true', help='useful for counting number of URLs by domains')
+    p.add_argument('--file', action='append', type=Path, help='read urls from file(s) instead of stdin (can be repeated)')
+    p.add_argument('--jobs', '-j', type=int, default=1, help='number of processes for --groups/--domains')
+    p.add_argument('--report-every', type=int, default=1_000_000, help='print counts to stderr every N urls')
     args = p.parse_args()
 
     it: Iterable[str]
-    if args.input is None:
+    if args.file is not None:
+        it = chain.from_iterable(_lines(f) for f in args.file)
+    elif args.input is None:
         import sys
 
         it = sys.stdin
@@ -836,8 +1396,8 @@ def main() -> None:  # pragma: no cover
 
     if args.groups:
         groups(it, args)
-    if args.domains:
-        domains(it)
+    elif args.domains:
+        domains(it, args)
     else:
         display(it, args)
 
@@ -13,6 +13,7 @@ from copy import copy
 from datetime import UTC, date, datetime
 from functools import lru_cache
 from glob import glob
+from hashlib import sha256
 from pathlib import Path
 from subprocess import PIPE, Popen, run
 from timeit import default_timer as timer
@@ -24,7 +25,11 @@ import platformdirs
 from more_itertools import intersperse
 from typing_extensions import deprecated
 
-from .cannon import canonify
+from .cannon import DomainTrie, canonify_cached
+
+if TYPE_CHECKING:
+    from hashlib import _Hash
+    from multiprocessing.context import ForkServerContext, SpawnContext
 
 _is_windows = os.name == 'nt'
 
@@ -171,7 +176,8 @@ class DbVisit(NamedTuple):
     duration: Second | None = None
 
     @staticmethod
-    def make(p: Visit, src: SourceName) -> Res[DbVisit]:
+    def make(p: Visit, src: SourceName, *, norm_url: Url | None = None) -> Res[DbVisit]:
+        # norm_url can be passed if it's already been canonified (e.g. in a batch)
         try:
             # hmm, mypy gets a bit confused here.. presumably because datetime is always datetime (but date is not datetime)
             if isinstance(p.dt, datetime):
@@ -184,10 +190,13 @@ class DbVisit(NamedTuple):
         except Exception as e:
             return e
 
-        try:
-            nurl = canonify(p.url)
-        except Exception as e:
-            return e
+        if norm_url is not None:
+            nurl = norm_url
+        else:
+            try:
+                nurl = canonify_cached(p.url)
+            except Exception as e:
+                return e
 
         return DbVisit(
             # TODO shit, can't handle errors properly here...
@@ -204,6 +213,114 @@ class DbVisit(NamedTuple):
 Filter = Callable[[Url], bool]
 
 
+class DomainFilter:
+    """
+    Filters out urls on any of the domains (including their subdomains), e.g. for blocking ad/tracker hosts.
+
+    Domains can be passed directly, or read from files with one domain per line.
+    Files in hosts format ('0.0.0.0 ads.example.com') and adblock domain rules ('||ads.example.com^') work too,
+    other adblock rules (e.g. element hiding or path based) are ignored since they don't block whole domains.
+    Lookup costs O(number of labels in the url domain), regardless of how many domains are in the list.
+
+    Usage in config: FILTERS = [DomainFilter(['doubleclick.net'], files=['/path/to/blocklist.txt'])]
+    """
+
+    def __init__(self, domains: Iterable[str] = (), *, files: Iterable[PathIsh] = ()) -> None:
+        self._trie: DomainTrie[bool] = DomainTrie()
+        # kept for the fingerprint, files only contribute their paths, sizes and mtimes
+        self._domains: list[str] = []
+        self._files = [Path(f) for f in files]
+        for d in domains:
+            self.add(d)
+        for f in self._files:
+            with f.open() as fo:
+                for line in fo:
+                    self._add(line)
+
+    def add(self, domain: str) -> None:
+        self._domains.append(domain)
+        self._add(domain)
+
+    def _add(self, domain: str) -> None:
+        for dom in _parse_domain_entries(domain):
+            self._trie.add(dom, True)  # noqa: FBT003
+
+    def fingerprint(self) -> str:
+        '''
+        Hash of the domains and the files, changes if the set of filtered urls might have changed.
+        '''
+        h = sha256(repr(sorted(self._domains)).encode('utf8'))
+        _hash_inputs(h, self._files)
+        return h.hexdigest()
+
+    def __len__(self) -> int:
+        return len(self._trie)
+
+    def __call__(self, url: Url) -> bool:
+        return self._trie.lookup(_url_domain(url)) is not None
+
+
+# adblock element hiding/scriptlet rules, these hide parts of the page rather than block the whole domain
+_ADBLOCK_COSMETIC = ('##', '#@#', '#?#', '#$#')
+# comments are only recognized at the start of the line or after whitespace, e.g. 'a.com#b' isn't a comment
+_COMMENT_RE = re.compile(r'(?:^|\s)#')
+_HOSTNAME_RE = re.compile(r'[a-z0-9_-]+(?:\.[a-z0-9_-]+)*')
+
+
+def _parse_domain_entries(line: str) -> list[str]:
+    line = line.strip()
+    if line.startswith(('!', '@@', '[')):  # adblock comment, exception rule or header (e.g. '[Adblock Plus 2.0]')
+        return []
+    if any(c in line for c in _ADBLOCK_COSMETIC):
+        return []
+    line = _COMMENT_RE.split(line, maxsplit=1)[0]
+    parts = line.split()
+    if len(parts) > 1 and _is_ip_address(parts[0]):
+        # hosts file format: ip address followed by one or more hosts
+        parts = parts[1:]
+    res = []
+    for part in parts:
+        dom = part.lower()
+        if dom.startswith('||'):
+            # adblock network rule, only whole domain ones ('||domain^') make sense here
+            # options (e.g. '$third-party') don't matter for us
+            dom = dom.split('$', maxsplit=1)[0]
+            if not dom.endswith('^'):
+                continue
+            dom = dom[2:-1]
+        dom = dom.removeprefix('*.').strip('.')
+        if dom in {'localhost', 'localhost.localdomain', 'local', 'broadcasthost'} or _HOSTNAME_RE.fullmatch(dom) is None:
+            continue
+        res.append(dom)
+    return res
+
+
+def _is_ip_address(s: str) -> bool:
+    import ipaddress
+
+    try:
+        ipaddress.ip_address(s)
+    except ValueError:
+        return False
+    return True
+
+
+def _url_domain(url: Url) -> str:
+    start = url.find('://')
+    start = 0 if start == -1 else start + 3
+    end = len(url)
+    for c in '/?#':
+        i = url.find(c, start, end)
+        if i != -1:
+            end = i
+    host = url[start:end]
+    host = host[host.rfind('@') + 1 :]  # user:password@
+    colon = host.find(':')  # port
+    if colon != -1:
+        host = host[:colon]
+    return host.lower().rstrip('.')
+
+
 from .logging import LazyLogger
 
 logger = LazyLogger('promnesia', level='DEBUG')
@@ -222,6 +339,18 @@ def get_tmpdir() -> tempfile.TemporaryDirectory[str]:
     return tdir
 
 
+def mp_context() -> ForkServerContext | SpawnContext:
+    '''
+    Context for worker processes. Not using fork (default on Linux), since workers are started while other threads
+    (e.g. the database writer) might be running, and forking a multithreaded process might deadlock the child.
+    '''
+    import multiprocessing
+
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
 # TODO use mypy literal?
 Syntax = str
 
@@ -299,6 +428,10 @@ PreExtractor = Callable[..., Results]
 PreSource = PreExtractor | ModuleType  # module with 'index' functon defined in it
 
 
+# files/directories (or glob patterns) a source reads, or a function returning them, e.g. to look up HPI export paths lazily
+SourceInputs = Sequence[PathIsh] | Callable[[], Iterable[PathIsh]]
+
+
 # todo not sure about this...
 def _guess_name(thing: PreSource) -> str:
     guess = ''
@@ -325,10 +458,22 @@ def _get_index_function(sourceish: PreSource) -> PreExtractor:
     return res
 
 
+# default object repr, e.g. '<function <lambda> at 0x7f...>', differs between runs
+_MEMORY_ADDRESS_RE = re.compile(r' at 0x[0-9a-fA-F]+>')
+
+
 class Source:
     # TODO make sure it works with empty src?
     # TODO later, make it properly optional?
-    def __init__(self, ff: PreSource, *args, src: SourceName = '', name: SourceName = '', **kwargs) -> None:
+    def __init__(
+        self,
+        ff: PreSource,
+        *args,
+        src: SourceName = '',
+        name: SourceName = '',
+        inputs: SourceInputs | None = None,
+        **kwargs,
+    ) -> None:
         # NOTE: in principle, would be nice to make the Source countructor to be as dumb as possible
         # so we could move _get_index_function inside extractor lambda
         # but that way we get nicer error reporting
@@ -352,17 +497,66 @@ class Source:
                 # todo warn?
                 name_guess = ''
             self.name = name_guess
+        # if declared, the source is only reindexed when its inputs change (see fingerprint)
+        self.inputs = inputs
 
     @property
     def description(self) -> str:
         return f'{getattr(self.ff, "__module__", None)}:{getattr(self.ff, "__name__", None)} {self.args} {self.kwargs}'
 
+    def fingerprint(self) -> str | None:
+        '''
+        Hash of the source's arguments and its inputs (paths, sizes and mtimes of all files), None if inputs aren't declared.
+        Also None if the arguments can't be fingerprinted (e.g. functions, their repr changes on every run).
+        '''
+        if self.inputs is None:
+            return None
+        key = self.description
+        if not hasattr(self.ff, '__name__'):
+            # e.g. functools.partial, then its arguments aren't in the description
+            key += f' {self.ff!r}'
+        if _MEMORY_ADDRESS_RE.search(key) is not None:
+            logger.warning(
+                "%s: can't fingerprint the arguments (repr contains a memory address), so it's never skipped: %s",
+                self.name,
+                key,
+            )
+            return None
+        inputs = self.inputs() if callable(self.inputs) else self.inputs
+        h = sha256(key.encode('utf8'))
+        _hash_inputs(h, inputs)
+        return h.hexdigest()
+
     @property
     @deprecated("'src' property is deprecated, use 'name' instead")
     def src(self) -> str:
         return self.name
 
 
+def _hash_inputs(h: _Hash, inputs: Iterable[PathIsh]) -> None:
+    for path, st in _input_files(inputs):
+        h.update(repr((str(path), None if st is None else (st.st_size, st.st_mtime_ns))).encode('utf8'))
+
+
+def _input_files(inputs: Iterable[PathIsh]) -> list[tuple[Path, os.stat_result | None]]:
+    # None stat means the path is missing, that's part of the fingerprint too
+    res: list[tuple[Path, os.stat_result | None]] = []
+    for i in inputs:
+        si = os.path.expanduser(str(i))  # noqa: PTH111
+        is_glob = any(c in si for c in '*?[')
+        paths = [Path(p) for p in glob(si, recursive=True)] if is_glob else [Path(si)]  # noqa: PTH207
+        for p in paths:
+            if p.is_dir():
+                for root, _dirs, files in os.walk(p):
+                    res.extend((f, f.stat()) for f in map(Path(root).joinpath, files))
+            elif p.exists():
+                res.append((p, p.stat()))
+            else:
+                res.append((p, None))
+    res.sort(key=lambda x: x[0])
+    return res
+
+
 # TODO deprecated
 Indexer = Source
 
@@ -9,9 +9,12 @@ from pathlib import Path
 from types import ModuleType
 from typing import NamedTuple
 
-from .common import DbVisit, PathIsh, Res, Source, default_cache_dir, default_output_dir
+from .cannon import DEFAULT_CACHE_SIZE
+from .common import DbVisit, Filter, PathIsh, Res, Source, default_cache_dir, default_output_dir
 
 HookT = Callable[[Res[DbVisit]], Iterable[Res[DbVisit]]]
+# same as HOOK, but receives chunks of visits, so it can process them in bulk
+BatchHookT = Callable[[list[Res[DbVisit]]], Iterable[Res[DbVisit]]]
 
 
 ModuleName = str
@@ -28,10 +31,36 @@ class Config(NamedTuple):
     OUTPUT_DIR: PathIsh | None = None
 
     CACHE_DIR: PathIsh | None = ''
-    FILTERS: list[str] = []  # noqa: RUF012
+    # regexes, or predicates (e.g. DomainFilter)
+    FILTERS: list[str | Filter] = []  # noqa: RUF012
 
     HOOK: HookT | None = None
 
+    # applied after HOOK (if both are set)
+    BATCH_HOOK: BatchHookT | None = None
+
+    # max number of urls kept in memory by the canonify cache, 0 disables caching
+    CANONIFY_CACHE_SIZE: int = DEFAULT_CACHE_SIZE
+
+    # keep canonified urls in a database in CACHE_DIR, so reindexing mostly doesn't need to canonify again
+    PERSISTENT_CANONIFY_CACHE: bool = False
+
+    # number of sources extracted at once (each in its own process), 1 means sequential, 0 means number of CPUs
+    CONCURRENT_SOURCES: int = 1
+
+    # max bytes used for detecting duplicate visits within a source, beyond that it spills to disk. None means no limit
+    DEDUP_MEMORY_BUDGET: int | None = None
+
+    # keep repeated strings (sources/locators/contexts) in lookup tables, see database/normalized.py
+    # None means keep the schema of the existing database
+    NORMALIZED_DB: bool | None = None
+
+    # split sources between several database files, see database/shards.py
+    SHARDED_DB: bool = False
+
+    # compress large contexts with zstd, see database/compression.py
+    COMPRESS_CONTEXT: bool = False
+
     #
     # NOTE: INDEXERS is deprecated, use SOURCES instead
     INDEXERS: list[ConfigSource] = []  # noqa: RUF012
@@ -93,12 +122,58 @@ class Config(NamedTuple):
     def db(self) -> Path:
         return self.output_dir / 'promnesia.sqlite'
 
+    @property
+    def index_report_path(self) -> Path:
+        # per source performance stats of the last 'promnesia index' run, see perf.py
+        return self.output_dir / 'promnesia-index-report.json'
+
     @property
     def hook(self) -> HookT | None:
         return self.HOOK
 
+    @property
+    def batch_hook(self) -> BatchHookT | None:
+        return self.BATCH_HOOK
+
+    @property
+    def canonify_cache_size(self) -> int:
+        return self.CANONIFY_CACHE_SIZE
+
+    @property
+    def concurrent_sources(self) -> int:
+        cs = self.CONCURRENT_SOURCES
+        return (os.cpu_count() or 1) if cs == 0 else cs
+
+    @property
+    def dedup_memory_budget(self) -> int | None:
+        return self.DEDUP_MEMORY_BUDGET
+
+    @property
+    def normalized_db(self) -> bool | None:
+        return self.NORMALIZED_DB
+
+    @property
+    def sharded_db(self) -> bool:
+        return self.SHARDED_DB
+
+    @property
+    def compress_context(self) -> bool:
+        return self.COMPRESS_CONTEXT
+
+    @property
+    def canonify_store_path(self) -> Path | None:
+        if not self.PERSISTENT_CANONIFY_CACHE:
+            return None
+        cache_dir = self.cache_dir
+        if cache_dir is None:
+            warnings.warn("PERSISTENT_CANONIFY_CACHE is set, but CACHE_DIR is disabled. Not using the persistent cache.")
+            return None
+        return cache_dir / 'canonify.sqlite'
+
 
 instance: Config | None = None
+# file the instance was loaded from (if any), so worker processes can load the same config
+instance_path: Path | None = None
 
 
 def has() -> bool:
@@ -111,14 +186,16 @@ def get() -> Config:
 
 
 def load_from(config_file: Path) -> None:
-    global instance
+    global instance, instance_path
     instance = import_config(config_file)
+    instance_path = Path(config_file)
 
 
 def reset() -> None:
-    global instance
+    global instance, instance_path
     assert instance is not None
     instance = None
+    instance_path = None
 
 
 def import_config(config_file: PathIsh) -> Config:
@@ -145,7 +222,7 @@ def import_config(config_file: PathIsh) -> Config:
 def use_cores() -> int | None:
     '''
     Somewhat experimental.
-    For now only used in sources.auto, perhaps later will be shared among the other indexers.
+    Used in sources.auto (to process files in parallel) and in extract (to canonify visits in parallel).
     '''
     # most likely needs to be some sort of pipeline thing?
     cs = os.environ.get('PROMNESIA_CORES', None)
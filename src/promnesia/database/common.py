@@ -1,17 +1,24 @@
 from __future__ import annotations
 
-from collections.abc import Sequence
+from calendar import timegm
+from collections.abc import Callable, Sequence
 from datetime import datetime
+from hashlib import blake2b
 
 from sqlalchemy import (
     Column,
+    Float,
+    Index,
     Integer,
+    LargeBinary,
     String,
+    Table,
 )
 
 # TODO maybe later move DbVisit here completely?
 # kinda an issue that it's technically an "api" because hook in config can patch up DbVisit
 from ..common import DbVisit, Loc
+from . import compression
 
 
 def get_columns() -> Sequence[Column]:
@@ -23,20 +30,71 @@ def get_columns() -> Sequence[Column]:
         Column('locator_title', String()),
         Column('locator_href' , String()),
         Column('src'          , String()),
-        Column('context'      , String()),
-        Column('duration'     , Integer())
+        Column('context'      , String()),  # might be a blob if it's compressed, see compression.py
+        Column('duration'     , Integer()),
+        # derived from dt: seconds since unix epoch (UTC), for time range queries
+        # naive datetimes are treated as UTC, same as sqlite's strftime('%s') would
+        Column('epoch'        , Integer()),
+        # hash of all the other columns, used to only insert/delete changed visits when reindexing (see dump)
+        # might be NULL for visits indexed by older versions
+        Column('row_hash'     , Integer()),
     ]
     # fmt: on
-    assert len(res) == len(DbVisit._fields) + 1  # +1 because Locator is 'flattened'
+    assert len(res) == len(DbVisit._fields) + 3  # +1 because Locator is 'flattened', +1 for epoch, +1 for row_hash
     return res
 
 
-def db_visit_to_row(v: DbVisit) -> tuple:
+def get_indexes(table: Table) -> Sequence[Index]:
+    # NOTE: these are created by the server if missing (see load.get_db_stuff), and rebuilt after bulk loading (see dump)
+    res = [Index('index_norm_url', table.c.norm_url)]
+    # the columns might be missing if the server is using a database created by an older version (see migrations)
+    if 'epoch' in table.c:
+        res.append(Index('index_epoch', table.c.epoch))
+    if 'row_hash' in table.c:
+        res.append(Index('index_src_hash', table.c.src, table.c.row_hash))
+    return res
+
+
+def get_source_inputs_columns() -> Sequence[Column]:
+    # fingerprints of the sources' inputs as of the last time they were indexed (see Source.fingerprint)
+    # fmt: off
+    return [
+        Column('src'        , String(), primary_key=True),
+        Column('fingerprint', String()),
+        Column('indexed_at' , String()),
+    ]
+    # fmt: on
+
+
+def get_source_stats_columns() -> Sequence[Column]:
+    # number of visits per source, maintained while indexing (see dump), so it doesn't need a full scan of visits
+    # NOTE: src isn't a primary key since it might be NULL
+    # fmt: off
+    return [
+        Column('src'       , String()),
+        Column('visits'    , Integer()),
+        Column('indexed_at', String()),  # last time the source was indexed
+        Column('seconds'   , Float()),  # how long it took (see perf.py)
+    ]
+    # fmt: on
+
+
+def get_context_dicts_columns() -> Sequence[Column]:
+    # zstd dictionaries for compressed contexts, see compression.py
+    # fmt: off
+    return [
+        Column('id'  , Integer(), primary_key=True),  # same as the dict id in zstd frames
+        Column('data', LargeBinary()),
+    ]
+    # fmt: on
+
+
+def db_visit_to_row(v: DbVisit, *, compress: Callable[[str | None], str | bytes | None] | None = None) -> tuple:
     # ugh, very hacky...
     # we want to make sure the resulting tuple only consists of simple types
     # so we can use dbengine directly
     dt_s = v.dt.isoformat()
-    row = (
+    row: tuple = (
         v.norm_url,
         v.orig_url,
         dt_s,
@@ -45,14 +103,28 @@ def db_visit_to_row(v: DbVisit) -> tuple:
         v.src,
         v.context,
         v.duration,
+        timegm(v.dt.utctimetuple()),
     )
-    return row
+    # NOTE: hash is of the uncompressed context, so enabling compression doesn't make all visits 'changed'
+    rhash = row_hash(row)
+    if compress is not None:
+        row = (*row[:6], compress(v.context), *row[7:])
+    return (*row, rhash)
+
+
+def row_hash(row: tuple) -> int:
+    # signed, so it fits in sqlite INTEGER
+    digest = blake2b(repr(row).encode('utf8', errors='surrogatepass'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little', signed=True)
 
 
 def row_to_db_visit(row: Sequence) -> DbVisit:
-    (norm_url, orig_url, dt_s, locator_title, locator_href, src, context, duration) = row
+    # NOTE: epoch/row_hash might be missing for databases created by older versions (see migrations)
+    (norm_url, orig_url, dt_s, locator_title, locator_href, src, context, duration) = row[:8]
     dt_s = dt_s.split()[0]  # backwards compatibility: previously it could be a string separated with tz name
     dt = datetime.fromisoformat(dt_s)
+    if isinstance(context, bytes):
+        context = compression.decompress(context)
     return DbVisit(
         norm_url=norm_url,
         orig_url=orig_url,
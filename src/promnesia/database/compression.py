@@ -0,0 +1,138 @@
+'''
+Optional compression of large contexts (see COMPRESS_CONTEXT in the config).
+
+Contexts are by far the largest column (rendered markdown/html blocks, org-mode node bodies, chat messages),
+and they are very repetitive between visits, so they compress well with a zstd dictionary trained on them.
+Contexts shorter than THRESHOLD are kept as plain text, longer ones are stored as blobs (zstd frames) in the same column,
+so row_to_db_visit can tell them apart by type, and the dictionary is picked by the id in the frame header.
+
+Dictionaries are kept in the 'context_dicts' table (of each shard, if the database is sharded),
+and loaded into DICTS when the database is opened (see load.get_db_stuff).
+
+NOTE: LIKE doesn't work on compressed contexts, so search decompresses them on the fly (see searchable_context).
+Proper full text search would need a separate index.
+'''
+
+from __future__ import annotations
+
+from collections.abc import Iterable
+from typing import TYPE_CHECKING
+
+from sqlalchemy import ColumnElement, Connection, String, case, exc, func
+
+from ..common import get_logger
+
+if TYPE_CHECKING:
+    import zstandard  # type: ignore[import-not-found,unused-ignore]  # ty: ignore[unresolved-import,unused-ignore-comment]
+
+# contexts shorter than that (in characters) aren't worth it: zstd frame overhead would eat most of the savings
+THRESHOLD = 256
+_LEVEL = 3  # zstd default, higher levels are much slower to index and barely smaller with a dictionary
+_DICT_SIZE = 64 * 1024
+_TRAIN_SAMPLES = 2000
+
+# dict id -> dictionary, for all databases opened by this process (ids are random, so shouldn't clash)
+DICTS: dict[int, zstandard.ZstdCompressionDict] = {}
+
+_FUNC = 'promnesia_context'
+
+
+def _zstd():
+    try:
+        import zstandard  # type: ignore[import-not-found,unused-ignore]  # ty: ignore[unresolved-import,unused-ignore-comment]
+    except ModuleNotFoundError as e:
+        if e.name == 'zstandard':
+            raise RuntimeError(
+                "Compressed contexts need 'zstandard' package (pip3 install --user zstandard). See COMPRESS_CONTEXT in the config."
+            ) from e
+        raise e
+    return zstandard
+
+
+def register_dicts(rows: Iterable[tuple[int, bytes]]) -> None:
+    for dict_id, data in rows:
+        if dict_id not in DICTS:
+            DICTS[dict_id] = _zstd().ZstdCompressionDict(data)
+
+
+def load_dicts(conn: Connection) -> None:
+    try:
+        rows = conn.exec_driver_sql('SELECT id, data FROM context_dicts').all()
+    except exc.OperationalError as e:
+        if 'no such table' in str(e):
+            # database created by an older version
+            return
+        raise e
+    register_dicts(rows)
+
+
+def decompress(data: bytes) -> str:
+    zstd = _zstd()
+    dict_id = zstd.get_frame_parameters(data).dict_id
+    if dict_id == 0:
+        dctx = zstd.ZstdDecompressor()
+    else:
+        zdict = DICTS.get(dict_id)
+        if zdict is None:
+            raise RuntimeError(f"Context dictionary {dict_id} isn't loaded, database might be corrupted")
+        dctx = zstd.ZstdDecompressor(dict_data=zdict)
+    return dctx.decompress(data).decode('utf8')
+
+
+def _context(value: str | bytes | None) -> str | None:
+    return decompress(value) if isinstance(value, bytes) else value
+
+
+def register_functions(dbapi_con, con_record) -> None:
+    '''
+    Should be called on connect (as an sqlalchemy event listener) for the connections which use searchable_context
+    '''
+    dbapi_con.create_function(_FUNC, 1, _context, deterministic=True)
+
+
+def searchable_context(column: ColumnElement) -> ColumnElement:
+    # typeof check in sql, so plain text contexts don't go through python at all
+    return case((func.typeof(column) == 'blob', getattr(func, _FUNC)(column, type_=String())), else_=column)
+
+
+class ContextCompressor:
+    '''
+    Compresses contexts longer than THRESHOLD while indexing.
+    Uses the dictionary already in the database if there is one, otherwise trains a new one on the first contexts
+    (until then they are compressed without a dictionary).
+    '''
+
+    def __init__(self, dicts: Iterable[tuple[int, bytes]]) -> None:
+        self.zstd = _zstd()
+        dicts = list(dicts)
+        register_dicts(dicts)
+        self.zdict: zstandard.ZstdCompressionDict | None = None
+        self.samples: list[bytes] | None = []
+        if len(dicts) > 0:
+            [(dict_id, _), *_] = dicts
+            self.zdict = DICTS[dict_id]
+            self.samples = None
+        self.cctx = self.zstd.ZstdCompressor(level=_LEVEL, dict_data=self.zdict)
+
+    def compress(self, context: str | None) -> str | bytes | None:
+        if context is None or len(context) < THRESHOLD:
+            return context
+        data = context.encode('utf8')
+        if self.samples is not None:
+            self.samples.append(data)
+            if len(self.samples) >= _TRAIN_SAMPLES:
+                self._train()
+        return self.cctx.compress(data)
+
+    def _train(self) -> None:
+        assert self.samples is not None
+        samples, self.samples = self.samples, None
+        try:
+            zdict = self.zstd.train_dictionary(_DICT_SIZE, samples, level=_LEVEL)
+        except self.zstd.ZstdError as e:
+            # e.g. if the samples are too small/similar
+            get_logger().warning(f"couldn't train context dictionary, compressing without it: {e}")
+            return
+        DICTS[zdict.dict_id()] = zdict
+        self.zdict = zdict
+        self.cctx = self.zstd.ZstdCompressor(level=_LEVEL, dict_data=zdict)
@@ -1,18 +1,25 @@
 from __future__ import annotations
 
+import os
 import sqlite3
-from collections.abc import Iterable
+from collections import Counter
+from collections.abc import Callable, Collection, Iterable, Iterator, Mapping
+from contextlib import ExitStack
+from itertools import islice
 from pathlib import Path
+from queue import Full, Queue
+from tempfile import TemporaryDirectory
+from threading import Thread
+from timeit import default_timer as timer
+from typing import NamedTuple
 
-from more_itertools import chunked
 from sqlalchemy import (
+    Connection,
     Engine,
     MetaData,
     Table,
     create_engine,
     event,
-    exc,
-    func,
     select,
 )
 from sqlalchemy.dialects import sqlite as dialect_sqlite
@@ -26,13 +33,17 @@ from ..common import (
     get_logger,
     now_tz,
 )
-from .common import db_visit_to_row, get_columns
-
-# NOTE: I guess the main performance benefit from this is not creating too many tmp lists and avoiding overhead
-# since as far as sql is concerned it should all be in the same transaction. only a guess
-# not sure it's the proper way to handle it
-# see test_index_many
-_CHUNK_BY = 10
+from ..perf import perf
+from . import compression, migrations, shards
+from . import normalized as norm
+from .common import (
+    db_visit_to_row,
+    get_columns,
+    get_context_dicts_columns,
+    get_indexes,
+    get_source_inputs_columns,
+    get_source_stats_columns,
+)
 
 # I guess 1 hour is definitely enough
 _CONNECTION_TIMEOUT_SECONDS = 3600
@@ -50,14 +61,298 @@ def begin_immediate_transaction(conn):
     conn.exec_driver_sql('BEGIN IMMEDIATE')
 
 
+# staging database is thrown away if anything goes wrong, so doesn't need durability
+def staging_pragmas(dbapi_con, con_record) -> None:
+    dbapi_con.execute('PRAGMA journal_mode = OFF')
+    dbapi_con.execute('PRAGMA synchronous = OFF')
+
+
+# used for bulk loading. can't be changed within a transaction, so these are set on connection instead
+def relax_pragmas(dbapi_con, con_record) -> None:
+    # NOTE: journal mode has to stay WAL, so the database is readable while we're writing
+    # with WAL, NORMAL means no fsync on commit, it still can't corrupt the database
+    dbapi_con.execute('PRAGMA synchronous = NORMAL')
+    # more memory for building indexes in the end
+    dbapi_con.execute(f'PRAGMA cache_size = -{_BULK_CACHE_KB}')
+
+
 Stats = dict[SourceName | None, int]
 
+_SRC_COLUMN = [c.name for c in get_columns()].index('src')
+
+
+# visits are staged in batches starting from this size, and at most this many batches are waiting in the writer queue
+_WRITER_BATCH = 1000
+_WRITER_QUEUE = 16
+# batches grow up to this size (and are inserted in one go), so small runs still don't use much memory
+_MAX_BATCH = 16_000
+_BULK_CACHE_KB = 256 * 1024
+
+
+def _adaptive_chunks[T](it: Iterable[T], *, start: int, max_size: int) -> Iterator[list[T]]:
+    # chunk size doubles until it reaches max_size
+    size = start
+    it = iter(it)
+    while chunk := list(islice(it, size)):
+        yield chunk
+        size = min(size * 2, max_size)
+
+
+class _Batch(NamedTuple):
+    rows: list[tuple]
+    srcs: Mapping[SourceName, int]  # number of visits by source
+
+
+class _Aborted(Exception):
+    pass
+
+
+def _write_in_thread(write: Callable[[Iterable[_Batch]], None], batches: Iterable[_Batch]) -> None:
+    '''
+    Runs write() in a dedicated thread, feeding it batches through a bounded queue.
+    sqlite releases GIL while it's working, so with multiple CPUs this overlaps extraction with inserts.
+    If producing batches fails, write() gets an exception from its iterator, so its transaction is rolled back.
+    '''
+    queue: Queue[_Batch | BaseException | None] = Queue(maxsize=_WRITER_QUEUE)
+    errors: list[BaseException] = []
+
+    def consume() -> Iterator[_Batch]:
+        while (item := queue.get()) is not None:
+            if isinstance(item, BaseException):
+                raise _Aborted from item
+            yield item
+
+    def target() -> None:
+        try:
+            write(consume())
+        except BaseException as e:
+            errors.append(e)
+
+    writer = Thread(target=target, name='promnesia-db-writer', daemon=True)
+    writer.start()
+
+    def put(item: _Batch | BaseException | None) -> None:
+        while writer.is_alive():
+            try:
+                queue.put(item, timeout=1)
+            except Full:
+                continue
+            return
+        # otherwise the writer crashed, its error is reraised below
+
+    try:
+        for batch in batches:
+            put(batch)
+            if not writer.is_alive():
+                break
+    except BaseException as e:
+        put(e)
+        writer.join()
+        raise
+    put(None)
+    writer.join()
+    if len(errors) > 0:
+        raise errors[0]
+
+
+def _query_db(db_path: Path, query: str) -> list[tuple]:
+    # read only, and empty if the table doesn't exist
+    if not db_path.exists():
+        return []
+    conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+    try:
+        return conn.execute(query).fetchall()
+    except sqlite3.OperationalError as e:
+        if 'no such table' in str(e):
+            # database created by an older version
+            return []
+        raise e
+    finally:
+        conn.close()
+
+
+def _shard_paths(db_path: Path) -> list[Path] | None:
+    if len(_query_db(db_path, "SELECT 1 FROM sqlite_master WHERE name = 'shards'")) == 0:
+        return None
+    return [db_path.parent / path for (path,) in _query_db(db_path, 'SELECT path FROM shards')]
+
+
+def get_source_fingerprints(db_path: Path) -> dict[SourceName, str]:
+    '''
+    Input fingerprints of the sources recorded in the database during previous runs
+    '''
+    paths = _shard_paths(db_path) or [db_path]
+    res: dict[SourceName, str] = {}
+    for path in paths:
+        res.update(_query_db(path, 'SELECT src, fingerprint FROM source_inputs'))
+    return res
+
+
+def _read_context_dicts(db_path: Path) -> list[tuple[int, bytes]]:
+    paths = _shard_paths(db_path) or [db_path]
+    return [row for path in paths for row in _query_db(path, 'SELECT id, data FROM context_dicts')]
+
+
+def _read_stats(paths: Iterable[Path]) -> Stats:
+    res: Stats = {}
+    for path in paths:
+        res.update(_query_db(path, 'SELECT src, visits FROM source_stats'))
+    return res
+
+
+def _main_engine(db_path: Path) -> Engine:
+    engine = create_engine(f'sqlite:///{db_path}', connect_args={'timeout': _CONNECTION_TIMEOUT_SECONDS})
+    event.listen(engine, 'connect', enable_wal)
+    event.listen(engine, 'begin', begin_immediate_transaction)
+    return engine
+
+
+def _drop_visits(conn: Connection) -> None:
+    schema = norm.get_schema(conn)
+    if schema == 'normalized':
+        norm.drop(conn)
+    elif schema == 'flat':
+        conn.exec_driver_sql('DROP TABLE visits')
+    conn.exec_driver_sql('DROP TABLE IF EXISTS source_inputs')
+    conn.exec_driver_sql('DROP TABLE IF EXISTS source_stats')
+
+
+def _remove_shard_files(paths: Iterable[Path]) -> None:
+    for path in paths:
+        for p in [path, path.with_name(path.name + '-wal'), path.with_name(path.name + '-shm')]:
+            p.unlink(missing_ok=True)
+
+
+def _unshard(db_path: Path, *, overwrite_db: bool) -> None:
+    # converts sharded database back to a single file, only possible when overwriting
+    paths = _shard_paths(db_path)
+    if paths is None:
+        return
+    if not overwrite_db:
+        raise RuntimeError(f'Database "{db_path}" is sharded. Either set SHARDED_DB, or run with --overwrite to convert it.')
+    engine = _main_engine(db_path)
+    with engine.begin() as conn:
+        conn.exec_driver_sql('DROP TABLE shards')
+    engine.dispose()
+    _remove_shard_files(paths)
+
+
+def _merge_shards(
+    db_path: Path,
+    staging_paths: Mapping[str, Path],
+    *,
+    merge: Callable[[str, Path], tuple[Stats, Stats]],
+    overwrite_db: bool,
+    keep_srcs: Collection[SourceName],
+    empty_staging: Path | None,
+) -> tuple[Stats, Stats]:
+    '''
+    Merges each staging database into its shard (staging_paths are by shard path), and registers the shards in the main database.
+    When overwriting, the shards which have nothing staged are merged with empty_staging, so the sources which aren't kept are deleted.
+    Returns database stats before/after (over all shards).
+    '''
+    engine = _main_engine(db_path)
+    with engine.begin() as conn:
+        if norm.get_schema(conn) is not None:
+            if not overwrite_db:
+                raise RuntimeError(f'Database "{db_path}" is not sharded. Run with --overwrite to convert it.')
+            _drop_visits(conn)
+        shards.create_table(conn)
+        old = shards.get_shards(conn) or []
+    stats = {path: _read_stats([db_path.parent / path]) for path in old}
+    stats_before = {src: count for st in stats.values() for src, count in st.items()}
+
+    targets = dict(staging_paths)
+    if overwrite_db:
+        assert empty_staging is not None
+        for path, st in stats.items():
+            # NOTE: visits without src are never kept when overwriting
+            if path not in targets and any(src is None or src not in keep_srcs for src in st):
+                targets[path] = empty_staging
+    # check before writing anything, otherwise the server wouldn't be able to attach them
+    shards.check_limit({*old, *targets})
+
+    for path, staging_path in sorted(targets.items()):
+        (db_path.parent / path).parent.mkdir(exist_ok=True)
+        _, stats[path] = merge(path, staging_path)
+
+    # NOTE: re-reading, since other indexers might have added their shards in the meantime
+    with engine.begin() as conn:
+        current = {*(shards.get_shards(conn) or []), *targets}
+        shards.set_shards(conn, current)
+    engine.dispose()
+    stats_after = {src: count for st in stats.values() for src, count in st.items()}
+    return stats_before, stats_after
+
+
+def _delete_changed(conn, *, schema: norm.Schema) -> str:
+    '''
+    Incremental mode: visits of the reindexed sources are diffed with the ones already in the database by row_hash.
+    Deletes the visits which aren't in the staging database anymore, and returns a query for the staged visits to insert.
+    Hashes are compared along with their counts, so exact duplicate visits are handled as well.
+    '''
+    for name in ['staged_counts', 'db_counts', 'changed']:
+        conn.exec_driver_sql(f'DROP TABLE IF EXISTS temp.{name}')
+    conn.exec_driver_sql('CREATE TEMP TABLE staged_counts (src, row_hash, n, PRIMARY KEY (src, row_hash))')
+    conn.exec_driver_sql('CREATE TEMP TABLE db_counts     (src, row_hash, n, PRIMARY KEY (src, row_hash))')
+    conn.exec_driver_sql('CREATE TEMP TABLE changed       (src, row_hash,    PRIMARY KEY (src, row_hash))')
+    conn.exec_driver_sql('''
+    INSERT INTO temp.staged_counts SELECT src, row_hash, COUNT(*) FROM staging.visits GROUP BY src, row_hash
+    ''')
+    # NOTE: normalized 'visits' view can't be searched by src (it's a left join), so it would be a full scan
+    visits = 'main.visit_srcs JOIN main.visit_rows ON src_id = id' if schema == 'normalized' else 'main.visits'
+    conn.exec_driver_sql(f'''
+    INSERT INTO temp.db_counts SELECT src, row_hash, COUNT(*) FROM {visits}
+    WHERE src IN (SELECT src FROM temp.staged_counts) GROUP BY src, row_hash
+    ''')
+    # NOTE: visits with NULL row_hash (indexed by older versions) are always replaced
+    conn.exec_driver_sql('''
+    INSERT INTO temp.changed
+    SELECT s.src, s.row_hash FROM temp.staged_counts s
+    LEFT JOIN temp.db_counts d ON d.src = s.src AND d.row_hash = s.row_hash
+    WHERE d.n IS NOT s.n
+    UNION
+    SELECT d.src, d.row_hash FROM temp.db_counts d
+    LEFT JOIN temp.staged_counts s ON s.src = d.src AND s.row_hash = d.row_hash
+    WHERE s.n IS NULL AND d.row_hash IS NOT NULL
+    ''')
+    if schema == 'normalized':
+        deleted = norm.delete_changed(conn, srcs='SELECT src FROM temp.staged_counts', changed='temp.changed')
+    else:
+        deleted = conn.exec_driver_sql('''
+        DELETE FROM main.visits
+        WHERE src IN (SELECT src FROM temp.staged_counts)
+          AND (row_hash IS NULL OR (src, row_hash) IN (SELECT src, row_hash FROM temp.changed))
+        ''').rowcount
+    get_logger().info(f'incremental: deleted {deleted} visits')
+    # NOTE: visits without src are never deleted (same as in non-incremental mode), so they are always inserted
+    return '(SELECT * FROM staging.visits WHERE src IS NULL OR (src, row_hash) IN (SELECT src, row_hash FROM temp.changed))'
+
 
 # returns critical warnings
 def visits_to_sqlite(
     vit: Iterable[Res[DbVisit]],
     *,
     overwrite_db: bool,
+    # sources skipped during this run since their inputs didn't change -- their visits are kept even when overwriting
+    keep_srcs: Collection[SourceName] = (),
+    # input fingerprints to record for the reindexed sources, only called after vit is exhausted
+    # (so the caller can leave out sources which had errors, and they are retried next time)
+    fingerprints: Callable[[], Mapping[SourceName, str]] | None = None,
+    # insert in a separate thread, so it overlaps with extraction. None means only if there are multiple CPUs
+    writer_thread: bool | None = None,
+    # bulk loading: indexes are dropped and rebuilt in the end, relaxed pragmas, bigger batches. None means only when overwriting
+    bulk: bool | None = None,
+    # only delete/insert visits which changed since the last run (by row_hash), rather than all visits of the reindexed sources
+    # the end result is the same, but much less is written if most visits are the same. None means unless in bulk mode
+    incremental: bool | None = None,
+    # use normalized schema (see database/normalized.py), the existing database is migrated if necessary
+    # None means keep the schema of the existing database (plain for new databases)
+    normalized: bool | None = None,
+    # split sources between several database files (see database/shards.py)
+    sharded: bool = False,
+    # compress large contexts with a zstd dictionary (see database/compression.py)
+    compress_context: bool = False,
     _db_path: Path | None = None,  # only used in tests
 ) -> list[Exception]:
     if _db_path is None:
@@ -92,10 +387,35 @@ def visits_to_sqlite(
 
     meta = MetaData()
     table = Table('visits', meta, *get_columns())
-
-    def query_total_stats(conn) -> Stats:
-        query = select(table.c.src, func.count(table.c.src)).select_from(table).group_by(table.c.src)
-        return dict(conn.execute(query).all())
+    inputs_table = Table('source_inputs', meta, *get_source_inputs_columns())
+    stats_table = Table('source_stats', meta, *get_source_stats_columns())
+    dicts_table = Table('context_dicts', meta, *get_context_dicts_columns())
+    staging_table = Table('visits', MetaData(), *get_columns(), schema='staging')
+
+    def update_source_stats(
+        conn,
+        source_stats: dict[SourceName | None, dict],
+        *,
+        index_stats: Stats,
+    ) -> dict[SourceName | None, dict]:
+        # after merging, visits of each reindexed source are exactly the staged ones, so no need to count them in the database
+        # this keeps the stats in sync without scanning the whole table
+        source_stats = {src: r for src, r in source_stats.items() if not overwrite_db or src in keep_srcs}
+        for src, count in index_stats.items():
+            if src is None:
+                # when updating, visits without src are never deleted, so just accumulate
+                count += source_stats.get(None, {}).get('visits', 0)
+            st = None if src is None else perf.sources.get(src)
+            source_stats[src] = {
+                'src': src,
+                'visits': count,
+                'indexed_at': now.isoformat(),
+                'seconds': None if st is None else round(st.total_seconds, 3),
+            }
+        conn.execute(stats_table.delete())
+        if len(source_stats) > 0:
+            conn.execute(stats_table.insert(), list(source_stats.values()))
+        return source_stats
 
     def get_engine(*args, **kwargs) -> Engine:
         # kwargs['echo'] = True  # useful for debugging
@@ -103,59 +423,230 @@ def visits_to_sqlite(
         event.listen(e, 'connect', enable_wal)
         return e
 
-    ### use readonly database just to get stats
-    pengine = get_engine('sqlite://', creator=lambda: sqlite3.connect(f"file:{db_path}?mode=ro", uri=True))
-    stats_before: Stats
-    try:
-        with pengine.begin() as conn:
-            stats_before = query_total_stats(conn)
-    except exc.OperationalError as oe:
-        if oe.code == 'e3q8':
-            # db doesn't exist yet
-            stats_before = {}
-        else:
-            raise oe
-    pengine.dispose()
-    ###
-
-    # needtimeout, othewise concurrent indexing might not work
-    # (note that this also requires WAL mode)
-    engine = get_engine(f'sqlite:///{db_path}', connect_args={'timeout': _CONNECTION_TIMEOUT_SECONDS})
-
-    cleared: set[str] = set()
-
-    # by default, sqlalchemy does some sort of BEGIN (implicit) transaction, which doesn't provide proper isolation??
-    # see https://docs.sqlalchemy.org/en/20/dialects/sqlite.html#serializable-isolation-savepoints-transactional-ddl
-    event.listen(engine, 'begin', begin_immediate_transaction)
-    # TODO to allow more concurrent indexing, maybe could instead write to a temporary table?
-    # or collect visits first and only then start writing to the db to minimize db access window.. not sure
-
-    # engine.begin() starts a transaction
-    # so everything inside this block will be atomic to the outside observers
-    with engine.begin() as conn:
-        table.create(conn, checkfirst=True)
-
-        if overwrite_db:
-            conn.execute(table.delete())
-
-        insert_stmt = table.insert()
-        # using raw statement gives a massive speedup for inserting visits
-        # see test_benchmark_visits_dumping
-        insert_stmt_raw = str(insert_stmt.compile(dialect=dialect_sqlite.dialect(paramstyle='qmark')))
-
-        for chunk in chunked(vit_ok(), n=_CHUNK_BY):
-            srcs = {v.src or '' for v in chunk}
-            new = srcs.difference(cleared)
-
-            for src in new:
-                conn.execute(table.delete().where(table.c.src == src))
-                cleared.add(src)
+    if bulk is None:
+        bulk = overwrite_db
+    if incremental is None:
+        incremental = not bulk
+    assert not (bulk and incremental), "bulk mode rebuilds indexes from scratch, so can't be incremental"
+
+    compressor: compression.ContextCompressor | None = None
+    if compress_context:
+        compressor = compression.ContextCompressor(_read_context_dicts(db_path))
+    compress = None if compressor is None else compressor.compress
+
+    # seconds spent inserting, by source (merged into perf stats in the end, to avoid touching them from both threads)
+    sqlite_seconds: dict[SourceName, float] = {}
+
+    def batches() -> Iterator[_Batch]:
+        for chunk in _adaptive_chunks(vit_ok(), start=_WRITER_BATCH, max_size=_MAX_BATCH):
+            srcs = Counter(v.src or '' for v in chunk)
+            yield _Batch(rows=[db_visit_to_row(v, compress=compress) for v in chunk], srcs=srcs)
+
+    def merge(db_path: Path, staging_path: Path, *, index_stats: Stats, fps: Mapping[SourceName, str]) -> tuple[Stats, Stats]:
+        # needtimeout, othewise concurrent indexing might not work
+        # (note that this also requires WAL mode)
+        engine = get_engine(f'sqlite:///{db_path}', connect_args={'timeout': _CONNECTION_TIMEOUT_SECONDS})
+
+        def attach_staging(dbapi_con, con_record) -> None:
+            # can't attach within a transaction, so has to be done on connection
+            dbapi_con.execute('ATTACH DATABASE ? AS staging', (str(staging_path),))
+
+        event.listen(engine, 'connect', attach_staging)
+        event.listen(engine, 'connect', norm.register_functions)
+        # by default, sqlalchemy does some sort of BEGIN (implicit) transaction, which doesn't provide proper isolation??
+        # see https://docs.sqlalchemy.org/en/20/dialects/sqlite.html#serializable-isolation-savepoints-transactional-ddl
+        event.listen(engine, 'begin', begin_immediate_transaction)
+        if bulk:
+            event.listen(engine, 'connect', relax_pragmas)
+
+        # engine.begin() starts a transaction
+        # so everything inside this block will be atomic to the outside observers
+        with engine.begin() as conn:
+            migrations.migrate(conn)
+            schema = norm.get_schema(conn)
+            if schema is None:
+                schema = 'normalized' if normalized else 'flat'
+                if schema == 'normalized':
+                    norm.create(conn)
+            elif normalized is not None:
+                wanted: norm.Schema = 'normalized' if normalized else 'flat'
+                if wanted != schema:
+                    start = timer()
+                    norm.migrate(conn, to=wanted)
+                    logger.info(f'database "{db_path}" : migrated from {schema} to {wanted} schema in {timer() - start:.1f}s')
+                    schema = wanted
+            table.create(conn, checkfirst=True)
+            inputs_table.create(conn, checkfirst=True)
+            stats_table.create(conn, checkfirst=True)
+            dicts_table.create(conn, checkfirst=True)
+            source_stats = {r.src: r._asdict() for r in conn.execute(select(stats_table))}
+            stats_before = {src: r['visits'] for src, r in source_stats.items()}
+
+            if overwrite_db:
+                keep = list(keep_srcs)
+                if incremental:
+                    # reindexed sources are diffed below
+                    keep.extend(src for (src,) in conn.execute(select(staging_table.c.src).distinct()) if src is not None)
+                if schema == 'normalized':
+                    norm.delete_visits(conn, srcs=keep, keep=True)
+                else:
+                    # NOTE: explicit NULL check, otherwise visits without src are only deleted if keep is empty
+                    conn.execute(table.delete().where(table.c.src.is_(None) | table.c.src.not_in(keep)))
+                conn.execute(inputs_table.delete().where(inputs_table.c.src.not_in(keep_srcs)))
+
+            staged_query = 'staging.visits'
+            if incremental:
+                staged_query = _delete_changed(conn, schema=schema)
+            elif overwrite_db:
+                pass  # already deleted everything above
+            elif schema == 'normalized':
+                norm.delete_visits(conn, srcs='SELECT DISTINCT src FROM staging.visits', keep=False)
+            else:
+                # visits of the reindexed sources are replaced
+                conn.execute(table.delete().where(table.c.src.in_(select(staging_table.c.src).distinct())))
+
+            # NOTE: separate table, since get_indexes attaches them to it (and merge runs for each shard)
+            indexes = get_indexes(Table('visits', MetaData(), *get_columns()))
+            if bulk:
+                # maintaining indexes while inserting is much slower than building them from scratch in the end
+                # (this happens within the transaction too, so readers still see old indexes until it's committed)
+                if schema == 'normalized':
+                    norm.drop_indexes(conn)
+                else:
+                    for idx in indexes:
+                        conn.exec_driver_sql(f'DROP INDEX IF EXISTS {idx.name}')
+
+            if schema == 'normalized':
+                inserted = norm.insert_visits(conn, staged_query)
+            else:
+                columns = ', '.join(table.c.keys())
+                inserted = conn.exec_driver_sql(
+                    f'INSERT INTO main.visits ({columns}) SELECT {columns} FROM {staged_query} t'
+                ).rowcount
+            if incremental:
+                logger.info(f'incremental: inserted {inserted} visits')
+
+            start = timer()
+            if schema == 'normalized':
+                norm.create_indexes(conn)
+            else:
+                # (if not bulk loading, only creates them for new databases)
+                for idx in indexes:
+                    idx.create(conn, checkfirst=True)
+            if bulk:
+                logger.info(f'bulk: rebuilt indexes in {timer() - start:.1f}s')
+
+            if len(fps) > 0:
+                conn.execute(inputs_table.delete().where(inputs_table.c.src.in_(fps.keys())))
+                conn.execute(
+                    inputs_table.insert(),
+                    [{'src': src, 'fingerprint': fp, 'indexed_at': now.isoformat()} for src, fp in fps.items()],
+                )
 
-            bound = [db_visit_to_row(v) for v in chunk]
-            conn.exec_driver_sql(insert_stmt_raw, bound)
+            if compressor is not None and compressor.zdict is not None:
+                # might be already there if it was reused
+                zdict = compressor.zdict
+                conn.execute(dicts_table.insert().prefix_with('OR IGNORE'), {'id': zdict.dict_id(), 'data': zdict.as_bytes()})
+
+            source_stats = update_source_stats(conn, source_stats, index_stats=index_stats)
+            stats_after = {src: r['visits'] for src, r in source_stats.items()}
+        engine.dispose()
+        return stats_before, stats_after
+
+    # visits are written in a separate staging database first, so the main database isn't locked while we're extracting
+    # in the end they are merged in the main database in a single (short) transaction
+    with TemporaryDirectory(dir=db_path.parent, prefix='.promnesia-staging-') as staging_dir:
+        # if the database is sharded, visits are staged separately for each shard (by shard path)
+        staging_paths: dict[str | None, Path] = {}
+        shard_of: dict[SourceName | None, str] = {}  # cache, since it's computed for every visit
+
+        def write(batches: Iterable[_Batch]) -> None:
+            with ExitStack() as stack:
+                conns: dict[str | None, Connection] = {}
+
+                def staging_conn(key: str | None) -> Connection:
+                    conn = conns.get(key)
+                    if conn is None:
+                        path = Path(staging_dir) / f'staging{len(conns)}.sqlite'
+                        # (check_same_thread is fine to disable since the connection is only used by one thread at a time, see _write_in_thread)
+                        staging = create_engine(f'sqlite:///{path}', connect_args={'check_same_thread': False})
+                        event.listen(staging, 'connect', staging_pragmas)
+                        stack.callback(staging.dispose)
+                        conn = stack.enter_context(staging.begin())
+                        table.create(conn)
+                        conns[key] = conn
+                        staging_paths[key] = path
+                    return conn
+
+                if not sharded:
+                    staging_conn(None)  # merged even if there are no visits
+                insert_stmt = table.insert()
+                # using raw statement gives a massive speedup for inserting visits
+                # see test_benchmark_visits_dumping
+                insert_stmt_raw = str(insert_stmt.compile(dialect=dialect_sqlite.dialect(paramstyle='qmark')))
+                for batch in batches:
+                    start = timer()
+                    if sharded:
+                        by_shard: dict[str, list[tuple]] = {}
+                        for row in batch.rows:
+                            src = row[_SRC_COLUMN]
+                            shard = shard_of.get(src)
+                            if shard is None:
+                                shard = shard_of[src] = shards.shard_relpath(db_path, src)
+                            by_shard.setdefault(shard, []).append(row)
+                        for key, rows in by_shard.items():
+                            staging_conn(key).exec_driver_sql(insert_stmt_raw, rows)
+                    else:
+                        staging_conn(None).exec_driver_sql(insert_stmt_raw, batch.rows)
+                    # batch might span several sources, just split the time evenly between visits
+                    per_visit = (timer() - start) / len(batch.rows)
+                    for src, count in batch.srcs.items():
+                        sqlite_seconds[src] = sqlite_seconds.get(src, 0.0) + per_visit * count
+
+        if writer_thread is None:
+            writer_thread = (os.cpu_count() or 1) > 1
+        if writer_thread:
+            _write_in_thread(write, batches())
+        else:
+            write(batches())
+
+        fps = {} if fingerprints is None else dict(fingerprints())
+
+        merge_start = timer()
+        if sharded:
+            empty_staging: Path | None = None
+            if overwrite_db:
+                empty_staging = Path(staging_dir) / 'empty.sqlite'
+                staging = create_engine(f'sqlite:///{empty_staging}')
+                table.create(staging)
+                staging.dispose()
+
+            def in_shard(src: SourceName | None, path: str) -> bool:
+                return shards.shard_relpath(db_path, src) == path
+
+            stats_before, stats_after = _merge_shards(
+                db_path,
+                {path: staging_path for path, staging_path in staging_paths.items() if path is not None},
+                merge=lambda path, staging_path: merge(
+                    db_path.parent / path,
+                    staging_path,
+                    index_stats={src: count for src, count in index_stats.items() if in_shard(src, path)},
+                    fps={src: fp for src, fp in fps.items() if in_shard(src, path)},
+                ),
+                overwrite_db=overwrite_db,
+                keep_srcs=keep_srcs,
+                empty_staging=empty_staging,
+            )
+        else:
+            _unshard(db_path, overwrite_db=overwrite_db)
+            stats_before, stats_after = merge(db_path, staging_paths[None], index_stats=index_stats, fps=fps)
+        merge_seconds = timer() - merge_start
+        logger.info(f'database "{db_path}" : merged visits in {merge_seconds:.1f}s')
 
-        stats_after = query_total_stats(conn)
-    engine.dispose()
+    total = sum(index_stats.values())
+    for src, secs in sqlite_seconds.items():
+        # merge time is split between sources proportionally to the number of visits
+        perf.source(src).add('sqlite', secs + merge_seconds * index_stats.get(src, 0) / total)
 
     stats_changes = {}
     # map str just in case some srcs are None
@@ -181,7 +672,10 @@ def visits_to_sqlite(
         for k, v in stats_changes.items():
             logger.info(f'database stats changes: {k} {v}')
 
+    if len(keep_srcs) > 0:
+        logger.info(f'kept (inputs unchanged): {sorted(keep_srcs)}')
+
     res: list[Exception] = []
-    if total_ok == 0:
+    if total_ok == 0 and len(keep_srcs) == 0:
         res.append(RuntimeError('No visits were indexed, something is probably wrong!'))
     return res
@@ -4,14 +4,16 @@ from pathlib import Path
 
 from sqlalchemy import (
     Engine,
-    Index,
     MetaData,
     Table,
     create_engine,
+    event,
     exc,
 )
 
-from .common import DbVisit, get_columns, row_to_db_visit
+from ..common import get_logger
+from . import compression, migrations, normalized, shards
+from .common import DbVisit, get_columns, get_indexes, row_to_db_visit
 
 DbStuff = tuple[Engine, Table]
 
@@ -21,19 +23,46 @@ def get_db_stuff(db_path: Path) -> DbStuff:
     # todo how to open read only?
     # actually not sure if we can since we are creating an index here
     engine = create_engine(f'sqlite:///{db_path}')  # , echo=True)
+    # for searching in compressed contexts
+    event.listen(engine, 'connect', compression.register_functions)
 
     meta = MetaData()
     table = Table('visits', meta, *get_columns())
 
-    idx = Index('index_norm_url', table.c.norm_url)
-    try:
-        idx.create(bind=engine)
-    except exc.OperationalError as e:
-        if 'already exists' in str(e):
-            # meh, but no idea how to check it properly...
-            pass
-        else:
-            raise e
+    with engine.begin() as conn:
+        db_shards = shards.get_shards(conn)
+    if db_shards is not None:
+        # shards are indexed/migrated by the indexer, so only need to attach them
+        # (dispose, so the pooled connection which was opened before the listener isn't reused)
+        engine.dispose()
+        event.listen(engine, 'connect', lambda dbapi_con, _: shards.attach(dbapi_con, db_path, db_shards))
+        with engine.connect() as conn:
+            compression.load_dicts(conn)
+        return engine, table
+
+    with engine.begin() as conn:
+        # NOTE: not migrating here, it might need to rewrite all visits, so it's only done by the indexer
+        missing = migrations.missing(conn)
+        schema = normalized.get_schema(conn)
+        if schema == 'normalized':
+            # 'visits' is a view, so the index is on the underlying table
+            normalized.create_indexes(conn)
+        compression.load_dicts(conn)
+    if len(missing) > 0:
+        get_logger().warning(
+            f'database "{db_path}" was created by an older version of promnesia (missing {missing}), some queries might be slower. Run "promnesia index" to upgrade it'
+        )
+        table = Table('visits', MetaData(), *(c for c in get_columns() if c.name not in missing))
+    indexes = [] if schema == 'normalized' else get_indexes(table)
+    for idx in indexes:
+        try:
+            idx.create(bind=engine)
+        except exc.OperationalError as e:
+            if 'already exists' in str(e):
+                # meh, but no idea how to check it properly...
+                pass
+            else:
+                raise e
 
     # NOTE: apparently it's ok to open connection on every request? at least my comparisons didn't show anything
     return engine, table
@@ -0,0 +1,79 @@
+'''
+Upgrades databases created by older versions of promnesia to the current schema.
+
+Only runs on indexing (see dump), since some of the migrations have to rewrite all visits.
+The server just detects an old database (see missing) and falls back to slower queries until it's reindexed.
+'''
+
+from __future__ import annotations
+
+from sqlalchemy import Connection, MetaData, Table
+
+from ..common import get_logger
+from . import normalized
+from .common import get_source_stats_columns
+
+
+def _columns(conn: Connection, table: str) -> list[str]:
+    return [name for (_, name, *_) in conn.exec_driver_sql(f'PRAGMA main.table_info({table})')]
+
+
+# same as timegm(dt.utctimetuple()) in db_visit_to_row
+# dt might have a trailing timezone name in legacy databases (e.g. '2020-11-10T06:13:03+00:00 Europe/London')
+EPOCH_FROM_DT = "CAST(strftime('%s', substr(dt, 1, instr(dt || ' ', ' ') - 1)) AS INTEGER)"
+
+
+def _add_column(conn: Connection, column: str, *, index: str, index_columns: str, backfill: str | None = None) -> None:
+    schema = normalized.get_schema(conn)
+    table = 'visit_rows' if schema == 'normalized' else 'visits'
+    if column in _columns(conn, table):
+        return
+    logger = get_logger()
+    logger.info(f'migrating database: adding {column} column')
+    conn.exec_driver_sql(f'ALTER TABLE {table} ADD COLUMN {column} INTEGER')
+    if backfill is not None:
+        conn.exec_driver_sql(f'UPDATE {table} SET {column} = {backfill}')
+    if schema == 'normalized':
+        index_columns = index_columns.replace('src', 'src_id')
+        normalized.recreate_view(conn)
+    conn.exec_driver_sql(f'CREATE INDEX IF NOT EXISTS {index} ON {table} ({index_columns})')
+
+
+def _has_source_stats(conn: Connection) -> bool:
+    return conn.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE name = 'source_stats'").scalar() is not None
+
+
+def _add_source_stats(conn: Connection) -> None:
+    if _has_source_stats(conn):
+        return
+    logger = get_logger()
+    logger.info('migrating database: adding source_stats table')
+    Table('source_stats', MetaData(), *get_source_stats_columns()).create(conn)
+    # indexed_at/seconds are unknown at this point
+    conn.exec_driver_sql('INSERT INTO source_stats (src, visits) SELECT src, COUNT(*) FROM visits GROUP BY src')
+
+
+def migrate(conn: Connection) -> None:
+    '''
+    Should run within a transaction, so readers never see a partially migrated database
+    '''
+    if normalized.get_schema(conn) is None:
+        return  # nothing to migrate
+    _add_column(conn, 'epoch', index='index_epoch', index_columns='epoch', backfill=EPOCH_FROM_DT)
+    # not backfilled: these visits are just replaced on the next indexing (see dump)
+    _add_column(conn, 'row_hash', index='index_src_hash', index_columns='src, row_hash')
+    _add_source_stats(conn)
+
+
+def missing(conn: Connection) -> list[str]:
+    '''
+    Columns/tables which the database doesn't have yet, i.e. which migrate would add
+    '''
+    if normalized.get_schema(conn) is None:
+        return []
+    # NOTE: 'visits' is a view for the normalized schema, but it's recreated with the new columns (see _add_column)
+    columns = _columns(conn, 'visits')
+    res = [c for c in ('epoch', 'row_hash') if c not in columns]
+    if not _has_source_stats(conn):
+        res.append('source_stats')
+    return res
@@ -0,0 +1,266 @@
+'''
+Optional normalized database schema (see NORMALIZED_DB in the config).
+
+Sources, locators and contexts repeat a lot between visits (e.g. all links from the same org-mode file share the locator,
+all links from the same paragraph share the context), so instead of storing them in every row,
+they are kept once in lookup tables, and 'visit_rows' only refers to them by integer ids.
+
+'visits' is then a view joining these back, with exactly the same columns as the plain 'visits' table,
+so everything reading the database (server queries, row_to_db_visit) works the same regardless of the schema.
+sqlite flattens the view, so lookups by norm_url still use the index on visit_rows.
+
+Only the indexer (see dump) needs to know about the schema, since views can't be inserted into.
+'''
+
+from __future__ import annotations
+
+from collections.abc import Collection
+from hashlib import blake2b
+from typing import Literal
+
+from sqlalchemy import Connection, MetaData, Table
+
+from .common import get_columns, get_indexes
+
+Schema = Literal['flat', 'normalized']
+
+# fmt: off
+_DDL = [
+    'CREATE TABLE visit_srcs     (id INTEGER PRIMARY KEY, src TEXT NOT NULL UNIQUE)',
+    # large strings are looked up by hash, so they aren't duplicated in the index
+    'CREATE TABLE visit_locators (id INTEGER PRIMARY KEY, hash INTEGER NOT NULL, title TEXT, href TEXT)',
+    'CREATE TABLE visit_contexts (id INTEGER PRIMARY KEY, hash INTEGER NOT NULL, context TEXT NOT NULL)',
+    'CREATE INDEX index_locators_hash ON visit_locators (hash)',
+    'CREATE INDEX index_contexts_hash ON visit_contexts (hash)',
+    '''
+    CREATE TABLE visit_rows (
+        norm_url   TEXT,
+        orig_url   TEXT,
+        dt         TEXT,
+        locator_id INTEGER,
+        src_id     INTEGER,
+        context_id INTEGER,
+        duration   INTEGER,
+        epoch      INTEGER,
+        row_hash   INTEGER
+    )''',
+]
+# NOTE: columns have to match database.common.get_columns
+_VIEW = '''
+    CREATE VIEW main.visits AS SELECT
+        r.norm_url AS norm_url,
+        r.orig_url AS orig_url,
+        r.dt       AS dt,
+        l.title    AS locator_title,
+        l.href     AS locator_href,
+        s.src      AS src,
+        c.context  AS context,
+        r.duration AS duration,
+        r.epoch    AS epoch,
+        r.row_hash AS row_hash
+    FROM visit_rows r
+    LEFT JOIN visit_locators l ON l.id = r.locator_id
+    LEFT JOIN visit_srcs     s ON s.id = r.src_id
+    LEFT JOIN visit_contexts c ON c.id = r.context_id'''
+# fmt: on
+_TABLES = ['visit_rows', 'visit_srcs', 'visit_locators', 'visit_contexts']
+
+_HASH = 'promnesia_hash'
+
+
+def _hash(*args) -> int:
+    # needs to be stable between runs, so can't use builtin hash()
+    digest = blake2b(repr(args).encode('utf8', errors='surrogatepass'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little', signed=True)
+
+
+def register_functions(dbapi_con, con_record) -> None:
+    '''
+    Should be called on connect (as an sqlalchemy event listener) for the connections used to write into the normalized schema
+    '''
+    dbapi_con.create_function(_HASH, -1, _hash, deterministic=True)
+
+
+def get_schema(conn: Connection) -> Schema | None:
+    '''
+    Schema of the existing database, or None if it doesn't have visits yet
+    '''
+    kind = conn.exec_driver_sql("SELECT type FROM sqlite_master WHERE name = 'visits'").scalar()
+    if kind is None:
+        return None
+    return 'normalized' if kind == 'view' else 'flat'
+
+
+def create(conn: Connection) -> None:
+    for ddl in _DDL:
+        conn.exec_driver_sql(ddl)
+    recreate_view(conn)
+    create_indexes(conn)
+
+
+def recreate_view(conn: Connection) -> None:
+    # e.g. after adding columns to visit_rows
+    # NOTE: explicit 'main', since the staging database might be attached, and it has 'visits' too
+    conn.exec_driver_sql('DROP VIEW IF EXISTS main.visits')
+    conn.exec_driver_sql(_VIEW)
+
+
+def create_indexes(conn: Connection) -> None:
+    # same names as the indexes on plain 'visits' table (see common.get_indexes), so they can be dropped the same way during bulk loading
+    conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS index_norm_url ON visit_rows (norm_url)')
+    conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS index_epoch ON visit_rows (epoch)')
+    conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS index_src_hash ON visit_rows (src_id, row_hash)')
+    # for checking whether the strings are still used after deleting visits (see _delete_rows)
+    # (index_src_hash covers src_id already)
+    for column in ['locator_id', 'context_id']:
+        conn.exec_driver_sql(f'CREATE INDEX IF NOT EXISTS index_{column} ON visit_rows ({column})')
+
+
+def drop_indexes(conn: Connection) -> None:
+    for name in ['index_norm_url', 'index_epoch', 'index_src_hash', 'index_locator_id', 'index_context_id']:
+        conn.exec_driver_sql(f'DROP INDEX IF EXISTS {name}')
+
+
+def insert_visits(conn: Connection, source: str) -> int:
+    '''
+    Inserts visits from another table (with the same columns as 'visits'), adding the missing strings to lookup tables.
+    Returns the number of inserted visits.
+    '''
+    conn.exec_driver_sql(f'''
+    INSERT INTO visit_srcs (src)
+    SELECT DISTINCT src FROM {source} WHERE src IS NOT NULL AND src NOT IN (SELECT src FROM visit_srcs)
+    ''')
+    # promnesia_hash is a python function, so it's only computed once for each distinct string (rather than in each subquery for each visit)
+    # then the ids are looked up by the strings themselves in temp tables (which are dropped after, so it's fine to index them)
+    _intern(conn, 'visit_locators', ['title', 'href'], f'SELECT DISTINCT locator_title AS title, locator_href AS href FROM {source}')
+    _intern(conn, 'visit_contexts', ['context'], f'SELECT DISTINCT context FROM {source} WHERE context IS NOT NULL')
+    inserted = conn.exec_driver_sql(f'''
+    INSERT INTO visit_rows (norm_url, orig_url, dt, locator_id, src_id, context_id, duration, epoch, row_hash)
+    SELECT
+        t.norm_url,
+        t.orig_url,
+        t.dt,
+        (SELECT l.id FROM temp.new_visit_locators l WHERE l.title IS t.locator_title AND l.href IS t.locator_href),
+        (SELECT s.id FROM visit_srcs s WHERE s.src = t.src),
+        (SELECT c.id FROM temp.new_visit_contexts c WHERE c.context = t.context),
+        t.duration,
+        t.epoch,
+        t.row_hash
+    FROM {source} t
+    ''').rowcount
+    for table in ['visit_locators', 'visit_contexts']:
+        conn.exec_driver_sql(f'DROP TABLE temp.new_{table}')
+    return inserted
+
+
+def _intern(conn: Connection, table: str, columns: list[str], values: str) -> None:
+    '''
+    Adds the missing values (an SQL query returning the columns) to the lookup table, and puts their ids into temp.new_<table>, indexed by the values
+    '''
+    cols = ', '.join(columns)
+    same = ' AND '.join(f'x.{c} IS t.{c}' for c in columns)
+    conn.exec_driver_sql(f'DROP TABLE IF EXISTS temp.new_{table}')
+    conn.exec_driver_sql(f'''
+    CREATE TEMP TABLE new_{table} AS SELECT {cols}, {_HASH}({cols}) AS hash, NULL AS id FROM ({values})
+    ''')
+    conn.exec_driver_sql(f'''
+    INSERT INTO {table} (hash, {cols})
+    SELECT t.hash, {cols} FROM temp.new_{table} t
+    WHERE NOT EXISTS (SELECT 1 FROM {table} x WHERE x.hash = t.hash AND {same})
+    ''')
+    conn.exec_driver_sql(f'''
+    UPDATE temp.new_{table} AS t SET id = (SELECT x.id FROM {table} x WHERE x.hash = t.hash AND {same})
+    ''')
+    conn.exec_driver_sql(f'CREATE INDEX temp.index_new_{table} ON new_{table} ({cols})')
+
+
+def delete_visits(conn: Connection, *, srcs: Collection[str] | str, keep: bool) -> None:
+    '''
+    Deletes visits of the given sources (or of all other sources if keep is set).
+    srcs can also be an SQL query returning the sources.
+    '''
+    params: tuple[str, ...] = ()
+    if isinstance(srcs, str):
+        query = srcs
+    else:
+        query, params = 'VALUES ' + ', '.join(['(?)'] * len(srcs)), tuple(srcs)
+        if len(srcs) == 0:
+            query = 'SELECT NULL WHERE 0'
+    ids = f'SELECT id FROM visit_srcs WHERE src IN ({query})'
+    if keep:
+        _delete_rows(conn, f'src_id IS NULL OR src_id NOT IN ({ids})', params)
+    else:
+        _delete_rows(conn, f'src_id IN ({ids})', params)
+
+
+def delete_changed(conn: Connection, *, srcs: str, changed: str) -> int:
+    '''
+    Deletes visits of the sources (an SQL query) which have NULL row_hash, or whose (src, row_hash) is in the 'changed' table.
+    Returns the number of deleted visits.
+    '''
+    return _delete_rows(
+        conn,
+        f'''
+        src_id IN (SELECT id FROM visit_srcs WHERE src IN ({srcs}))
+        AND (row_hash IS NULL OR (src_id, row_hash) IN (SELECT s.id, c.row_hash FROM {changed} c JOIN visit_srcs s ON s.src = c.src))
+        ''',
+    )
+
+
+_LOOKUPS = [('visit_srcs', 'src_id'), ('visit_locators', 'locator_id'), ('visit_contexts', 'context_id')]
+
+
+def _delete_rows(conn: Connection, where: str, params: tuple = ()) -> int:
+    '''
+    Deletes visits matching the condition, along with the strings which aren't used by any visits anymore.
+    Returns the number of deleted visits.
+    '''
+    # NOTE: only checking the strings the deleted visits referred to, checking all of them would be a full scan on every reindexing
+    for table, column in _LOOKUPS:
+        conn.exec_driver_sql(f'DROP TABLE IF EXISTS temp.gc_{table}')
+        conn.exec_driver_sql(
+            f'CREATE TEMP TABLE gc_{table} AS SELECT DISTINCT {column} AS id FROM visit_rows WHERE ({where}) AND {column} IS NOT NULL',
+            params,
+        )
+    deleted = conn.exec_driver_sql(f'DELETE FROM visit_rows WHERE {where}', params).rowcount
+    for table, column in _LOOKUPS:
+        conn.exec_driver_sql(f'''
+        DELETE FROM {table} WHERE id IN (SELECT id FROM temp.gc_{table})
+        AND NOT EXISTS (SELECT 1 FROM visit_rows r WHERE r.{column} = {table}.id)
+        ''')
+        conn.exec_driver_sql(f'DROP TABLE temp.gc_{table}')
+    return deleted
+
+
+def drop(conn: Connection) -> None:
+    conn.exec_driver_sql('DROP VIEW main.visits')
+    for table in _TABLES:
+        conn.exec_driver_sql(f'DROP TABLE {table}')
+
+
+def migrate(conn: Connection, *, to: Schema) -> None:
+    '''
+    Converts the database between plain and normalized schema, all visits are kept.
+    Should run within a transaction, so the readers see either the old or the new schema.
+    '''
+    current = get_schema(conn)
+    if current is None or current == to:
+        return
+    indexes = get_indexes(Table('visits', MetaData(), *get_columns()))
+    if to == 'normalized':
+        for idx in indexes:
+            conn.exec_driver_sql(f'DROP INDEX IF EXISTS {idx.name}')
+        conn.exec_driver_sql('ALTER TABLE visits RENAME TO visits_flat')
+        create(conn)
+        drop_indexes(conn)  # cheaper to build them after inserting
+        insert_visits(conn, 'visits_flat')
+        create_indexes(conn)
+        conn.exec_driver_sql('DROP TABLE visits_flat')
+    else:
+        flat = Table('visits_flat', MetaData(), *get_columns())
+        flat.create(conn)
+        conn.exec_driver_sql('INSERT INTO visits_flat SELECT * FROM visits')
+        drop(conn)
+        conn.exec_driver_sql('ALTER TABLE visits_flat RENAME TO visits')
+        for idx in indexes:
+            idx.create(conn)
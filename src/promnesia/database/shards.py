@@ -0,0 +1,109 @@
+'''
+Optional sharded database layout (see SHARDED_DB in the config).
+
+Sources are split between SHARDS database files (regular promnesia databases) by hash of the source name,
+in the '<db>.shards' directory next to the main database.
+The main database only has the 'shards' table listing them, and the server attaches the shards and sees them through temporary views
+with the same names as in a regular database ('visits', 'source_stats'), so the queries work the same way.
+
+Reindexing a source only rewrites its own shard, so indexing sources from different shards (e.g. 'promnesia index --sources ...')
+can run in parallel without waiting for each other.
+
+NOTE: sqlite can only attach a limited number of databases (10 by default, and that's also the compile time max),
+so the number of shards is fixed rather than one per source, otherwise configs with more sources couldn't use it.
+'''
+
+from __future__ import annotations
+
+import sqlite3
+from collections.abc import Collection
+from hashlib import blake2b
+from pathlib import Path
+
+from sqlalchemy import Connection
+
+from ..common import SourceName
+from .common import get_columns, get_context_dicts_columns, get_source_stats_columns
+
+# sqlite default attach limit is 10, one is left spare (e.g. to attach a staging database to a connection with all shards)
+# NOTE: changing it would move sources between shards, so existing databases would need to be rebuilt with --overwrite
+SHARDS = 9
+
+
+def max_shards() -> int:
+    conn = sqlite3.connect(':memory:')
+    try:
+        return conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+    finally:
+        conn.close()
+
+
+def shard_relpath(db_path: Path, src: SourceName | None) -> str:
+    '''
+    Path of the shard the source belongs to, relative to the directory of the main database
+    '''
+    # needs to be stable between runs, so can't use builtin hash()
+    digest = blake2b((src or '').encode('utf8', errors='surrogatepass'), digest_size=8).digest()
+    shard = int.from_bytes(digest, 'little') % SHARDS
+    return f'{db_path.name}.shards/{shard}.sqlite'
+
+
+def create_table(conn: Connection) -> None:
+    conn.exec_driver_sql('CREATE TABLE IF NOT EXISTS shards (path TEXT NOT NULL)')
+
+
+def get_shards(conn: Connection) -> list[str] | None:
+    '''
+    None if the database isn't sharded
+    '''
+    exists = conn.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE name = 'shards'").scalar()
+    if not exists:
+        return None
+    return [path for (path,) in conn.exec_driver_sql('SELECT DISTINCT path FROM shards ORDER BY path')]
+
+
+def set_shards(conn: Connection, paths: Collection[str]) -> None:
+    conn.exec_driver_sql('DELETE FROM shards')
+    if len(paths) > 0:
+        conn.exec_driver_sql('INSERT INTO shards (path) VALUES (?)', [(path,) for path in sorted(paths)])
+
+
+def check_limit(paths: Collection[str]) -> None:
+    limit = max_shards()
+    if len(paths) > limit:
+        raise RuntimeError(
+            f'Too many shards: {len(paths)} (sqlite can only attach {limit} databases). '
+            'Use a single file database instead (SHARDED_DB = False).'
+        )
+
+
+def _union_view(name: str, columns: list[str], schemas: list[str]) -> str:
+    if len(schemas) == 0:
+        # no shards yet, but should still be queryable
+        select = 'SELECT ' + ', '.join(f'NULL AS {c}' for c in columns) + ' WHERE 0'
+    else:
+        select = ' UNION ALL '.join(f'SELECT * FROM {schema}.{name}' for schema in schemas)
+    return f'CREATE TEMP VIEW {name} AS {select}'
+
+
+def attach(dbapi_con, db_path: Path, paths: Collection[str]) -> None:
+    '''
+    Should be called on connect: attaches the shards and creates temporary views unioning them.
+    sqlite pushes WHERE clauses down into each part of UNION ALL, so the queries still use the indexes within shards.
+    '''
+    check_limit(paths)
+    schemas = [f'shard{i}' for i in range(len(paths))]
+    for schema, path in zip(schemas, paths, strict=True):
+        dbapi_con.execute(f'ATTACH DATABASE ? AS {schema}', (str(db_path.parent / path),))
+    visits_columns = [c.name for c in get_columns()]
+    stats_columns = [c.name for c in get_source_stats_columns()]
+    dicts_columns = [c.name for c in get_context_dicts_columns()]
+    dbapi_con.execute(_union_view('visits', visits_columns, schemas))
+    dbapi_con.execute(_union_view('source_stats', stats_columns, schemas))
+    # only there if the shard was indexed with compressed contexts by this version
+    with_dicts = [
+        schema
+        for schema in schemas
+        if dbapi_con.execute(f"SELECT 1 FROM {schema}.sqlite_master WHERE name = 'context_dicts'").fetchone() is not None
+    ]
+    dbapi_con.execute(_union_view('context_dicts', dicts_columns, with_dicts))
@@ -0,0 +1,240 @@
+'''
+Compact duplicate detection for visits.
+
+Instead of keeping the whole Visit objects around (with locators and contexts, for millions of visits it takes gigabytes),
+only a 128-bit fingerprint of each visit is kept, in a flat open addressing hash table (16 bytes per slot).
+
+Collisions: two different visits with the same fingerprint would be treated as duplicates, so the second one would be dropped.
+With a 128-bit hash the probability of that is about n^2 / 2^129, i.e. ~10^-25 for 10M visits, so it's safe to ignore.
+'''
+
+from __future__ import annotations
+
+import sqlite3
+from array import array
+from collections.abc import Sequence
+from datetime import UTC, datetime
+from hashlib import blake2b
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from .common import Visit, get_tmpdir, logger
+
+_MASK64 = (1 << 64) - 1
+# max number of bound parameters is 999 in older sqlite versions
+_DISK_QUERY_CHUNK = 500
+_EPOCH = datetime.fromtimestamp(0, tz=UTC)
+_NAIVE_EPOCH = datetime(1970, 1, 1)
+
+
+def visit_fingerprint(v: Visit) -> int:
+    '''
+    128-bit hash of the visit, equal visits (as in ==) get equal fingerprints
+    '''
+    dt = v.dt
+    dtkey: tuple
+    if isinstance(dt, datetime):
+        # aware datetimes compare by the moment in time regardless of the timezone, naive ones are never equal to aware
+        naive = dt.utcoffset() is None
+        delta = dt.replace(tzinfo=None) - _NAIVE_EPOCH if naive else dt - _EPOCH
+        dtkey = (naive, delta.days, delta.seconds, delta.microseconds)
+    else:
+        # e.g. date (supported by DbVisit.make), never equal to a datetime
+        dtkey = (type(dt).__name__, repr(dt))
+    key = repr((v.url, dtkey, *v.locator, v.context, v.duration, v.debug))
+    return int.from_bytes(blake2b(key.encode('utf8', errors='surrogatepass'), digest_size=16).digest(), 'little')
+
+
+class FingerprintSet:
+    '''
+    Open addressing hash set of 128-bit ints backed by two arrays, i.e. 16 bytes per slot.
+    Zero is reserved as the 'empty' marker in the arrays, so zero fingerprint is tracked by a separate flag.
+    '''
+
+    _MAX_LOAD = 0.6
+
+    def __init__(self, capacity: int = 1 << 16) -> None:
+        cap = 1
+        while cap < capacity:
+            cap <<= 1
+        self._alloc(cap)
+        self._size = 0
+        self._has_zero = False
+
+    def _alloc(self, cap: int) -> None:
+        self._mask = cap - 1
+        # (repetition doesn't need a temporary buffer, unlike array('Q', bytes(...)))
+        self._lo = array('Q', [0]) * cap
+        self._hi = array('Q', [0]) * cap
+
+    @property
+    def nbytes(self) -> int:
+        return 2 * 8 * (self._mask + 1)
+
+    @property
+    def full(self) -> bool:
+        '''
+        True if the next add of a new fingerprint would grow the table (temporarily it takes 3x nbytes while rehashing)
+        '''
+        return self._size + 1 > self._MAX_LOAD * (self._mask + 1)
+
+    def add(self, fp: int) -> bool:
+        '''
+        Returns False if fp was already present
+        '''
+        if fp == 0:
+            if self._has_zero:
+                return False
+            self._has_zero = True
+            return True
+        if not self._insert(fp & _MASK64, fp >> 64):
+            return False
+        if self._size > self._MAX_LOAD * (self._mask + 1):
+            self._grow()
+        return True
+
+    def _insert(self, lo: int, hi: int) -> bool:
+        los, his, mask = self._lo, self._hi, self._mask
+        i = lo & mask
+        while True:
+            slo = los[i]
+            if slo == 0 and his[i] == 0:
+                break
+            if slo == lo and his[i] == hi:
+                return False
+            i = (i + 1) & mask
+        los[i] = lo
+        his[i] = hi
+        self._size += 1
+        return True
+
+    def __contains__(self, fp: int) -> bool:
+        if fp == 0:
+            return self._has_zero
+        lo = fp & _MASK64
+        hi = fp >> 64
+        los, his, mask = self._lo, self._hi, self._mask
+        i = lo & mask
+        while True:
+            slo = los[i]
+            if slo == lo and his[i] == hi:
+                return True
+            if slo == 0 and his[i] == 0:
+                return False
+            i = (i + 1) & mask
+
+    def __iter__(self):
+        if self._has_zero:
+            yield 0
+        for lo, hi in zip(self._lo, self._hi, strict=True):
+            if lo != 0 or hi != 0:
+                yield (hi << 64) | lo
+
+    def _grow(self) -> None:
+        # NOTE: iterating over the old arrays directly, materializing them (e.g. as a list of tuples) would take way more memory than the table itself
+        old_lo, old_hi = self._lo, self._hi
+        self._alloc(2 * (self._mask + 1))
+        self._size = 0
+        for lo, hi in zip(old_lo, old_hi, strict=True):
+            if lo != 0 or hi != 0:
+                self._insert(lo, hi)
+
+    def __len__(self) -> int:
+        return self._size + self._has_zero
+
+
+class VisitDedup:
+    '''
+    Remembers visits seen so far (by fingerprint).
+
+    If memory_budget (in bytes) is set and the in-memory table outgrows it, fingerprints are moved to an sqlite database on disk,
+    so memory usage stays bounded for huge sources (at the cost of slower lookups).
+    '''
+
+    def __init__(self, *, memory_budget: int | None = None, tmp_dir: Path | None = None) -> None:
+        self.memory_budget = memory_budget
+        self._tmp_dir = tmp_dir
+        self._mem = self._new_mem()
+        self._disk: sqlite3.Connection | None = None
+        self._disk_dir: TemporaryDirectory[str] | None = None
+        self._disk_size = 0
+
+    def add(self, v: Visit) -> bool:
+        '''
+        Returns False if the visit was already seen
+        '''
+        [res] = self.add_many([v])
+        return res
+
+    def add_many(self, visits: Sequence[Visit]) -> list[bool]:
+        '''
+        Same as add for each visit in order, but once spilled, the disk is queried once for the whole chunk instead of once per visit
+        '''
+        fps = [visit_fingerprint(v) for v in visits]
+        on_disk = self._on_disk([fp for fp in fps if fp not in self._mem])
+        # the table might be spilled in the middle of the chunk, so need to remember what's added since on_disk was queried
+        added: set[int] = set()
+        res = []
+        for fp in fps:
+            if fp in self._mem or fp in on_disk or fp in added:
+                res.append(False)
+                continue
+            if self.memory_budget is not None and self._mem.full and 3 * self._mem.nbytes > self.memory_budget:
+                # growing would take more than the budget (old and new tables are both in memory while rehashing)
+                self._spill()
+            self._mem.add(fp)
+            added.add(fp)
+            res.append(True)
+        return res
+
+    def __contains__(self, v: Visit) -> bool:
+        fp = visit_fingerprint(v)
+        return fp in self._mem or fp in self._on_disk([fp])
+
+    def _on_disk(self, fps: Sequence[int]) -> set[int]:
+        if self._disk is None or len(fps) == 0:
+            return set()
+        res: set[int] = set()
+        for i in range(0, len(fps), _DISK_QUERY_CHUNK):
+            keys = [fp.to_bytes(16, 'little') for fp in fps[i : i + _DISK_QUERY_CHUNK]]
+            query = f'SELECT fp FROM fingerprints WHERE fp IN ({",".join("?" * len(keys))})'
+            res.update(int.from_bytes(key, 'little') for (key,) in self._disk.execute(query, keys))
+        return res
+
+    def _spill(self) -> None:
+        if self._disk is None:
+            self._disk_dir = TemporaryDirectory(dir=self._tmp_dir or get_tmpdir().name, prefix='dedup')
+            path = Path(self._disk_dir.name) / 'fingerprints.sqlite'
+            logger.debug('dedup: exceeded memory budget (%d bytes), spilling fingerprints to %s', self.memory_budget, path)
+            self._disk = sqlite3.connect(path)
+            self._disk.execute('PRAGMA journal_mode=OFF')
+            self._disk.execute('PRAGMA synchronous=OFF')
+            self._disk.execute('CREATE TABLE fingerprints (fp BLOB PRIMARY KEY) WITHOUT ROWID')
+        with self._disk:
+            self._disk.executemany(
+                'INSERT OR IGNORE INTO fingerprints VALUES (?)', ((fp.to_bytes(16, 'little'),) for fp in self._mem)
+            )
+        self._disk_size += len(self._mem)
+        self._mem = self._new_mem()
+
+    def _new_mem(self) -> FingerprintSet:
+        capacity = 1 << 16
+        if self.memory_budget is not None:
+            # small enough to grow at least once before spilling (16 bytes per slot, and 3x that while growing)
+            capacity = max(16, min(capacity, self.memory_budget // 48))
+        return FingerprintSet(capacity)
+
+    @property
+    def spilled(self) -> bool:
+        return self._disk is not None
+
+    def close(self) -> None:
+        if self._disk is not None:
+            self._disk.close()
+            self._disk = None
+        if self._disk_dir is not None:
+            self._disk_dir.cleanup()
+            self._disk_dir = None
+
+    def __len__(self) -> int:
+        return self._disk_size + len(self._mem)
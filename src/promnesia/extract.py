@@ -1,10 +1,16 @@
 from __future__ import annotations
 
+import os
 import re
-from collections.abc import Iterable, Sequence
+from collections import deque
+from collections.abc import Iterable, Iterator, Sequence
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import ExitStack
 from functools import lru_cache
+from hashlib import sha256
+from timeit import default_timer as timer
 
-from .cannon import CanonifyException
+from .cannon import canonify_cache, canonify_many
 from .common import (
     DbVisit,
     Filter,
@@ -15,7 +21,11 @@ from .common import (
     Url,
     Visit,
     logger,
+    mp_context,
 )
+from .config import use_cores
+from .dedup import VisitDedup
+from .perf import SourceStats, peak_rss, perf
 
 DEFAULT_FILTERS = (
     r'^chrome-\w+://',
@@ -34,66 +44,334 @@ DEFAULT_FILTERS = (
 def filters() -> Sequence[Filter]:
     from . import config
 
-    flt = list(DEFAULT_FILTERS)
+    flt: list[str | Filter] = list(DEFAULT_FILTERS)
     if config.has():  # meeeh...
         cfg = config.get()
         flt.extend(cfg.FILTERS)
-    return tuple(make_filter(f) for f in flt)
+    return make_filters(flt)
+
+
+# visits are canonified in batches, so duplicate urls within the batch are only processed once
+_CANONIFY_BATCH = 1000
 
 
 def extract_visits(source: Source, *, src: SourceName) -> Iterable[Res[DbVisit]]:
     extractor = source.extractor
     logger.info('extracting via %s ...', source.description)
 
+    stats = perf.source(src)
     try:
         vit: Results = extractor()
     except Exception as e:
         # todo critical error?
         # cause that means error during binding extractor args
         logger.exception(e)
+        stats.errors += 1
         yield e
         return
 
-    handled: set[Visit] = set()
+    rss_before = peak_rss()
+    handled = VisitDedup(memory_budget=_dedup_memory_budget())
     try:
-        for p in vit:
-            if isinstance(p, Exception):
-                # todo not sure if need it at all?
-                # parts = ['indexer emitted exception\n']
-                # eh, exception type is ignored by format_exception completely, apparently??
-                # parts.extend(traceback.format_exception(Exception, p, p.__traceback__))
-                # logger.error(''.join(parts))
-                yield p
-                continue
+        batches = _iter_batches(stats.timed('extract', vit), handled=handled, stats=stats)
 
-            if p in handled:  # no need to emit duplicates
-                continue
-            handled.add(p)
+        cores = use_cores()
+        res: Iterable[Res[DbVisit]]
+        if cores is None:
+            res = (v for batch in batches for v in as_db_visits(batch, src=src, stats=stats))
+        else:
+            res = _as_db_visits_parallel(batches, src=src, workers=cores or os.cpu_count() or 1, stats=stats)
+        for v in res:
+            if isinstance(v, Exception):
+                stats.errors += 1
+            else:
+                stats.visits += 1
+            yield v
+
+        logger.info('extracting via %s: got %d visits', source.description, len(handled))
+    finally:
+        handled.close()
+        rss_after = peak_rss()
+        if rss_before is not None and rss_after is not None:
+            stats.peak_rss_growth = (stats.peak_rss_growth or 0) + rss_after - rss_before
 
-            yield from as_db_visit(p, src=src)
+
+def _dedup_memory_budget() -> int | None:
+    from . import config
+
+    return config.get().dedup_memory_budget if config.has() else None
+
+
+def _iter_batches(vit: Results, *, handled: VisitDedup, stats: SourceStats | None = None) -> Iterator[list[Res[Visit]]]:
+    # NOTE: errors are kept in place within the batch, so the original order is preserved
+    stats = stats or SourceStats('')
+
+    def dedup(chunk: list[Res[Visit]]) -> list[Res[Visit]]:
+        # whole chunk at once, so it's a single query if the fingerprints are spilled to disk
+        start = timer()
+        new = iter(handled.add_many([v for v in chunk if not isinstance(v, Exception)]))
+        res = [v for v in chunk if isinstance(v, Exception) or next(new)]  # no need to emit duplicates
+        stats.add('dedup', timer() - start)
+        return res
+
+    chunk: list[Res[Visit]] = []
+    try:
+        for p in vit:
+            # todo not sure if need it at all?
+            # parts = ['indexer emitted exception\n']
+            # eh, exception type is ignored by format_exception completely, apparently??
+            # parts.extend(traceback.format_exception(Exception, p, p.__traceback__))
+            # logger.error(''.join(parts))
+            chunk.append(p)
+            if len(chunk) >= _CANONIFY_BATCH:
+                batch = dedup(chunk)
+                if len(batch) > 0:
+                    yield batch
+                chunk = []
     except Exception as e:
         # todo critical error?
         logger.exception(e)
-        yield e
-
-    logger.info('extracting via %s: got %d visits', source.description, len(handled))
+        # still emit whatever we managed to extract before the error
+        chunk.append(e)
+    batch = dedup(chunk)
+    if len(batch) > 0:
+        yield batch
 
 
 def as_db_visit(v: Visit, *, src: SourceName) -> Iterable[Res[DbVisit]]:
-    if filtered(v.url):
-        return
-    res = DbVisit.make(v, src=src)
-    if isinstance(res, CanonifyException):
-        # todo not sure if need this log? either way maybe get rid of canonify exception and just yield up
-        logger.error('error while canonnifying %s... ignoring', v)
-        logger.exception(res)
-    yield res
+    return as_db_visits([v], src=src)
+
+
+def as_db_visits(visits: Sequence[Res[Visit]], *, src: SourceName, stats: SourceStats | None = None) -> Iterable[Res[DbVisit]]:
+    start = timer()
+    kept = _filter_visits(visits)
+    filtered_at = timer()
+    nurls = canonify_many(_urls(kept), cache=canonify_cache)
+    res = _make_db_visits(kept, nurls, src=src)
+    if stats is not None:
+        stats.add('filter', filtered_at - start)
+        stats.add('canonify', timer() - filtered_at)
+        res = stats.timed('convert', res)
+    return res
+
+
+def _filter_visits(visits: Sequence[Res[Visit]]) -> list[Res[Visit]]:
+    # errors from filters are reported per visit, so they don't affect the rest of the batch
+    kept: list[Res[Visit]] = []
+    for v in visits:
+        if isinstance(v, Exception):
+            kept.append(v)
+            continue
+        try:
+            if filtered(v.url):
+                continue
+        except Exception as e:
+            kept.append(e)
+            continue
+        kept.append(v)
+    return kept
+
+
+def _urls(visits: Sequence[Res[Visit]]) -> list[Url]:
+    return [v.url for v in visits if not isinstance(v, Exception)]
+
+
+def _make_db_visits(visits: Sequence[Res[Visit]], nurls: Sequence[Res[Url]], *, src: SourceName) -> Iterable[Res[DbVisit]]:
+    nit = iter(nurls)
+    for v in visits:
+        if isinstance(v, Exception):
+            yield v
+            continue
+        nurl = next(nit)
+        if isinstance(nurl, Exception):
+            # todo not sure if need this log? either way maybe get rid of canonify exception and just yield up
+            logger.error('error while canonnifying %s... ignoring', v)
+            logger.exception(nurl)
+            yield nurl
+            continue
+        yield DbVisit.make(v, src=src, norm_url=nurl)
+
+
+def _init_worker(cache_size: int) -> None:
+    canonify_cache.resize(cache_size)
+
+
+def _canonify_batch(urls: list[Url]) -> list[Res[Url]]:
+    return canonify_many(urls, cache=canonify_cache)
+
+
+def _as_db_visits_parallel(
+    batches: Iterable[list[Res[Visit]]],
+    *,
+    src: SourceName,
+    workers: int,
+    stats: SourceStats | None = None,
+) -> Iterable[Res[DbVisit]]:
+    '''
+    Canonifies batches in a process pool, results are emitted in the original order.
+    Only urls missing from the cache are sent to the workers (cheaper to pickle than whole visits),
+    filtering stays in the main process since filters from the config might not be picklable.
+    '''
+    # keep a bounded number of batches in flight, so we don't end up with the whole source in memory
+    window = 2 * workers
+    pending: deque[tuple[list[Res[Visit]], dict[Url, Res[Url]], list[Url], Future[list[Res[Url]]]]] = deque()
+    stats = stats or SourceStats(src)
+
+    def pop() -> Iterable[Res[DbVisit]]:
+        kept, done, missing, fut = pending.popleft()
+        # NOTE: from the main process perspective, canonify time is the time spent waiting for the workers
+        start = timer()
+        try:
+            results = fut.result()
+        except Exception as e:
+            # e.g. if worker process died
+            logger.exception(e)
+            yield e
+            return
+        for url, nurl in zip(missing, results, strict=True):
+            done[url] = nurl
+            if not isinstance(nurl, Exception):
+                # workers have their own in-memory caches, but the persistent store is only used by the main process
+                canonify_cache.add(url, nurl)
+        stats.add('canonify', timer() - start)
+        yield from stats.timed('convert', _make_db_visits(kept, [done[u] for u in _urls(kept)], src=src))
+
+    with ExitStack() as stack:
+        pool: ProcessPoolExecutor | None = None
+        for batch in batches:
+            if pool is None and len(batch) < _CANONIFY_BATCH:
+                # only batch in a small source, not worth starting a pool
+                yield from as_db_visits(batch, src=src, stats=stats)
+                continue
+            if pool is None:
+                pool = stack.enter_context(
+                    ProcessPoolExecutor(
+                        workers, mp_context=mp_context(), initializer=_init_worker, initargs=(canonify_cache.maxsize,)
+                    )
+                )
+            start = timer()
+            kept = _filter_visits(batch)
+            filtered_at = timer()
+            urls = dict.fromkeys(_urls(kept))
+            done: dict[Url, Res[Url]] = dict(canonify_cache.lookup_many(urls))
+            missing = [u for u in urls if u not in done]
+            stats.add('filter', filtered_at - start)
+            stats.add('canonify', timer() - filtered_at)
+            pending.append((kept, done, missing, pool.submit(_canonify_batch, missing)))
+            if len(pending) >= window:
+                yield from pop()
+        while len(pending) > 0:
+            yield from pop()
 
 
 def filtered(url: Url) -> bool:
     return any(f(url) for f in filters())
 
 
+def make_filters(things: Iterable[str | Filter]) -> Sequence[Filter]:
+    '''
+    String filters are combined into a single RegexFilters matcher, callable filters are kept as is.
+    '''
+    patterns: list[str] = []
+    callables: list[Filter] = []
+    for thing in things:
+        if isinstance(thing, str):
+            patterns.append(thing)
+        else:
+            callables.append(thing)
+    return (RegexFilters(patterns), *callables)
+
+
+# these are in most urls, so not much use for prefiltering
+_COMMON_TRIGRAMS = frozenset(
+    g for w in ('https://', 'http://', 'www.', '.com/', '.org/', '.html') for g in (w[i : i + 3] for i in range(len(w) - 2))
+)
+
+
+class RegexFilters:
+    '''
+    Checks a url against many regexes at once, returns True if any of them matches (same as re.search).
+
+    Each regex with a required literal (e.g. 'google' for r'mail.google.com') is only searched if the literal occurs in the url,
+    which is much cheaper than running the regex engine. With lots of regexes even checking all the literals gets slow,
+    so then regexes are indexed by a trigram of their literal, and only those whose trigram occurs in the url are checked.
+    NOTE: Python regex engine doesn't do any better with one big alternation, it's actually slower than separate searches.
+    '''
+
+    # roughly where the trigram index starts to pay off, see test_benchmark_filters
+    INDEX_THRESHOLD = 400
+
+    def __init__(self, patterns: Sequence[str]) -> None:
+        self.patterns = tuple(patterns)
+        literals = [(_required_literal(p) or '', re.compile(p)) for p in self.patterns]
+
+        # (literal, regex) pairs checked for every url, empty literal means no prefiltering
+        self._linear: list[tuple[str, re.Pattern[str]]] = []
+        self._index: dict[str, list[tuple[str, re.Pattern[str]]]] = {}
+        if len(literals) < self.INDEX_THRESHOLD:
+            self._linear = literals
+            return
+
+        # prefer trigrams shared by fewer regexes, so the url matches fewer candidates
+        popularity: dict[str, int] = {}
+        for lit, _ in literals:
+            for g in _trigrams(lit):
+                popularity[g] = popularity.get(g, 0) + 1
+        for lit, rc in literals:
+            grams = _trigrams(lit)
+            if len(grams) == 0:
+                self._linear.append((lit, rc))
+                continue
+            gram = min(grams, key=lambda g: (g in _COMMON_TRIGRAMS, popularity[g]))
+            self._index.setdefault(gram, []).append((lit, rc))
+
+    def fingerprint(self) -> str:
+        return sha256(repr(self.patterns).encode('utf8')).hexdigest()
+
+    def __call__(self, url: str) -> bool:
+        for lit, rc in self._linear:
+            if lit in url and rc.search(url) is not None:
+                return True
+        index = self._index
+        if len(index) == 0:
+            return False
+        for gram in _trigrams(url) & index.keys():
+            for lit, rc in index[gram]:
+                if lit in url and rc.search(url) is not None:
+                    return True
+        return False
+
+
+def _trigrams(s: str) -> set[str]:
+    return {s[i : i + 3] for i in range(len(s) - 2)}
+
+
+def _required_literal(pattern: str) -> str | None:
+    '''
+    Longest string which has to occur in any match of the pattern (only looks at top level literals, so it's conservative)
+    '''
+    try:
+        from re import _constants as C  # type: ignore[attr-defined]
+        from re import _parser  # type: ignore[attr-defined]
+
+        parsed = _parser.parse(pattern)
+    except Exception:
+        # e.g. if internals of re change
+        return None
+    if parsed.state.flags & (re.IGNORECASE | re.VERBOSE):
+        return None
+    best = ''
+    cur = ''
+    for op, av in parsed:
+        if op is C.LITERAL:
+            cur += chr(av)
+            continue
+        best = max(best, cur, key=len)
+        cur = ''
+    best = max(best, cur, key=len)
+    return best if len(best) > 0 else None
+
+
 def make_filter(thing: str | Filter) -> Filter:
     if isinstance(thing, str):
         rc = re.compile(thing)
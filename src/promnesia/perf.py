@@ -0,0 +1,175 @@
+'''
+Per source performance stats collected during indexing.
+
+Time is split into stages (see STAGES), so it's easy to tell whether it's the extractor itself that's slow,
+or e.g. canonify/filters/database.
+Stats are accumulated in the module level 'perf' object and dumped as a JSON report next to the database in the end.
+'''
+
+from __future__ import annotations
+
+import json
+import sys
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+from timeit import default_timer as timer
+from typing import Any, TypeVar
+
+from .common import SourceName, now_tz
+
+Json = dict[str, Any]
+
+STAGES = (
+    'extract',  # iterating the extractor (i.e. the source itself)
+    'dedup',  # filtering out duplicate visits
+    'filter',  # FILTERS from the config
+    'canonify',  # normalising urls
+    'convert',  # making DbVisit objects
+    'hook',  # HOOK from the config
+    'sqlite',  # inserting into the database
+)
+
+T = TypeVar('T')
+
+
+def peak_rss(*, children: bool = False) -> int | None:
+    '''
+    Peak resident memory of the current process (in bytes), or None if not available on the platform.
+    NOTE: it's the peak over the whole lifetime of the process, so it never goes down.
+    If children is set, it's the max of the current process and its terminated child processes (e.g. workers).
+    '''
+    try:
+        import resource
+    except ImportError:  # e.g. on windows
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if children:
+        maxrss = max(maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # on macos it's in bytes, elsewhere in kilobytes
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+class SourceStats:
+    def __init__(self, name: SourceName) -> None:
+        self.name = name
+        self.visits = 0
+        self.errors = 0
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+        # how much the peak RSS of the process grew while extracting the source
+        # i.e. zero if the source didn't need more memory than the process had already used at some point before
+        self.peak_rss_growth: int | None = None
+
+    @property
+    def total_seconds(self) -> float:
+        return sum(self.seconds.values())
+
+    @property
+    def visits_per_sec(self) -> float | None:
+        total = self.total_seconds
+        return None if total == 0 else self.visits / total
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.seconds[stage] += seconds
+
+    def timed(self, stage: str, it: Iterable[T]) -> Iterator[T]:
+        '''
+        Yields from the iterable, accounting the time spent inside it (but not in the consumer) to the stage
+        '''
+        it = iter(it)
+        seconds = self.seconds
+        while True:
+            start = timer()
+            try:
+                x = next(it)
+            except StopIteration:
+                return
+            finally:
+                seconds[stage] += timer() - start
+            yield x
+
+    def merge(self, other: SourceStats) -> None:
+        self.visits += other.visits
+        self.errors += other.errors
+        for stage, secs in other.seconds.items():
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + secs
+        if other.peak_rss_growth is not None:
+            self.peak_rss_growth = (self.peak_rss_growth or 0) + other.peak_rss_growth
+
+    def to_json(self) -> Json:
+        vps = self.visits_per_sec
+        return {
+            'visits': self.visits,
+            'errors': self.errors,
+            'seconds': {stage: round(secs, 6) for stage, secs in self.seconds.items()},
+            'total_seconds': round(self.total_seconds, 6),
+            'visits_per_sec': None if vps is None else round(vps, 1),
+            'peak_rss_growth_bytes': self.peak_rss_growth,
+        }
+
+    @classmethod
+    def from_json(cls, name: SourceName, j: Json) -> SourceStats:
+        res = cls(name)
+        res.visits = j['visits']
+        res.errors = j['errors']
+        res.seconds.update(j['seconds'])
+        res.peak_rss_growth = j['peak_rss_growth_bytes']
+        return res
+
+
+class PerfStats:
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self.sources: dict[SourceName, SourceStats] = {}
+        self.started = now_tz()
+        self._started = timer()
+
+    def source(self, name: SourceName) -> SourceStats:
+        st = self.sources.get(name)
+        if st is None:
+            st = SourceStats(name)
+            self.sources[name] = st
+        return st
+
+    def merge(self, sources: Json) -> None:
+        '''
+        Merges stats sent over from a worker process (in the format of report()['sources'])
+        '''
+        for name, j in sources.items():
+            self.source(name).merge(SourceStats.from_json(name, j))
+
+    def report(self) -> Json:
+        total = SourceStats('total')
+        for st in self.sources.values():
+            total.merge(st)
+        jtotal = total.to_json()
+        # growth isn't meaningful for the total, the actual peak is
+        del jtotal['peak_rss_growth_bytes']
+        jtotal['peak_rss_bytes'] = peak_rss(children=True)
+        return {
+            'started': self.started.isoformat(),
+            'finished': now_tz().isoformat(),
+            'wall_seconds': round(timer() - self._started, 6),
+            'total': jtotal,
+            'sources': {name: st.to_json() for name, st in sorted(self.sources.items())},
+        }
+
+    def summary(self) -> list[str]:
+        rep = self.report()
+        header = f'{"source":<20} {"visits":>9} {"errors":>6} {"visits/s":>9}  ' + ' '.join(f'{s:>8}' for s in STAGES)
+        lines = [header]
+        for name, j in [*rep['sources'].items(), ('total', rep['total'])]:
+            vps = j['visits_per_sec']
+            svps = '-' if vps is None else f'{vps:.0f}'
+            stages = ' '.join(f'{j["seconds"].get(s, 0.0):>7.2f}s' for s in STAGES)
+            lines.append(f'{name:<20} {j["visits"]:>9} {j["errors"]:>6} {svps:>9}  {stages}')
+        rss = rep['total']['peak_rss_bytes']
+        lines.append(f'wall time: {rep["wall_seconds"]:.2f}s, peak RSS: ' + ('n/a' if rss is None else f'{rss / 2**20:.0f}MB'))
+        return lines
+
+    def write(self, path: Path) -> None:
+        path.write_text(json.dumps(self.report(), indent=2, ensure_ascii=False))
+
+
+perf = PerfStats()
@@ -21,6 +21,7 @@ from sqlalchemy import (
     exc,
     func,
     literal,
+    literal_column,
     or_,
     select,
     types,
@@ -28,7 +29,7 @@ from sqlalchemy import (
 from sqlalchemy.sql import text
 from sqlalchemy.sql.elements import ColumnElement
 
-from .cannon import canonify
+from .cannon import DEFAULT_CACHE_SIZE, canonify_cache, canonify_cached, canonify_many
 from .common import (
     DbVisit,
     PathWithMtime,
@@ -36,7 +37,9 @@ from .common import (
     get_system_tz,
     setup_logger,
 )
+from .database.compression import searchable_context
 from .database.load import DbStuff, get_db_stuff, row_to_db_visit
+from .database.migrations import EPOCH_FROM_DT
 
 Json = dict[str, Any]
 
@@ -68,19 +71,25 @@ def get_version() -> str:
 class ServerConfig(NamedTuple):
     db: Path
     timezone: ZoneInfo
+    canonify_cache_size: int = DEFAULT_CACHE_SIZE
 
     def as_str(self) -> str:
         return json.dumps(
             {
                 'timezone': self.timezone.key,
                 'db': str(self.db),
+                'canonify_cache_size': self.canonify_cache_size,
             }
         )
 
     @classmethod
     def from_str(cls, cfgs: str) -> ServerConfig:
         d = json.loads(cfgs)
-        return cls(db=Path(d['db']), timezone=ZoneInfo(d['timezone']))
+        return cls(
+            db=Path(d['db']),
+            timezone=ZoneInfo(d['timezone']),
+            canonify_cache_size=d.get('canonify_cache_size', DEFAULT_CACHE_SIZE),
+        )
 
 
 class EnvConfig:
@@ -92,7 +101,10 @@ class EnvConfig:
     def get() -> ServerConfig:
         cfgs = os.environ.get(EnvConfig.KEY)
         assert cfgs is not None
-        return ServerConfig.from_str(cfgs)
+        cfg = ServerConfig.from_str(cfgs)
+        # it's only called once per process (see lru_cache), so a good place to set up the cache
+        canonify_cache.resize(cfg.canonify_cache_size)
+        return cfg
 
     @staticmethod
     def set(cfg: ServerConfig) -> None:
@@ -149,9 +161,16 @@ def get_stuff(db_path: Path | None = None) -> DbStuff:  # TODO better name
 
 def db_stats(db_path: Path) -> Json:
     engine, table = get_stuff(db_path)
-    query = select(func.count()).select_from(table)
+    # maintained by the indexer, so doesn't need to scan all visits (this is called by the extension quite often)
+    query = text('SELECT COALESCE(SUM(visits), 0) FROM source_stats')
     with engine.connect() as conn:
-        [(total,)] = conn.execute(query)
+        try:
+            [(total,)] = conn.execute(query)
+        except exc.OperationalError as e:
+            if 'no such table: source_stats' not in str(e):
+                raise e
+            # database created by an older version, so need a full scan until it's reindexed (see migrations)
+            [(total,)] = conn.execute(select(func.count()).select_from(table))
     return {
         'total_visits': total,
     }
@@ -173,7 +192,7 @@ def search_common(url: str, where: Where) -> VisitsResponse:
     config = EnvConfig.get()
 
     original_url = url and url.strip()
-    url = canonify(original_url)
+    url = canonify_cached(original_url)
     if not url:  # Don't eliminate a "#tag" query.
         url = original_url
     logger.debug(f'normalised url {original_url!r} to {url!r}')
@@ -289,7 +308,7 @@ def search(request: SearchRequest, fastapi_request: fastapi.Request) -> VisitsRe
             # todo hmm. think about it, not sure if I need proper indexer for fuzzy search etc?
             table.c.norm_url     .contains(url, autoescape=True),
             table.c.orig_url     .contains(url, autoescape=True),
-            table.c.context      .contains(url, autoescape=True),
+            searchable_context(table.c.context).contains(url, autoescape=True),
             table.c.locator_title.contains(url, autoescape=True),
         ),
     )  # fmt: skip
@@ -313,22 +332,13 @@ def search_around(request: SearchAroundRequest, fastapi_request: fastapi.Request
 
     return search_common(
         url='http://dummy.org',  # NOTE: not used in the where query (below).. perhaps need to get rid of this
+        # NOTE: epoch is UTC, so it's tz aware, e.g. would distinguish +05:00 vs -03:00
+        # it's indexed, so this is a range query rather than a full scan
         where=lambda table, url: between(  # noqa: ARG005
-            func.strftime(
-                '%s',  # NOTE: it's tz aware, e.g. would distinguish +05:00 vs -03:00
-                # this is a bit fragile, relies on cachew internal timestamp format, e.g.
-                # 2020-11-10T06:13:03.196376+00:00 Europe/London
-                func.substr(
-                    table.c.dt,
-                    1,  # substr is 1-indexed
-                    # instr finds the first match, but if not found it defaults to 0.. which we hack by concatting with ' '
-                    func.instr(func.cast(table.c.dt, types.Unicode).op('||')(' '), ' ') - 1,
-                    # for fucks sake.. seems that cast is necessary otherwise it tries to treat ' ' as datetime???
-                ),
-            )
-            - literal(utc_timestamp),
-            literal(-delta_back),
-            literal(delta_front),
+            # might be missing in a database created by an older version, then it's a full scan until it's reindexed
+            table.c.epoch if 'epoch' in table.c else literal_column(EPOCH_FROM_DT),
+            literal(utc_timestamp - delta_back),
+            literal(utc_timestamp + delta_front),
         ),
     )
 
@@ -373,8 +383,15 @@ def visited(request: VisitedRequest, fastapi_request: fastapi.Request) -> Visite
 
     _version = as_version(client_version)  # todo use it?
 
-    nurls = [canonify(u) for u in urls]
-    snurls = sorted(set(nurls))
+    nurls: list[str | None] = []
+    for u, cu in zip(urls, canonify_many(urls, cache=canonify_cache), strict=True):
+        if isinstance(cu, Exception):
+            # no need to fail the whole request because of a single weird url
+            get_logger().error('error while canonifying %s: %r', u, cu)
+            nurls.append(None)
+        else:
+            nurls.append(cu)
+    snurls = sorted({nu for nu in nurls if nu is not None})
 
     if len(snurls) == 0:
         return []
@@ -414,7 +431,7 @@ SELECT queried, visits.*
         present: dict[str, Any] = {row[0]: row_to_db_visit(row[1:]) for row in res}
     results = []
     for nu in nurls:
-        r = present.get(nu)
+        r = None if nu is None else present.get(nu)
         results.append(None if r is None else as_json(r))
 
     # no need for it anymore, extension has been updated since
@@ -446,6 +463,7 @@ def run(args: argparse.Namespace) -> None:
         config=ServerConfig(
             db=args.db,
             timezone=args.timezone,
+            canonify_cache_size=args.canonify_cache_size,
         ),
     )
 
@@ -492,3 +510,10 @@ def setup_parser(p: argparse.ArgumentParser) -> None:
         default=get_system_tz(),
         help='Fallback timezone, defaults to the system timezone if not specified',
     )
+
+    p.add_argument(
+        '--canonify-cache-size',
+        type=int,
+        default=DEFAULT_CACHE_SIZE,
+        help='Max number of canonified URLs cached in memory, 0 disables it (same as CANONIFY_CACHE_SIZE for indexing)',
+    )
@@ -0,0 +1,331 @@
+'''
+Benchmark for cannon.canonify over a generated corpus of realistic URLs.
+
+Reports URLs/sec overall, per URL category and per canonify branch,
+and can dump the results as JSON to compare across commits, e.g.
+
+    python3 -m promnesia.tests.cannon_bench --output before.json
+    git checkout ...
+    python3 -m promnesia.tests.cannon_bench --output after.json --compare before.json
+'''
+
+from __future__ import annotations
+
+import argparse
+import json
+import random
+import subprocess
+import sys
+from collections import defaultdict
+from collections.abc import Callable, Sequence
+from datetime import UTC, datetime
+from pathlib import Path
+from timeit import default_timer as timer
+from typing import Any, NamedTuple
+from urllib.parse import quote, urlsplit
+
+from ..cannon import (
+    _canonify_simple,
+    _compiled_rules,
+    _def_spec,
+    _prenormalise,
+    canonify,
+    canonify_domain,
+    get_compiled_spec,
+    get_spec2,
+    handle_archive_org,
+)
+
+Json = dict[str, Any]
+
+
+class Sample(NamedTuple):
+    category: str
+    url: str
+
+
+_WORDS = [
+    'python', 'rust', 'memory', 'index', 'search', 'history', 'notes', 'browser', 'extension', 'canonical',
+    'sqlite', 'performance', 'weekly', 'review', 'how-to', 'guide', 'release', 'announcement', 'paper', 'thread',
+]  # fmt: skip
+_HOSTS = [
+    'example.com', 'www.gwern.net', 'blog.acolyer.org', 'lwn.net', 'www.theguardian.com', 'arstechnica.com',
+    'en.wikipedia.org', 'docs.python.org', 'stackoverflow.com', 'www.lesswrong.com', 'amp.theguardian.com',
+]  # fmt: skip
+_UNICODE = ['ü', 'é', '–', 'ß', 'я', '中文']
+
+
+def _id(rnd: random.Random, n: int = 11) -> str:
+    return ''.join(rnd.choice('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_-') for _ in range(n))
+
+
+def _slug(rnd: random.Random) -> str:
+    return '-'.join(rnd.choice(_WORDS) for _ in range(rnd.randint(1, 5)))
+
+
+def _path(rnd: random.Random) -> str:
+    return '/' + '/'.join(_slug(rnd) for _ in range(rnd.randint(0, 4)))
+
+
+def _query(rnd: random.Random, count: int) -> str:
+    junk = ['utm_source', 'utm_medium', 'utm_campaign', 'ref', 'fbclid', 'gclid', 'session', 'lang', 'page', 'id']
+    return '&'.join(f'{rnd.choice(junk)}{i}={_id(rnd, rnd.randint(2, 30))}' for i in range(count))
+
+
+def _simple(rnd: random.Random) -> str:
+    return f'https://{rnd.choice(_HOSTS)}{_path(rnd)}' + rnd.choice(['', '/', '.html'])
+
+
+def _long_query(rnd: random.Random) -> str:
+    return f'https://{rnd.choice(_HOSTS)}{_path(rnd)}?{_query(rnd, rnd.randint(3, 15))}'
+
+
+def _encoded(rnd: random.Random) -> str:
+    parts = [rnd.choice(_WORDS) + rnd.choice(_UNICODE) for _ in range(rnd.randint(1, 3))]
+    path = '/'.join(quote(p) if rnd.random() < 0.5 else p.replace('-', '+') for p in parts)
+    return f'https://{rnd.choice(_HOSTS)}/{path}'
+
+
+def _youtube(rnd: random.Random) -> str:
+    v = _id(rnd)
+    return rnd.choice([
+        f'https://www.youtube.com/watch?v={v}',
+        f'https://www.youtube.com/watch?v={v}&t={rnd.randint(1, 3000)}s&list=WL&index={rnd.randint(1, 100)}',
+        f'https://m.youtube.com/watch?feature=share&v={v}&time_continue=6',
+        f'https://youtu.be/{v}?list=PL{_id(rnd, 20)}',
+        f'https://www.youtube.com/embed/{v}?feature=oembed&autoplay=1',
+        f'https://www.youtube.com/channel/UC{_id(rnd, 22)}/videos',
+    ])  # fmt: skip
+
+
+def _twitter(rnd: random.Random) -> str:
+    user = _id(rnd, rnd.randint(4, 15))
+    return rnd.choice([
+        f'https://twitter.com/{user}/status/{rnd.randint(10**17, 10**18)}',
+        f'https://mobile.twitter.com/{user}/status/{rnd.randint(10**17, 10**18)}?s=20&t={_id(rnd, 22)}',
+        'https://twitter.com/home',
+        'https://twitter.com/explore',
+        f'https://nitter.net/{user}',
+    ])  # fmt: skip
+
+
+def _reddit(rnd: random.Random) -> str:
+    sub = rnd.choice(['python', 'rust', 'selfhosted', 'datahoarder', 'emacs'])
+    post = _id(rnd, 6).lower()
+    title = _slug(rnd).replace('-', '_')
+    return rnd.choice([
+        f'https://www.reddit.com/r/{sub}/comments/{post}/{title}/',
+        f'https://old.reddit.com/r/{sub}/comments/{post}/{title}/{_id(rnd, 7).lower()}/?context=3',
+        f'https://www.reddit.com/r/{sub}/comments/{post}/{title}/?utm_source=share&utm_medium=web2x&context=3',
+        f'https://np.reddit.com/r/{sub}/',
+    ])  # fmt: skip
+
+
+def _archive_org(rnd: random.Random) -> str:
+    ts = rnd.randint(2005_0101000000, 2023_1231235959)
+    inner = rnd.choice([_simple, _long_query, _reddit])(rnd)
+    return f'https://web.archive.org/web/{ts}/{inner}'
+
+
+def _google_amp(rnd: random.Random) -> str:
+    inner = _simple(rnd).removeprefix('https://')
+    return f'https://www.google.{rnd.choice(["com", "co.uk", "de"])}/amp/s/{inner}'
+
+
+def _google_redirect(rnd: random.Random) -> str:
+    target = quote(_long_query(rnd), safe='')
+    return f'https://www.google.com/url?q={target}&sa=D&source=editors&ust={rnd.randint(10**15, 10**16)}&usg={_id(rnd, 28)}'
+
+
+def _facebook(rnd: random.Random) -> str:
+    fbid = rnd.randint(10**15, 10**16)
+    return rnd.choice([
+        f'https://www.facebook.com/photo.php?fbid={fbid}&set=pcb.{fbid}&type=3&theater',
+        f'https://m.facebook.com/story.php?story_fbid={fbid}&id={rnd.randint(10**8, 10**9)}&ref=bookmarks',
+        f'https://www.facebook.com/{_id(rnd, 10)}/posts/{fbid}?comment_id={fbid}&notif_id={fbid}&notif_t=comment',
+    ])  # fmt: skip
+
+
+def _hackernews(rnd: random.Random) -> str:
+    return rnd.choice([
+        f'https://news.ycombinator.com/item?id={rnd.randint(10**7, 4 * 10**7)}',
+        f'https://news.ycombinator.com/from?site={rnd.choice(_HOSTS)}',
+    ])  # fmt: skip
+
+
+def _github(rnd: random.Random) -> str:
+    repo = f'{_id(rnd, 8)}/{rnd.choice(_WORDS)}'
+    return rnd.choice([
+        f'https://github.com/{repo}',
+        f'https://github.com/{repo}/issues?q=is%3Aissue+is%3Aopen+{rnd.choice(_WORDS)}&utf8=%E2%9C%93',
+        f'https://github.com/{repo}/blob/master/src/{rnd.choice(_WORDS)}.py#L{rnd.randint(1, 500)}',
+        f'https://github.com/search?o=desc&q={rnd.choice(_WORDS)}&s=stars&type=Repositories',
+    ])  # fmt: skip
+
+
+# category -> (generator, weight)
+# weights roughly follow what a typical browser history looks like
+CATEGORIES: dict[str, tuple[Callable[[random.Random], str], int]] = {
+    'simple'         : (_simple         , 30),
+    'long_query'     : (_long_query     , 15),
+    'encoded_path'   : (_encoded        ,  5),
+    'youtube'        : (_youtube        , 10),
+    'twitter'        : (_twitter        ,  8),
+    'reddit'         : (_reddit         ,  8),
+    'archive.org'    : (_archive_org    ,  3),
+    'google_amp'     : (_google_amp     ,  3),
+    'google_redirect': (_google_redirect,  6),
+    'facebook'       : (_facebook       ,  4),
+    'hackernews'     : (_hackernews     ,  3),
+    'github'         : (_github         ,  5),
+}  # fmt: skip
+
+
+def corpus(count: int, *, seed: int = 0) -> list[Sample]:
+    '''
+    Deterministic (for the same seed) corpus of realistic looking URLs
+    '''
+    rnd = random.Random(seed)
+    names = list(CATEGORIES)
+    weights = [w for _, w in CATEGORIES.values()]
+    res = []
+    for category in rnd.choices(names, weights=weights, k=count):
+        gen, _ = CATEGORIES[category]
+        res.append(Sample(category=category, url=gen(rnd)))
+    return res
+
+
+def branch(url: str) -> str:
+    '''
+    Which code path canonify takes for this url (roughly)
+    '''
+    if _canonify_simple(url) is not None:
+        return 'fast_path'
+    try:
+        purl = _prenormalise(url)
+        parts = urlsplit(purl)
+        if parts.scheme == '':
+            parts = urlsplit('http://' + purl)
+    except Exception:
+        return 'error'
+    if handle_archive_org(parts.netloc + parts.path + parts.query + parts.fragment) is not None:
+        return 'archive.org'
+    domain = canonify_domain(parts.netloc)
+    if domain in _compiled_rules:
+        return 'transform_rule'
+    if get_spec2(domain) is not None:
+        return 'spec2'
+    if get_compiled_spec(domain).spec is not _def_spec:
+        return 'domain_spec'
+    return 'default_spec'
+
+
+def _time(urls: Sequence[str], *, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = timer()
+        for url in urls:
+            try:
+                canonify(url)
+            except Exception:
+                pass
+        best = min(best, timer() - start)
+    return best
+
+
+def _stats(urls: Sequence[str], *, repeat: int) -> Json:
+    secs = _time(urls, repeat=repeat)
+    return {
+        'count': len(urls),
+        'seconds': secs,
+        'urls_per_sec': len(urls) / secs if secs > 0 else None,
+        'us_per_url': secs / len(urls) * 10**6 if len(urls) > 0 else None,
+    }
+
+
+def _git_commit() -> str | None:
+    try:
+        res = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=Path(__file__).parent, capture_output=True, text=True, check=True
+        )
+    except Exception:
+        return None
+    return res.stdout.strip()
+
+
+def run(*, count: int, repeat: int = 3, seed: int = 0) -> Json:
+    samples = corpus(count, seed=seed)
+
+    by_category: dict[str, list[str]] = defaultdict(list)
+    by_branch: dict[str, list[str]] = defaultdict(list)
+    for s in samples:
+        by_category[s.category].append(s.url)
+        by_branch[branch(s.url)].append(s.url)
+
+    return {
+        'timestamp': datetime.now(tz=UTC).isoformat(),
+        'commit': _git_commit(),
+        'python': sys.version,
+        'count': count,
+        'seed': seed,
+        'total': _stats([s.url for s in samples], repeat=repeat),
+        'by_category': {k: _stats(v, repeat=repeat) for k, v in sorted(by_category.items())},
+        'by_branch': {k: _stats(v, repeat=repeat) for k, v in sorted(by_branch.items())},
+    }
+
+
+def _fmt(x: float | None) -> str:
+    return '-' if x is None else f'{x:,.0f}'
+
+
+def report(res: Json, baseline: Json | None = None) -> str:
+    lines = []
+
+    def row(name: str, cur: Json, old: Json | None) -> None:
+        line = f'{name:<20} {cur["count"]:>9} {_fmt(cur["urls_per_sec"]):>12} urls/sec'
+        if old is not None and old.get('urls_per_sec') and cur['urls_per_sec']:
+            ratio = cur['urls_per_sec'] / old['urls_per_sec']
+            line += f'   (was {_fmt(old["urls_per_sec"])}, x{ratio:.2f})'
+        lines.append(line)
+
+    def section(key: str) -> None:
+        lines.append(f'--- {key}')
+        old = {} if baseline is None else baseline.get(key, {})
+        for name, cur in res[key].items():
+            row(name, cur, old.get(name))
+
+    row('total', res['total'], None if baseline is None else baseline.get('total'))
+    section('by_category')
+    section('by_branch')
+    return '\n'.join(lines)
+
+
+def main() -> None:
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument('--count', type=int, default=100_000, help='Number of URLs in the corpus')
+    p.add_argument('--repeat', type=int, default=3, help='Number of runs (the fastest one is reported)')
+    p.add_argument('--seed', type=int, default=0, help='Seed for the corpus generator')
+    p.add_argument('--output', type=Path, help='Write results to this JSON file')
+    p.add_argument('--compare', type=Path, help='JSON file with results of a previous run to compare against')
+    args = p.parse_args()
+
+    res = run(count=args.count, repeat=args.repeat, seed=args.seed)
+    baseline = None if args.compare is None else json.loads(args.compare.read_text())
+    print(report(res, baseline))
+    if args.output is not None:
+        args.output.write_text(json.dumps(res, indent=2))
+
+
+def test_run() -> None:
+    res = run(count=1000, repeat=1)
+    assert res['total']['count'] == 1000
+    assert set(res['by_category']) == set(CATEGORIES)
+    assert sum(x['count'] for x in res['by_branch'].values()) == 1000
+    # make sure the corpus exercises all the interesting branches
+    assert {'fast_path', 'archive.org', 'transform_rule', 'spec2', 'domain_spec', 'default_spec'} <= set(res['by_branch'])
+    json.dumps(res)  # should be serializable
+    report(res, baseline=res)
+
+
+if __name__ == '__main__':
+    main()
@@ -43,6 +43,9 @@ def gc_control(*, gc_on: bool):
 
 running_on_ci = 'CI' in os.environ
 
+# large cases of some benchmarks take minutes (times the number of modes), so they only run on request
+run_benchmarks = 'PROMNESIA_BENCHMARKS' in os.environ
+
 
 GIT_ROOT = Path(__file__).absolute().parent.parent.parent.parent
 TESTDATA = GIT_ROOT / 'tests/testdata'
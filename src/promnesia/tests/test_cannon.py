@@ -1,8 +1,32 @@
+import random
+from collections.abc import Callable, Iterable, Iterator
+from pathlib import Path
 from typing import cast
 
 import pytest
 
-from ..cannon import CanonifyException, canonify
+from ..cannon import (
+    CacheStats,
+    CanonifyCache,
+    CanonifyException,
+    CanonifyStore,
+    DomainTrie,
+    PatternIndex,
+    Spec,
+    _canonify_full,
+    _canonify_simple,
+    analyse,
+    analyse_stream,
+    canonify,
+    canonify_many,
+    get_compiled_spec,
+    get_patterns,
+    get_spec,
+    rules_fingerprint,
+    specs,
+)
+from .cannon_bench import corpus
+from .common import running_on_ci
 
 # TODO should actually understand 'sequences'?
 # e.g.
@@ -340,3 +364,308 @@ def test_empty_query_parameter(url, expected):
 )
 def test_qkeep_true(url, expected):
     assert canonify(url) == expected
+
+
+def test_cache() -> None:
+    cache = CanonifyCache(maxsize=2)
+
+    assert cache.canonify('https://www.youtube.com/watch?v=1NHbPN9pNPM&index=63') == 'youtube.com/watch?v=1NHbPN9pNPM'
+    assert cache.canonify('https://www.youtube.com/watch?v=1NHbPN9pNPM&index=63') == 'youtube.com/watch?v=1NHbPN9pNPM'
+    assert cache.stats() == CacheStats(hits=1, misses=1, evictions=0, size=1, maxsize=2)
+
+    cache.canonify('https://example.com/a')
+    cache.canonify('https://example.com/b')  # should evict the least recently used, i.e. youtube
+    assert cache.stats() == CacheStats(hits=1, misses=3, evictions=1, size=2, maxsize=2)
+
+    cache.canonify('https://example.com/a')
+    assert cache.stats().hits == 2
+
+    # errors aren't cached
+    for _ in range(2):
+        with pytest.raises(CanonifyException):
+            cache.canonify('https://example.com\uff03@bing.com')
+    assert cache.stats().misses == 5
+
+    cache.resize(1)
+    assert cache.stats() == CacheStats(hits=2, misses=5, evictions=2, size=1, maxsize=1)
+
+    disabled = CanonifyCache(maxsize=0)
+    disabled.canonify('https://example.com/a')
+    disabled.canonify('https://example.com/a')
+    assert disabled.stats() == CacheStats(hits=0, misses=2, evictions=0, size=0, maxsize=0)
+
+
+_BENCHMARK_TEMPLATES = (
+    'https://youtu.be/video{i}?list=WL',
+    'https://www.youtube.com/embed/video{i}?feature=oembed',
+    'https://www.youtube.com/watch?v=video{i}&t=491s&index=63&list=WL',
+    'https://mobile.twitter.com/user{i}/status/{i}',
+    'https://twitter.com/home',
+    'https://google.co.uk/amp/s/amp.reddit.com/r/sub/comments/{i}/title',
+    'https://web.archive.org/web/20090902224414/http://reason.com/news/show/{i}.html',
+    'https://www.reddit.com/r/sub/comments/{i}/title/?utm_source=share&utm_medium=web2x',
+    'https://en.wikipedia.org/wiki/Page_{i}',
+    'https://example.com/some/path/{i}.html',
+)
+
+
+def _benchmark_urls(count: int) -> Iterator[str]:
+    for i in range(count):
+        yield _BENCHMARK_TEMPLATES[i % len(_BENCHMARK_TEMPLATES)].format(i=i)
+
+
+@pytest.mark.parametrize('count', [99, 100_000, 1_000_000])
+def test_benchmark_canonify(count: int) -> None:
+    # see benchmarks/ directory for the results
+    if count > 99 and running_on_ci:
+        pytest.skip("test would be too slow on CI, only meant to run manually")
+
+    for url in _benchmark_urls(count):
+        canonify(url)
+
+
+def test_get_spec() -> None:
+    assert get_spec('youtube.com') is specs['youtube.com']
+    assert get_spec('music.youtube.com') is specs['youtube.com']
+    assert get_spec('en.m.wikipedia.org') is specs['wikipedia.org']
+    assert get_spec('play.google.com') is specs['play.google.com']
+    assert get_spec('google.com') == Spec()
+    assert get_spec('notyoutube.com') == Spec()
+    assert get_spec('') == Spec()
+
+    compiled = get_compiled_spec('youtube.com')
+    assert compiled.keep_query('v') is not None
+    assert compiled.keep_query('feature') is None  # explicitly removed
+    assert compiled.keep_query('whatever') is None  # removed by default
+    # order matters for youtube
+    assert compiled.keep_query('v') < compiled.keep_query('t') < compiled.keep_query('list')  # type: ignore[operator]
+    assert get_compiled_spec('isfdb.org').keep_query('whatever') == 1
+
+
+def test_domain_trie() -> None:
+    trie = DomainTrie([('example.com', 1), ('sub.example.org', 2)])
+    assert len(trie) == 2
+    assert trie.lookup('example.com') == 1
+    assert trie.lookup('a.b.example.com') == 1
+    assert trie.lookup('notexample.com') is None
+    assert trie.lookup('com') is None
+    assert trie.lookup('example.org') is None
+    assert trie.lookup('x.sub.example.org') == 2
+    assert 'sub.example.org' in trie
+    assert 'example.net' not in trie
+
+
+def test_canonify_many() -> None:
+    urls = [
+        'https://www.youtube.com/watch?v=1NHbPN9pNPM&index=63',
+        'https://example.com\uff03@bing.com',
+        'https://example.com/a/',
+        'https://www.youtube.com/watch?v=1NHbPN9pNPM&index=63',
+    ]
+    [r1, r2, r3, r4] = canonify_many(urls)
+    assert r1 == 'youtube.com/watch?v=1NHbPN9pNPM'
+    assert isinstance(r2, CanonifyException)
+    assert r3 == 'example.com/a'
+    assert r4 == r1
+
+    cache = CanonifyCache()
+    assert canonify_many(urls[2:], cache=cache) == [r3, r4]
+    # duplicates within the batch don't even hit the cache
+    assert cache.stats().misses == 2
+    assert cache.stats().hits == 0
+
+    assert canonify_many([]) == []
+
+
+def _canonify_or_error(f: Callable[[str], str], url: str) -> str | type[Exception]:
+    try:
+        return f(url)
+    except Exception as e:
+        return type(e)
+
+
+def _check_fast_path(urls: Iterable[str]) -> int:
+    fast = 0
+    for url in urls:
+        assert _canonify_or_error(canonify, url) == _canonify_or_error(_canonify_full, url), url
+        if _canonify_simple(url) is not None:
+            fast += 1
+    return fast
+
+
+def _test_case_urls() -> Iterator[str]:
+    for name, f in globals().items():
+        if not name.startswith('test'):
+            continue
+        for mark in getattr(f, 'pytestmark', []):
+            if mark.name != 'parametrize' or 'url' not in str(mark.args[0]):
+                continue
+            for case in mark.args[1]:
+                # cases are either (url, expected) or sets of urls
+                yield from (case if isinstance(case, set) else case[:1])
+
+
+def test_fast_path_cases() -> None:
+    urls = list(_test_case_urls())
+    assert len(urls) > 30  # sanity check
+    fast = _check_fast_path(urls)
+    assert fast > 0  # sanity check
+
+
+def test_fast_path_random() -> None:
+    rnd = random.Random(0)
+    schemes = ['', 'http://', 'https://', 'HTTPS://', 'ftp://', 'file://', 'chrome-extension://', 'mailto:', '//', 'http:/']
+    hosts = [
+        'example.com', 'www.example.com', 'amp.theguardian.com', 'EXAMPLE.com', 'm.youtube.com', 'youtu.be',
+        'www.youtube.com', 'twitter.com', 'mobile.twitter.com', 'news.ycombinator.com', 'web.archive.org',
+        'web-archive-org', 'getpocket.com', 'www.google.co.uk', 'en.wikipedia.org', 'www.', 'www', '.', '',
+        'localhost:8080', 'user@host.com', '[::1]', 'xn--80ak6aa92e.com', 'пример.рф', '192.168.0.1',
+    ]  # fmt: skip
+    segments = [
+        'page', 'Page_1', 'a-b', 'x.html', '~user', '', 'web', '20090902224414', 'amp', 's', 'embed', 'home',
+        'from', 'watch', 'a%20b', 'a+b', 'a b', 'ü', '%e2%80%93', 'http:', 'a&b', 'x?y=1', 'x#frag', '?', '#',
+        '&utm_source=x', 'Dinic%27s', '(beer)', '!', '*', ';', '@', ',', '\t', '\\',
+    ]  # fmt: skip
+    urls = []
+    for _ in range(100_000):
+        path = '/'.join(rnd.choice(segments) for _ in range(rnd.randint(0, 5)))
+        if rnd.random() < 0.9:
+            path = '/' + path
+        urls.append(rnd.choice(schemes) + rnd.choice(hosts) + path)
+    fast = _check_fast_path(urls)
+    assert fast > 1000  # sanity check, make sure the fast path is actually exercised
+
+
+def _linear_match(all_pats: dict[str, list[str]], nurl: str) -> tuple[str | None, str | None]:
+    # reference implementation: try every pattern in order
+    import re
+
+    usplit = nurl[: nurl.find('/')].split('.')
+    for dom, pats in all_pats.items():
+        dsplit = dom.split('.')
+        if any(usplit[i : i + len(dsplit)] == dsplit for i in range(len(usplit))):
+            return (dom, next((p for p in pats if re.fullmatch(p, nurl) is not None), None))
+    return (None, None)
+
+
+def test_pattern_index() -> None:
+    all_pats = get_patterns()
+    index = PatternIndex(all_pats)
+    urls = [s.url for s in corpus(3000)] + list(_test_case_urls())
+    matched = 0
+    for url in urls:
+        try:
+            nurl = canonify(url)
+        except CanonifyException:
+            continue
+        res = index.match(nurl)
+        assert res == _linear_match(all_pats, nurl), url
+        matched += res[1] is not None
+    assert matched > 100
+
+    group, pat = index.match('twitter.com/user/status/123')
+    assert group == 'twitter'
+    assert pat is not None
+    assert index.group('tweetdeck.twitter.com') == 'twitter'
+    assert index.match('nottwitter.com/user') == (None, None)
+
+
+def test_analyse_stream() -> None:
+    urls = [s.url for s in corpus(5000)] + ['https://example.com/%%%', 'http://[bad']
+    reports: list[int] = []
+    serial = analyse_stream(urls, shard_size=1000, report_every=2000, on_report=lambda a: reports.append(a.total))
+    assert serial.total == len(urls)
+    assert reports == [2000, 4000]
+    assert serial.domains['ERROR'] > 0
+    assert sum(serial.patterns.values()) > 0
+
+    parallel = analyse_stream(urls, shard_size=1000, jobs=2)
+    assert parallel.domains == serial.domains
+    assert parallel.patterns == serial.patterns
+    assert parallel.unmatched == serial.unmatched
+    assert parallel.unmatched_examples == serial.unmatched_examples
+
+    # same examples as without sharding, i.e. the first ones
+    whole = analyse(urls, examples=5)
+    sharded = analyse_stream(urls, shard_size=100, examples=5)
+    assert sharded.unmatched_examples == whole.unmatched_examples
+    assert len(sharded.unmatched_examples) == 5
+    assert sharded.error_examples == whole.error_examples
+
+
+def test_rules_fingerprint(monkeypatch: pytest.MonkeyPatch) -> None:
+    from .. import cannon
+
+    fp = rules_fingerprint()
+    rules_fingerprint.cache_clear()
+    assert rules_fingerprint() == fp  # deterministic
+
+    monkeypatch.setattr(cannon, 'default_qremove', {*cannon.default_qremove, 'fbclid'})
+    rules_fingerprint.cache_clear()
+    try:
+        assert rules_fingerprint() != fp
+    finally:
+        monkeypatch.undo()
+        rules_fingerprint.cache_clear()
+    assert rules_fingerprint() == fp
+
+
+def test_canonify_store(tmp_path: Path) -> None:
+    path = tmp_path / 'canonify.sqlite'
+    urls = [s.url for s in corpus(200)] + ['http://[bad']
+
+    store = CanonifyStore(path, fingerprint='v1')
+    assert not store.invalidated
+    cache = CanonifyCache()
+    cache.attach_store(store)
+    first = canonify_many(urls, cache=cache)
+    cache.attach_store(None)
+    store.close()
+    assert isinstance(first[-1], Exception)
+    nunique = len(set(urls)) - 1  # errors aren't cached
+
+    # fresh in-memory cache, everything should come from the store
+    store = CanonifyStore(path, fingerprint='v1')
+    assert len(store) == nunique
+    cache = CanonifyCache()
+    cache.attach_store(store)
+    second = canonify_many(urls, cache=cache)
+    assert [str(x) for x in second] == [str(x) for x in first]
+    assert cache.stats().store_hits == nunique
+    store.close()
+
+    # rules changed -- should get wiped
+    store = CanonifyStore(path, fingerprint='v2')
+    assert store.invalidated
+    assert len(store) == 0
+    assert store.get(urls[0]) is None
+    store.close()
+
+
+def test_canonify_store_locked(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    import sqlite3
+
+    monkeypatch.setattr(CanonifyStore, '_FLUSH_EVERY', 1)
+    monkeypatch.setattr(CanonifyStore, '_BUSY_TIMEOUT', 0.01)
+    path = tmp_path / 'canonify.sqlite'
+    store = CanonifyStore(path, fingerprint='v1')
+    cache = CanonifyCache()
+    cache.attach_store(store)
+
+    # e.g. another worker process holding the write lock for too long
+    other = sqlite3.connect(path, isolation_level=None)
+    other.execute('BEGIN IMMEDIATE')
+    # it's just a cache, so shouldn't fail canonification
+    assert canonify_many(['https://example.com/page'], cache=cache) == ['example.com/page']
+    # opening does fail though (worker processes fall back to no store then)
+    with pytest.raises(sqlite3.OperationalError, match='locked'):
+        CanonifyStore(path, fingerprint='v1')
+    other.execute('ROLLBACK')
+    other.close()
+
+    # the write was dropped, but the store keeps working
+    assert len(store) == 0
+    assert cache.canonify('https://example.com/other') == 'example.com/other'
+    assert len(store) == 1
+    cache.attach_store(None)
+    store.close()
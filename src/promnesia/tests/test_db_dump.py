@@ -1,9 +1,11 @@
 from __future__ import annotations
 
+from collections import Counter
 from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
 from tempfile import TemporaryDirectory
+from threading import Event, Thread
 from typing import Any, cast
 from zoneinfo import ZoneInfo
 
@@ -13,13 +15,13 @@ from hypothesis import given, settings
 from hypothesis.strategies import from_type
 
 from ..common import Loc
-from ..database.common import DbVisit
-from ..database.dump import visits_to_sqlite
-from ..database.load import get_all_db_visits
+from ..database.common import DbVisit, db_visit_to_row
+from ..database.dump import get_source_fingerprints, visits_to_sqlite
+from ..database.load import get_all_db_visits, get_db_stuff
 from ..sqlite import sqlite_connection
 from .common import (
     gc_control,  # noqa: F401
-    running_on_ci,
+    run_benchmarks,
 )
 
 HSETTINGS = cast(
@@ -80,6 +82,8 @@ def test_one_visit(tmp_path: Path) -> None:
         'norm_url': 'google.com',
         'orig_url': 'https://google.com',
         'src': 'whatever',
+        'epoch': 1699999861,
+        'row_hash': db_visit_to_row(visit)[-1],
     }
 
     visits_in_db = get_all_db_visits(db)
@@ -133,6 +137,42 @@ INSERT INTO visits VALUES(
     )
 
 
+def test_epoch_migration(tmp_path: Path) -> None:
+    """
+    Databases created before the epoch column get it backfilled from dt on the next indexing
+    """
+    db = tmp_path / 'db.sqlite'
+    with sqlite_connection(db) as conn:
+        conn.execute('CREATE TABLE visits (norm_url, orig_url, dt, locator_title, locator_href, src, context, duration)')
+        conn.executemany(
+            'INSERT INTO visits VALUES (?, ?, ?, NULL, NULL, NULL, NULL, NULL)',
+            [
+                ('a.com', 'https://a.com', '2019-04-13T11:55:09-04:00 America/New_York'),
+                ('b.com', 'https://b.com', '2023-11-14T23:11:01.123456+01:00'),
+                ('c.com', 'https://c.com', '2023-11-14T23:11:01'),  # naive
+            ],
+        )
+
+    # reading (e.g. by the server) doesn't migrate, since it might need to rewrite all visits
+    visits = get_all_db_visits(db)
+    assert len(visits) == 3
+    with sqlite_connection(db) as conn:
+        columns = [name for (_, name, *_) in conn.execute('PRAGMA table_info(visits)')]
+    assert 'epoch' not in columns
+
+    errors = visits_to_sqlite([make_testvisit(1)._replace(src='new')], overwrite_db=False, _db_path=db)
+    assert len(errors) == 0
+    assert len(get_all_db_visits(db)) == 4
+
+    with sqlite_connection(db) as conn:
+        epochs = [epoch for (epoch,) in conn.execute("SELECT epoch FROM visits WHERE src IS NULL")]
+        indexes = {name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    # same as what db_visit_to_row would produce for new visits
+    assert epochs == [db_visit_to_row(v)[-2] for v in visits]
+    assert epochs == [1555170909, 1699999861, 1700003461]
+    assert 'index_epoch' in indexes
+
+
 def _test_random_visit_aux(visit: DbVisit, tmp_path: Path) -> None:
     db = tmp_path / 'db.sqlite'
     errors = visits_to_sqlite(
@@ -173,23 +213,36 @@ def make_testvisit(i: int) -> DbVisit:
     )
 
 
+_DUMP_MODES: dict[str, dict[str, Any]] = {
+    'inline': {'writer_thread': False, 'bulk': False},
+    'writer_thread': {'writer_thread': True, 'bulk': False},
+    'bulk': {'writer_thread': False, 'bulk': True},
+}
+
+
+@pytest.mark.parametrize('mode', _DUMP_MODES.keys())
 @pytest.mark.parametrize('count', [99, 100_000, 1_000_000])
 @pytest.mark.parametrize('gc_on', [True, False], ids=['gc_on', 'gc_off'])
-def test_benchmark_visits_dumping(count: int, gc_control, tmp_path: Path) -> None:
+def test_benchmark_visits_dumping(count: int, gc_control, tmp_path: Path, mode: str) -> None:
     # [20231212] testing differernt CHUNK_BY values with 1_000_000 visits on @karlicoss desktop pc
     # 1: 25s (perhaps most overhead is from temporary lists?)
     # 10 (current default): 8s
     # 100: 6s
     # 1000: 6s
     # TODO maybe consider changing default to 100?
-    if count > 99 and running_on_ci:
-        pytest.skip("test would be too slow on CI, only meant to run manually")
+    if count > 99 and not run_benchmarks:
+        pytest.skip("test would be too slow, only meant to run manually (set PROMNESIA_BENCHMARKS=1)")
 
-    visits = (make_testvisit(i) for i in range(count))
     db = tmp_path / 'db.sqlite'
+    # populate first, so it's a proper rebuild of the database with indexes
+    _populate_db(db, overwrite_db=True, count=count)
+    get_db_stuff(db)[0].dispose()  # creates indexes
+
+    visits = (make_testvisit(i) for i in range(count))
     errors = visits_to_sqlite(  # TODO maybe this method should return db stats? would make testing easier
         vit=visits,
         overwrite_db=True,
+        **_DUMP_MODES[mode],
         _db_path=db,
     )
     assert db.exists()
@@ -202,6 +255,446 @@ def _populate_db(db_path: Path, *, overwrite_db: bool, count: int) -> None:
     assert len(errors) == 0
 
 
+@pytest.mark.parametrize('writer_thread', [False, True], ids=['inline', 'writer_thread'])
+@pytest.mark.parametrize('crash', ['extraction', 'insert'])
+def test_crash_while_dumping(tmp_path: Path, crash: str, *, writer_thread: bool) -> None:
+    db_path = tmp_path / 'db.sqlite'
+    _populate_db(db_path, overwrite_db=True, count=10)
+
+    def visits():
+        for i in range(5000):
+            if i == 3456:
+                if crash == 'extraction':
+                    raise KeyboardInterrupt
+                yield make_testvisit(i)._replace(duration=2**100)  # too big for sqlite
+            yield make_testvisit(i)._replace(src=f'src{i % 3}')
+
+    with pytest.raises(KeyboardInterrupt if crash == 'extraction' else OverflowError):
+        visits_to_sqlite(visits(), overwrite_db=True, writer_thread=writer_thread, _db_path=db_path)
+
+    # should be rolled back completely
+    assert get_all_db_visits(db_path) == [make_testvisit(i) for i in range(10)]
+
+
+@pytest.mark.parametrize('overwrite_db', [True, False], ids=['overwrite', 'update'])
+def test_bulk(tmp_path: Path, *, overwrite_db: bool) -> None:
+    db_path = tmp_path / 'db.sqlite'
+    _populate_db(db_path, overwrite_db=True, count=10)
+
+    def indexes() -> list[str]:
+        with sqlite_connection(db_path) as conn:
+            return [name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'visits'")]
+
+    get_db_stuff(db_path)[0].dispose()
+    assert indexes() == ['index_norm_url', 'index_epoch', 'index_src_hash']
+
+    visits = [make_testvisit(i)._replace(src=f'src{i % 3}', norm_url=f'google.com/{(i * 7919) % 50_000}') for i in range(50_000)]
+    errors = visits_to_sqlite(visits, overwrite_db=overwrite_db, bulk=True, _db_path=db_path)
+    assert len(errors) == 0
+
+    # should be rebuilt in the end
+    assert indexes() == ['index_norm_url', 'index_epoch', 'index_src_hash']
+
+    in_db = get_all_db_visits(db_path)
+    expected = visits if overwrite_db else [*(make_testvisit(i) for i in range(10)), *visits]
+    assert sorted(in_db, key=_key) == sorted(expected, key=_key)
+
+
+def _key(v: DbVisit):
+    return (v.src, v.norm_url, v.dt)
+
+
+@pytest.mark.parametrize('normalized', [False, True], ids=['flat', 'normalized'])
+@pytest.mark.parametrize('overwrite_db', [True, False], ids=['overwrite', 'update'])
+def test_incremental(tmp_path: Path, *, overwrite_db: bool, normalized: bool) -> None:
+    db_path = tmp_path / 'db.sqlite'
+    rows_table = 'visit_rows' if normalized else 'visits'
+
+    def dump(vis: list[DbVisit]) -> None:
+        errors = visits_to_sqlite(
+            vis, overwrite_db=overwrite_db, incremental=True, bulk=False, normalized=normalized, _db_path=db_path
+        )
+        assert len(errors) == 0
+
+    def rowids() -> dict[str, int]:
+        with sqlite_connection(db_path) as conn:
+            return {url: rowid for (rowid, url) in conn.execute(f'SELECT rowid, norm_url FROM {rows_table}')}
+
+    a = [make_testvisit(i)._replace(src='a') for i in range(3000)]
+    # exact duplicates
+    dups = [make_testvisit(5000)._replace(src='a')] * 3
+    b = [make_testvisit(i)._replace(src='b') for i in range(10000, 10010)]
+    dump([*a, *dups, *b])
+    before = rowids()
+
+    a2 = [*a[:2000], *(make_testvisit(i)._replace(src='a') for i in range(20000, 20005))]
+    dups2 = dups[:2]
+    dump([*a2, *dups2])
+    expected = [*a2, *dups2] if overwrite_db else [*a2, *dups2, *b]
+    assert sorted(get_all_db_visits(db_path), key=_key) == sorted(expected, key=_key)
+
+    # unchanged visits weren't rewritten
+    after = rowids()
+    assert all(after[v.norm_url] == before[v.norm_url] for v in a2[:2000])
+
+    # visits indexed by older versions (without row_hash) are replaced
+    with sqlite_connection(db_path) as conn:
+        conn.execute(f'UPDATE {rows_table} SET row_hash = NULL')
+    dump([*a2, *dups2])
+    assert sorted(get_all_db_visits(db_path), key=_key) == sorted(expected, key=_key)
+
+
+@pytest.mark.parametrize('mode', ['update', 'incremental', 'overwrite', 'normalized'])
+def test_source_stats(tmp_path: Path, mode: str) -> None:
+    db_path = tmp_path / 'db.sqlite'
+    kwargs: dict[str, Any] = {
+        'update': {'overwrite_db': False, 'incremental': False},
+        'incremental': {'overwrite_db': False, 'incremental': True},
+        'overwrite': {'overwrite_db': True},
+        'normalized': {'overwrite_db': False, 'normalized': True},
+    }[mode]
+
+    def dump(vis: list[DbVisit], **extra) -> None:
+        errors = visits_to_sqlite(vis, _db_path=db_path, **kwargs, **extra)
+        assert len(errors) == 0
+
+    def check() -> dict[str | None, int]:
+        with sqlite_connection(db_path) as conn:
+            stats = dict(conn.execute('SELECT src, visits FROM source_stats'))
+            actual = dict(conn.execute('SELECT src, COUNT(*) FROM visits GROUP BY src'))
+        assert stats == actual
+        return stats
+
+    def visits(src: str | None, count: int, start: int = 0) -> list[DbVisit]:
+        return [make_testvisit(i)._replace(src=src) for i in range(start, start + count)]
+
+    dump([*visits('a', 100), *visits('b', 10), *visits(None, 3)])
+    assert check() == {'a': 100, 'b': 10, None: 3}
+
+    dump([*visits('a', 50, start=70), *visits(None, 2)])
+    # visits without src are only replaced when overwriting
+    expected = {'a': 50, None: 2} if mode == 'overwrite' else {'a': 50, 'b': 10, None: 5}
+    assert check() == expected
+
+    dump(visits('c', 7), keep_srcs={'a'})
+    expected = {'a': 50, 'c': 7} if mode == 'overwrite' else {'a': 50, 'b': 10, 'c': 7, None: 5}
+    assert check() == expected
+
+    with sqlite_connection(db_path) as conn:
+        [(indexed_at,)] = conn.execute("SELECT indexed_at FROM source_stats WHERE src = 'c'")
+    assert indexed_at is not None
+
+    # older databases get it backfilled on the next indexing
+    with sqlite_connection(db_path) as conn:
+        conn.execute('DROP TABLE source_stats')
+    dump(visits('c', 7), keep_srcs={'a'})
+    assert check() == expected
+
+
+@pytest.mark.parametrize('writer_thread', [False, True], ids=['inline', 'writer_thread'])
+def test_dump_per_source(tmp_path: Path, *, writer_thread: bool) -> None:
+    db_path = tmp_path / 'db.sqlite'
+
+    def visits(src: str, count: int) -> list[DbVisit]:
+        return [make_testvisit(i)._replace(src=src) for i in range(count)]
+
+    def dump(vis: list[DbVisit]) -> None:
+        errors = visits_to_sqlite(vis, overwrite_db=False, writer_thread=writer_thread, _db_path=db_path)
+        assert len(errors) == 0
+
+    def stats() -> Counter[str | None]:
+        return Counter(v.src for v in get_all_db_visits(db_path))
+
+    dump(visits('a', 2500) + visits('b', 10))
+    assert stats() == {'a': 2500, 'b': 10}
+
+    # interleaved sources spanning several batches: each source is replaced completely, other sources are kept
+    dump([v for pair in zip(visits('a', 1500), visits('c', 1500), strict=True) for v in pair])
+    assert stats() == {'a': 1500, 'b': 10, 'c': 1500}
+
+
+def test_not_locked_while_extracting(tmp_path: Path) -> None:
+    db_path = tmp_path / 'db.sqlite'
+    _populate_db(db_path, overwrite_db=True, count=10)
+
+    extracting = Event()
+    resume = Event()
+
+    def slow_visits():
+        for i in range(2000):
+            if i == 1000:
+                extracting.set()
+                assert resume.wait(timeout=60)
+            yield make_testvisit(i)._replace(src='slow')
+
+    slow = Thread(target=lambda: visits_to_sqlite(slow_visits(), overwrite_db=False, _db_path=db_path))
+    slow.start()
+    assert extracting.wait(timeout=60)
+
+    # while the slow indexer is still extracting, another one can write to the database
+    fast = Thread(target=lambda: _populate_db(db_path, overwrite_db=False, count=5))
+    fast.start()
+    fast.join(timeout=60)
+    assert not fast.is_alive()
+    assert Counter(v.src for v in get_all_db_visits(db_path)) == {'whatever': 5}
+
+    resume.set()
+    slow.join(timeout=60)
+    assert not slow.is_alive()
+    assert Counter(v.src for v in get_all_db_visits(db_path)) == {'whatever': 5, 'slow': 2000}
+
+
+def _shared_visits(count: int, *, src: str = 'whatever') -> list[DbVisit]:
+    # visits sharing locators and contexts, like links extracted from the same files/paragraphs
+    return [
+        make_testvisit(i)._replace(
+            src=src,
+            locator=Loc.make(title=f'/notes/file{i % 10}.org', href=None if i % 3 == 0 else f'/notes/file{i % 10}.org'),
+            context=None if i % 5 == 0 else f'paragraph {i % 100} ' + 'lorem ipsum ' * 20,
+        )
+        for i in range(count)
+    ]
+
+
+@pytest.mark.parametrize('bulk', [False, True], ids=['inline', 'bulk'])
+@pytest.mark.parametrize('overwrite_db', [True, False], ids=['overwrite', 'update'])
+def test_normalized(tmp_path: Path, *, overwrite_db: bool, bulk: bool) -> None:
+    db_path = tmp_path / 'db.sqlite'
+
+    def dump(vis: list[DbVisit], **kwargs) -> None:
+        errors = visits_to_sqlite(vis, overwrite_db=overwrite_db, bulk=bulk, normalized=True, _db_path=db_path, **kwargs)
+        assert len(errors) == 0
+
+    def strings() -> tuple[int, int]:
+        with sqlite_connection(db_path) as conn:
+            [(locators,)] = conn.execute('SELECT COUNT(*) FROM visit_locators')
+            [(contexts,)] = conn.execute('SELECT COUNT(*) FROM visit_contexts')
+        return (locators, contexts)
+
+    a = _shared_visits(1000, src='a')
+    b = _shared_visits(500, src='b')
+    c = [make_testvisit(i)._replace(src='c', locator=Loc.make(title=f'c{i}'), context=f'c{i}') for i in range(5)]
+    dump([*a, *b, *c])
+    assert sorted(get_all_db_visits(db_path), key=_key) == sorted([*a, *b, *c], key=_key)
+
+    # strings are only stored once
+    assert strings() == (20 + 5, 80 + 5)
+    # so that checking whether strings are still used after deleting visits is cheap
+    with sqlite_connection(db_path) as conn:
+        indexes = {name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'visit_rows'")}
+    assert {'index_locator_id', 'index_context_id'} <= indexes
+
+    a2 = _shared_visits(300, src='a')[100:]
+    c2 = c[:2]
+    dump([*a2, *c2])
+    expected = [*a2, *c2] if overwrite_db else [*a2, *b, *c2]
+    assert sorted(get_all_db_visits(db_path), key=_key) == sorted(expected, key=_key)
+    # strings still used by other visits are kept, the rest are cleaned up
+    assert strings() == (20 + 2, 80 + 2)
+
+    if overwrite_db:
+        # unused strings are cleaned up
+        with sqlite_connection(db_path) as conn:
+            [(srcs,)] = conn.execute('SELECT COUNT(*) FROM visit_srcs')
+        assert srcs == 2
+
+    # server can query it as usual, and it's using the index
+    engine, table = get_db_stuff(db_path)
+    with engine.connect() as sconn:
+        rows = sconn.execute(table.select().where(table.c.norm_url == 'google.com/250')).all()
+        plan = sconn.exec_driver_sql("EXPLAIN QUERY PLAN SELECT * FROM visits WHERE norm_url = 'google.com/250'").all()
+    engine.dispose()
+    assert len(rows) == (1 if overwrite_db else 2)
+    assert any('index_norm_url' in str(p) for p in plan)
+
+
+def test_normalized_migration(tmp_path: Path) -> None:
+    db_path = tmp_path / 'db.sqlite'
+    visits = _shared_visits(2000)
+
+    def dump(vis: list[DbVisit], *, normalized: bool | None) -> None:
+        errors = visits_to_sqlite(vis, overwrite_db=False, normalized=normalized, _db_path=db_path)
+        assert len(errors) == 0
+
+    def schema() -> str:
+        with sqlite_connection(db_path) as conn:
+            [(kind,)] = conn.execute("SELECT type FROM sqlite_master WHERE name = 'visits'")
+        return kind
+
+    dump(visits, normalized=None)
+    assert schema() == 'table'
+    flat_size = db_path.stat().st_size
+
+    other = [make_testvisit(i)._replace(src='other') for i in range(10)]
+    dump(other, normalized=True)
+    assert schema() == 'view'
+    assert sorted(get_all_db_visits(db_path), key=_key) == sorted([*visits, *other], key=_key)
+    with sqlite_connection(db_path) as conn:
+        conn.execute('VACUUM')
+    assert db_path.stat().st_size < flat_size * 2 / 3
+
+    # None keeps the schema
+    dump(other, normalized=None)
+    assert schema() == 'view'
+
+    dump(other, normalized=False)
+    assert schema() == 'table'
+    assert sorted(get_all_db_visits(db_path), key=_key) == sorted([*visits, *other], key=_key)
+    with sqlite_connection(db_path) as conn:
+        tables = [name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE name GLOB 'visit_*'")]
+        indexes = [name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'visits'")]
+    assert tables == []
+    assert indexes == ['index_norm_url', 'index_epoch', 'index_src_hash']
+
+
+def test_sharded(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    from ..database import shards
+
+    db_path = tmp_path / 'db.sqlite'
+    shards_dir = tmp_path / 'db.sqlite.shards'
+
+    def dump(vis: list[DbVisit], **kwargs) -> None:
+        errors = visits_to_sqlite(vis, _db_path=db_path, **{'overwrite_db': False, 'sharded': True, **kwargs})
+        assert len(errors) == 0
+
+    def visits(src: str | None, count: int, start: int = 0) -> list[DbVisit]:
+        return [make_testvisit(i)._replace(src=src) for i in range(start, start + count)]
+
+    def shard_files() -> list[Path]:
+        return sorted(shards_dir.glob('*.sqlite'))
+
+    def shard(src: str | None) -> Path:
+        return tmp_path / shards.shard_relpath(db_path, src)
+
+    a, b, c = visits('a', 100), visits('b', 10), visits('c/d', 5, start=50)
+    dump([*a, *b, *c], fingerprints=lambda: {'a': 'fp_a'})
+    assert shard_files() == sorted(map(shard, ['a', 'b', 'c/d']))
+    assert sorted(get_all_db_visits(db_path), key=_key) == sorted([*a, *b, *c], key=_key)
+    assert get_source_fingerprints(db_path) == {'a': 'fp_a'}
+
+    engine, table = get_db_stuff(db_path)
+    with engine.connect() as conn:
+        rows = conn.execute(table.select().where(table.c.norm_url == 'google.com/50')).all()
+        plan = conn.exec_driver_sql("EXPLAIN QUERY PLAN SELECT * FROM visits WHERE norm_url = 'google.com/50'").all()
+        [(total,)] = conn.exec_driver_sql('SELECT SUM(visits) FROM source_stats')
+    engine.dispose()
+    assert sorted(src for *_, src, _context, _duration, _epoch, _hash in rows) == ['a', 'c/d']
+    assert sum('index_norm_url' in str(p) for p in plan) == 3
+    assert total == 115
+
+    # reindexing a source doesn't touch the other shards
+    mtimes = {p: p.stat().st_mtime_ns for p in shard_files()}
+    a2 = visits('a', 20, start=1000)
+    dump(a2)
+    assert sorted(get_all_db_visits(db_path), key=_key) == sorted([*a2, *b, *c], key=_key)
+    assert [p for p in shard_files() if p.stat().st_mtime_ns != mtimes[p]] == [shard('a')]
+
+    # overwriting removes visits of the sources which aren't kept, even from shards which have nothing new
+    nosrc = visits(None, 3)
+    dump(nosrc, overwrite_db=True, keep_srcs={'b'})
+    assert shard_files() == sorted(map(shard, ['a', 'b', 'c/d', None]))
+    assert Counter(get_all_db_visits(db_path)) == Counter([*b, *nosrc])
+
+    # sqlite can only attach a limited number of databases
+    monkeypatch.setattr(shards, 'max_shards', lambda: 2)
+    with pytest.raises(RuntimeError, match='Too many shards'):
+        dump(visits('e', 1))
+    monkeypatch.undo()
+
+    # converting back to a single file needs overwriting
+    with pytest.raises(RuntimeError, match='is sharded'):
+        dump(a2, sharded=False)
+    dump(a2, sharded=False, overwrite_db=True)
+    assert shard_files() == []
+    assert sorted(get_all_db_visits(db_path), key=_key) == sorted(a2, key=_key)
+
+    # and vice versa
+    with pytest.raises(RuntimeError, match='is not sharded'):
+        dump(b)
+    dump(b, overwrite_db=True)
+    assert shard_files() == [shard('b')]
+    assert get_all_db_visits(db_path) == b
+
+
+@pytest.mark.parametrize('overwrite_db', [True, False], ids=['overwrite', 'update'])
+def test_sharded_many_sources(tmp_path: Path, *, overwrite_db: bool) -> None:
+    from ..database import shards
+
+    db_path = tmp_path / 'db.sqlite'
+
+    def dump(vis: list[DbVisit], **kwargs) -> None:
+        errors = visits_to_sqlite(vis, _db_path=db_path, overwrite_db=overwrite_db, sharded=True, **kwargs)
+        assert len(errors) == 0
+
+    # more than sqlite can attach, so several sources share the same shard
+    srcs = [f'source{i}' for i in range(30)]
+    vis = {src: [make_testvisit(i)._replace(src=src) for i in range(j, j + 5)] for j, src in enumerate(srcs)}
+    dump([v for vs in vis.values() for v in vs])
+    assert len(list((tmp_path / 'db.sqlite.shards').glob('*.sqlite'))) == shards.SHARDS
+    assert Counter(get_all_db_visits(db_path)) == Counter(v for vs in vis.values() for v in vs)
+
+    # reindexing a source keeps visits of the other sources in its shard
+    [neighbour, *_] = [src for src in srcs[1:] if shards.shard_relpath(db_path, src) == shards.shard_relpath(db_path, srcs[0])]
+    vis[srcs[0]] = [make_testvisit(i)._replace(src=srcs[0]) for i in range(1000, 1003)]
+    dump(vis[srcs[0]], keep_srcs=[src for src in srcs if src != srcs[0]])
+    assert Counter(get_all_db_visits(db_path)) == Counter(v for vs in vis.values() for v in vs)
+    assert len([v for v in get_all_db_visits(db_path) if v.src == neighbour]) == 5
+
+    engine, _ = get_db_stuff(db_path)
+    with engine.connect() as conn:
+        [(total,)] = conn.exec_driver_sql('SELECT SUM(visits) FROM source_stats')
+    engine.dispose()
+    assert total == 29 * 5 + 3
+
+
+@pytest.mark.parametrize('sharded', [False, True], ids=['single', 'sharded'])
+def test_compress_context(tmp_path: Path, *, sharded: bool) -> None:
+    pytest.importorskip('zstandard')
+    from ..database import compression
+
+    db_path = tmp_path / 'db.sqlite'
+
+    def dump(vis: list[DbVisit], **kwargs) -> None:
+        errors = visits_to_sqlite(vis, _db_path=db_path, **{'overwrite_db': False, 'sharded': sharded, **kwargs})
+        assert len(errors) == 0
+
+    def context(i: int) -> str:
+        return f'<p>Some paragraph {i} with a link to <a href="https://google.com/{i}">google</a>, and some more text</p>\n' * (i % 5 + 3)
+
+    vis = [make_testvisit(i)._replace(src='a', context=context(i)) for i in range(3000)]
+    short = make_testvisit(5000)._replace(src='a', context='short context')
+    vis.append(short)
+
+    dump(vis, compress_context=True)
+
+    # visits are read back from the database, without relying on dictionaries loaded by the indexer
+    compression.DICTS.clear()
+    assert sorted(get_all_db_visits(db_path), key=_key) == sorted(vis, key=_key)
+
+    engine, table = get_db_stuff(db_path)
+    with engine.connect() as conn:
+        types = Counter(t for (t,) in conn.exec_driver_sql('SELECT typeof(context) FROM visits'))
+        hashes = {h for (h,) in conn.exec_driver_sql('SELECT row_hash FROM visits')}
+        [(dicts,)] = conn.exec_driver_sql('SELECT COUNT(*) FROM context_dicts')
+        found = conn.execute(
+            table.select().where(compression.searchable_context(table.c.context).contains('google.com/1234'))
+        ).all()
+    engine.dispose()
+    assert types == {'blob': 3000, 'text': 1}
+    # hashes are of uncompressed visits, so enabling compression doesn't make them 'changed'
+    assert hashes == {db_visit_to_row(v)[-1] for v in vis}
+    assert dicts == 1
+    assert [row.norm_url for row in found] == ['google.com/1234']
+
+    # the dictionary is reused on the next runs
+    dump([make_testvisit(i)._replace(src='b', context=context(i)) for i in range(10)], compress_context=True)
+    engine, _ = get_db_stuff(db_path)
+    with engine.connect() as conn:
+        [(dict_ids,)] = conn.exec_driver_sql('SELECT COUNT(DISTINCT id) FROM context_dicts')
+    engine.dispose()
+    assert dict_ids == 1
+
+
 @pytest.mark.parametrize('mode', ['update', 'overwrite'])
 def test_concurrent(tmp_path: Path, mode: str) -> None:
     overwrite_db = {'overwrite': True, 'update': False}[mode]
@@ -0,0 +1,146 @@
+import random
+from datetime import UTC, date, datetime, timedelta, timezone
+from pathlib import Path
+
+import pytest
+from more_itertools import chunked
+
+from ..common import Loc, Visit
+from ..dedup import FingerprintSet, VisitDedup, visit_fingerprint
+from .common import run_benchmarks
+
+
+def _visit(i: int, **kwargs) -> Visit:
+    return Visit(
+        url=f'https://example.com/{i}',
+        dt=datetime.fromtimestamp(i, tz=UTC),
+        locator=Loc.make(title=f'file{i % 10}', href=f'editor:///file{i % 10}'),
+        **kwargs,
+    )
+
+
+def test_fingerprint() -> None:
+    v = _visit(1, context='some context')
+    assert visit_fingerprint(v) == visit_fingerprint(_visit(1, context='some context'))
+    assert visit_fingerprint(v) != visit_fingerprint(_visit(1))
+    assert visit_fingerprint(v) != visit_fingerprint(v._replace(locator=Loc.make(title='file1')))
+    assert visit_fingerprint(v) != visit_fingerprint(v._replace(duration=10))
+
+    # should be consistent with Visit equality re: timezones
+    msk = v._replace(dt=v.dt.astimezone(timezone(timedelta(hours=3))))
+    assert msk == v
+    assert visit_fingerprint(msk) == visit_fingerprint(v)
+    naive = v._replace(dt=v.dt.replace(tzinfo=None))
+    assert naive != v
+    assert visit_fingerprint(naive) != visit_fingerprint(v)
+
+
+def test_fingerprint_date() -> None:
+    def date_visit(d: date) -> Visit:
+        # date-only visits are supported by DbVisit.make, even though Visit.dt is annotated as datetime
+        return _visit(1)._replace(dt=d)  # type: ignore[arg-type]
+
+    v = date_visit(date(2020, 1, 2))
+    assert visit_fingerprint(v) == visit_fingerprint(date_visit(date(2020, 1, 2)))
+    assert visit_fingerprint(v) != visit_fingerprint(date_visit(date(2020, 1, 3)))
+    midnight = v._replace(dt=datetime(2020, 1, 2))
+    assert midnight != v
+    assert visit_fingerprint(midnight) != visit_fingerprint(v)
+
+    d = VisitDedup()
+    assert d.add(v)
+    assert not d.add(date_visit(date(2020, 1, 2)))
+    assert d.add(midnight)
+    assert len(d) == 2
+
+
+def test_fingerprint_set() -> None:
+    s = FingerprintSet(capacity=4)
+    rnd = random.Random(0)
+    fps = [rnd.getrandbits(128) for _ in range(10_000)]
+    fps.append(0)  # special case, empty slot marker
+    fps.append((1 << 64) + 5)  # same lower half as the next one
+    fps.append(5)
+    for fp in fps:
+        assert s.add(fp)
+    for fp in fps:
+        assert not s.add(fp)
+        assert fp in s
+    assert len(s) == len(fps)
+    assert 12345 not in s
+    assert sorted(s) == sorted(fps)
+    assert s.nbytes < 16 * 4 * len(fps)
+
+    # zero shouldn't collide with any other fingerprint
+    s = FingerprintSet()
+    assert 0 not in s
+    assert s.add(1)
+    assert 0 not in s
+    assert s.add(0)
+    assert not s.add(0)
+    assert len(s) == 2
+
+
+@pytest.mark.parametrize('budget', [None, 1024])
+def test_visit_dedup(budget: int | None, tmp_path: Path) -> None:
+    d = VisitDedup(memory_budget=budget, tmp_dir=tmp_path)
+    visits = [_visit(i) for i in range(5000)]
+    assert all(d.add(v) for v in visits)
+    assert not any(d.add(v) for v in visits)
+    assert all(v in d for v in visits)
+    assert _visit(10_000) not in d
+    assert len(d) == len(visits)
+    assert d.spilled == (budget is not None)
+    d.close()
+    assert list(tmp_path.iterdir()) == []  # should clean up after itself
+
+
+@pytest.mark.parametrize('budget', [None, 1024])
+def test_visit_dedup_many(budget: int | None, tmp_path: Path) -> None:
+    d = VisitDedup(memory_budget=budget, tmp_dir=tmp_path)
+    visits = [_visit(i) for i in range(5000)]
+    # duplicates within the same chunk, also when it's spilled in the middle of the chunk
+    assert d.add_many([*visits, *visits]) == [True] * len(visits) + [False] * len(visits)
+    assert d.spilled == (budget is not None)
+    assert d.add_many(visits[::-1]) == [False] * len(visits)
+    assert d.add_many([_visit(10_000), visits[0], _visit(10_000)]) == [True, False, False]
+    assert d.add_many([]) == []
+    assert len(d) == len(visits) + 1
+    d.close()
+
+
+def test_visit_dedup_peak_memory(tmp_path: Path) -> None:
+    import tracemalloc
+
+    budget = 1024 * 1024
+    d = VisitDedup(memory_budget=budget, tmp_dir=tmp_path)
+    tracemalloc.start()
+    try:
+        for i in range(200_000):
+            d.add(_visit(i))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert d.spilled
+    # including while the table is growing (with some slack for the visits, sqlite connection etc)
+    assert peak < budget * 1.25
+    d.close()
+
+
+@pytest.mark.parametrize('budget', [None, 1024 * 1024], ids=['memory', 'spill'])
+@pytest.mark.parametrize('count', [99, 1_000_000])
+def test_benchmark_dedup(count: int, budget: int | None, tmp_path: Path) -> None:
+    # see benchmarks/ directory for the results
+    if count > 99 and not run_benchmarks:
+        pytest.skip("test would be too slow, only meant to run manually (set PROMNESIA_BENCHMARKS=1)")
+
+    if budget is not None and count <= 99:
+        budget = 512  # still want to exercise spilling
+    d = VisitDedup(memory_budget=budget, tmp_dir=tmp_path)
+    # in chunks, same as extract does
+    for _ in range(2):
+        for chunk in chunked(range(count), 1000):
+            d.add_many([_visit(i, context=f'some longer context for visit {i} ' * 3) for i in chunk])
+    assert len(d) == count
+    assert d.spilled == (budget is not None)
+    d.close()
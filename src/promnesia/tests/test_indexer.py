@@ -1,11 +1,14 @@
+import json
+import time
 from collections import Counter
+from functools import partial
 from pathlib import Path
 from subprocess import Popen, check_call
 
 import pytest
 
 from ..__main__ import do_index, read_example_config
-from ..common import DbVisit, _is_windows
+from ..common import DbVisit, Source, _is_windows
 from ..database.load import get_all_db_visits
 from .common import (
     get_testdata,
@@ -78,14 +81,33 @@ def test_concurrent_indexing(tmp_path: Path) -> None:
     cfg_fast_path = tmp_path / 'cfg_fast.py'
     write_config(cfg_fast_path, cfg_fast)
 
-    def cfg_slow() -> None:
+    def cfg_slow(started_file: str, release_file: str) -> None:
+        import time
+        from pathlib import Path
+
         from promnesia.common import Source
         from promnesia.sources import demo
 
-        SOURCES = [Source(demo.index, count=100_000)]  # noqa: F841
+        def indexer():
+            visits = list(demo.index(count=20_000, base_dt='2001-01-01'))
+            # enough for some of them to end up in the staging database
+            yield from visits[:10_000]
+            Path(started_file).touch()
+            # hold the staging phase until the fast indexers are done
+            for _ in range(600):
+                if Path(release_file).exists():
+                    break
+                time.sleep(0.1)
+            else:
+                raise RuntimeError('timed out waiting for release')
+            yield from visits[10_000:]
+
+        SOURCES = [Source(indexer, name='slow')]  # noqa: F841
 
+    started_file = tmp_path / 'started'
+    release_file = tmp_path / 'release'
     cfg_slow_path = tmp_path / 'cfg_slow.py'
-    write_config(cfg_slow_path, cfg_slow)
+    write_config(cfg_slow_path, cfg_slow, started_file=started_file, release_file=release_file)
 
     # init it first, to create the database
     # TODO ideally this shouldn't be necessary but it's reasonable that people would already have the index
@@ -93,23 +115,31 @@ def test_concurrent_indexing(tmp_path: Path) -> None:
     # todo in principle can work around same way as in cachew, by having a loop around PRAGMA WAL command?
     check_call(promnesia_bin('index', '--config', cfg_fast_path, '--overwrite'))
 
-    total_runs = 0
     # run in the background
     with Popen(promnesia_bin('index', '--config', cfg_slow_path, '--overwrite')) as slow_indexer:
-        while slow_indexer.poll() is None:
-            # create a bunch of 'smaller' indexers running in parallel
+        try:
+            for _ in range(600):
+                if started_file.exists():
+                    break
+                assert slow_indexer.poll() is None, slow_indexer
+                time.sleep(0.1)
+            else:
+                raise RuntimeError("slow indexer didn't start")
+
+            # visits are staged outside of the database, so fast indexers don't have to wait for the slow one
             fasts = [
                 Popen(promnesia_bin('index', '--config', cfg_fast_path, '--overwrite'))
-                for _ in range(10)
+                for _ in range(5)
             ]  # fmt: skip
             for fast in fasts:
-                assert fast.wait() == 0, fast  # should succeed
-                total_runs += 1
-        assert slow_indexer.poll() == 0, slow_indexer
+                assert fast.wait(timeout=60) == 0, fast  # should succeed
+            assert slow_indexer.poll() is None, slow_indexer  # still staging
+            assert get_stats(tmp_path) == {'demo': 10}
+        finally:
+            release_file.touch()
+        assert slow_indexer.wait(timeout=60) == 0, slow_indexer
 
-    # FIXME ok, need to uncomment this once proper concurrent indexing is supported
-    # if not, slow indexer is too fast, so crank up the count in it
-    # assert total_runs > 20
+    assert get_stats(tmp_path) == {'slow': 20_000}
 
 
 def test_filter(tmp_path: Path, reset_filters) -> None:
@@ -189,6 +219,277 @@ def test_errors_during_indexing(tmp_path: Path) -> None:
     }
 
 
+@pytest.mark.parametrize('writer_thread', [False, True], ids=['inline', 'writer_thread'])
+@pytest.mark.parametrize('mode', ['update', 'overwrite'])
+def test_concurrent_sources(
+    tmp_path: Path,
+    mode: str,
+    *,
+    writer_thread: bool,
+    monkeypatch: pytest.MonkeyPatch,
+    recwarn: pytest.WarningsRecorder,
+) -> None:
+    from .. import __main__ as main
+
+    # otherwise it depends on the number of cpus
+    monkeypatch.setattr(main, 'visits_to_sqlite', partial(main.visits_to_sqlite, writer_thread=writer_thread))
+
+    def cfg(nworkers: int) -> None:
+        import os
+
+        from promnesia.common import Source
+        from promnesia.sources import demo
+
+        def indexer_with_error():
+            yield from demo.index(count=5, base_dt='2002-01-01')
+            yield RuntimeError("some error during visits extraction")
+
+        def indexer_crashing():
+            raise RuntimeError("in this case indexer itself crashed")
+
+        def indexer_killing_worker():
+            if int(nworkers) > 1:
+                os._exit(1)  # simulate the worker dying
+            yield from ()
+
+        CONCURRENT_SOURCES = int(nworkers)  # noqa: F841
+
+        SOURCES = [  # noqa: F841
+            Source(demo.index, count=1500, base_dt='2000-01-01', delta=30, name='demo1'),
+            Source(demo.index, count=20, base_dt='2001-01-01', delta=30, name='demo2'),
+            Source(indexer_with_error, name='with_error'),
+            Source(indexer_crashing, name='crashing'),
+            Source(indexer_killing_worker, name='killing'),
+            Source(demo.index, count=30, base_dt='2003-01-01', delta=30, name='demo3'),
+        ]
+
+    def index(nworkers: int, name: str) -> list[DbVisit]:
+        cfg_path = tmp_path / f'{name}.py'
+        write_config(cfg_path, cfg, nworkers=nworkers)
+        do_index(cfg_path, overwrite_db=mode == 'overwrite')
+        return get_all_db_visits(tmp_path / 'promnesia.sqlite')
+
+    def key(v: DbVisit):
+        return (v.src, v.dt, v.norm_url, v.context or '')
+
+    sequential = index(1, 'sequential')
+    concurrent = index(3, 'concurrent')
+
+    def non_errors(visits: list[DbVisit]) -> list[DbVisit]:
+        return sorted((v for v in visits if v.src != 'error'), key=key)
+
+    # second run replaces visits for each source rather than duplicating them
+    assert non_errors(concurrent) == non_errors(sequential)
+    assert Counter(v.src for v in concurrent) == {
+        'demo1': 1500,
+        'demo2': 20,
+        'with_error': 5,
+        'demo3': 30,
+        # 'killing' source only crashes in concurrent mode, so one more error
+        'error': 3,
+    }
+    # forking while the writer thread is running might deadlock, python warns about it
+    assert not [w for w in recwarn if 'fork()' in str(w.message)]
+
+
+@pytest.mark.parametrize('mode', ['update', 'overwrite'])
+def test_unchanged_sources(tmp_path: Path, mode: str) -> None:
+    def cfg(input_file: str, calls_file: str) -> None:
+        from pathlib import Path
+
+        from promnesia.common import Source
+        from promnesia.sources import demo
+
+        def indexer():
+            with Path(calls_file).open('a') as fo:
+                fo.write('called\n')
+            yield from demo.index(count=int(Path(input_file).read_text()))
+
+        SOURCES = [  # noqa: F841
+            Source(indexer, name='with_inputs', inputs=[input_file]),
+            Source(demo.index, count=20, base_dt='2001-01-01', name='no_inputs'),
+        ]
+
+    input_file = tmp_path / 'input.txt'
+    calls_file = tmp_path / 'calls.txt'
+    cfg_path = tmp_path / 'config.py'
+    write_config(cfg_path, cfg, input_file=input_file, calls_file=calls_file)
+
+    def index(*, force: bool = False) -> int:
+        do_index(cfg_path, overwrite_db=mode == 'overwrite', force=force)
+        return len(calls_file.read_text().splitlines())
+
+    input_file.write_text('3')
+    assert index() == 1
+    assert get_stats(tmp_path) == {'with_inputs': 3, 'no_inputs': 20}
+
+    # inputs didn't change, so the source is skipped, but its visits are kept
+    assert index() == 1
+    assert get_stats(tmp_path) == {'with_inputs': 3, 'no_inputs': 20}
+
+    input_file.write_text('12')  # NOTE: size changes too, in case mtime resolution is coarse
+    assert index() == 2
+    assert get_stats(tmp_path) == {'with_inputs': 12, 'no_inputs': 20}
+
+    assert index(force=True) == 3
+    assert get_stats(tmp_path) == {'with_inputs': 12, 'no_inputs': 20}
+
+
+def test_unchanged_sources_filters(tmp_path: Path, reset_filters) -> None:
+    def cfg(input_file: str, calls_file: str, blocklist: str, opaque: str) -> None:
+        from pathlib import Path
+
+        from promnesia.common import DomainFilter, Filter, Source, Visit
+        from promnesia.sources import demo
+
+        def indexer():
+            with Path(calls_file).open('a') as fo:
+                fo.write('called\n')
+            for v in demo.index(count=5):
+                assert isinstance(v, Visit)
+                if v.url.endswith(('3.html', '4.html')):
+                    v = v._replace(url=v.url.replace('demo.com', 'example.com'))
+                yield v
+
+        SOURCES = [Source(indexer, name='with_inputs', inputs=[input_file])]  # noqa: F841
+
+        FILTERS: list[str | Filter] = [DomainFilter(files=[blocklist])]
+        if opaque == 'True':
+            FILTERS.append(lambda _url: False)
+
+    input_file = tmp_path / 'input.txt'
+    input_file.write_text('whatever')
+    calls_file = tmp_path / 'calls.txt'
+    blocklist = tmp_path / 'blocklist.txt'
+
+    def index(*, opaque: bool = False) -> int:
+        from .. import extract
+
+        extract.filters.cache_clear()  # otherwise filters from the previous config would be reused
+        cfg_path = tmp_path / f'config_{opaque}.py'
+        write_config(cfg_path, cfg, input_file=input_file, calls_file=calls_file, blocklist=blocklist, opaque=opaque)
+        do_index(cfg_path)
+        return len(calls_file.read_text().splitlines())
+
+    blocklist.write_text('other.com\n')
+    assert index() == 1
+    assert get_stats(tmp_path) == {'with_inputs': 5}
+    assert index() == 1
+
+    # blocklist changed, so previously indexed visits might need to be filtered out now
+    blocklist.write_text('other.com\ndemo.com\n')
+    assert index() == 2
+    assert get_stats(tmp_path) == {'with_inputs': 2}
+
+    # can't tell whether an arbitrary callable filter changed, so never skipping
+    assert index(opaque=True) == 3
+    assert index(opaque=True) == 4
+
+
+def test_source_fingerprint(tmp_path: Path) -> None:
+    from ..sources import demo
+
+    (tmp_path / 'a.txt').write_text('a')
+    (tmp_path / 'sub').mkdir()
+    (tmp_path / 'sub' / 'b.txt').write_text('b')
+
+    assert Source(demo.index).fingerprint() is None  # inputs not declared
+
+    def fingerprint(**kwargs) -> str | None:
+        return Source(demo.index, count=10, inputs=[tmp_path], **kwargs).fingerprint()
+
+    fp = fingerprint()
+    assert fp is not None
+    assert fingerprint() == fp
+    assert Source(demo.index, count=10, inputs=lambda: [tmp_path]).fingerprint() == fp
+    assert fingerprint(delta=30) != fp  # arguments changed
+
+    (tmp_path / 'sub' / 'b.txt').write_text('bb')
+    fp2 = fingerprint()
+    assert fp2 != fp
+    (tmp_path / 'sub' / 'c.txt').write_text('c')
+    assert fingerprint() != fp2
+
+    # globs and missing paths are fine too
+    assert Source(demo.index, inputs=[tmp_path / '*.txt']).fingerprint() != Source(demo.index, inputs=[tmp_path / 'b.txt']).fingerprint()
+    assert Source(demo.index, inputs=[tmp_path / 'missing']).fingerprint() is not None
+
+
+def test_source_fingerprint_unstable_args(tmp_path: Path) -> None:
+    from functools import partial
+
+    from ..sources import demo
+
+    def indexer(transform):
+        yield from map(transform, demo.index(count=3))
+
+    # repr of a function contains its memory address, so the fingerprint would change on every run
+    assert Source(indexer, lambda v: v, inputs=[tmp_path]).fingerprint() is None
+    assert Source(partial(demo.index, count=3), inputs=[tmp_path]).fingerprint() is None
+    # whereas plain values are fine
+    assert Source(indexer, 'whatever', inputs=[tmp_path]).fingerprint() is not None
+
+
+def test_filter_fingerprint(tmp_path: Path) -> None:
+    from ..common import DomainFilter
+    from ..extract import RegexFilters
+
+    blocklist = tmp_path / 'blocklist.txt'
+    blocklist.write_text('ads.com\n')
+    fp = DomainFilter(['a.com'], files=[blocklist]).fingerprint()
+    assert DomainFilter(['a.com'], files=[blocklist]).fingerprint() == fp
+    assert DomainFilter(['b.com'], files=[blocklist]).fingerprint() != fp
+    blocklist.write_text('ads.com\ntracker.com\n')
+    assert DomainFilter(['a.com'], files=[blocklist]).fingerprint() != fp
+
+    assert RegexFilters(['a', 'b']).fingerprint() == RegexFilters(['a', 'b']).fingerprint()
+    assert RegexFilters(['a', 'b']).fingerprint() != RegexFilters(['a', 'c']).fingerprint()
+
+
+@pytest.mark.parametrize('nworkers', [1, 2])
+def test_index_report(tmp_path: Path, nworkers: int) -> None:
+    def cfg(nworkers: int) -> None:
+        from promnesia.common import Source
+        from promnesia.sources import demo
+
+        def indexer_with_error():
+            yield from demo.index(count=5, base_dt='2002-01-01')
+            yield RuntimeError("some error during visits extraction")
+
+        def HOOK(v):
+            yield v
+
+        CONCURRENT_SOURCES = int(nworkers)  # noqa: F841
+
+        SOURCES = [  # noqa: F841
+            Source(demo.index, count=100, name='demo1'),
+            Source(indexer_with_error, name='with_error'),
+        ]
+
+    cfg_path = tmp_path / 'config.py'
+    write_config(cfg_path, cfg, nworkers=nworkers)
+    do_index(cfg_path)
+
+    report = json.loads((tmp_path / 'promnesia-index-report.json').read_text())
+    sources = report['sources']
+    assert sources['demo1']['visits'] == 100
+    assert sources['demo1']['errors'] == 0
+    assert sources['with_error']['visits'] == 5
+    assert sources['with_error']['errors'] == 1
+    assert report['total']['visits'] == 105
+    for j in [sources['demo1'], sources['with_error']]:
+        assert set(j['seconds']) == {'extract', 'dedup', 'filter', 'canonify', 'convert', 'hook', 'sqlite'}
+        assert j['seconds']['extract'] > 0
+        assert j['seconds']['convert'] > 0
+        assert j['seconds']['sqlite'] > 0
+        assert j['visits_per_sec'] > 0
+        if not _is_windows:
+            assert j['peak_rss_growth_bytes'] >= 0
+    if not _is_windows:
+        assert report['total']['peak_rss_bytes'] > 0
+        assert 'peak_rss_growth_bytes' not in report['total']
+
+
 def test_hook(tmp_path: Path) -> None:
     def cfg() -> None:
         from promnesia.common import Source
@@ -238,6 +539,101 @@ def test_hook(tmp_path: Path) -> None:
     assert p6.locator is not None
 
 
+def test_batch_hook(tmp_path: Path) -> None:
+    def cfg() -> None:
+        from promnesia.common import Source
+        from promnesia.sources import demo
+
+        SOURCES = [  # noqa: F841
+            Source(demo.index, count=7, name='demo1'),
+            Source(demo.index, count=3, base_dt='2001-01-01', name='demo2'),
+        ]
+
+        def HOOK(visit):
+            if 'page6' in visit.norm_url:
+                return
+            yield visit
+
+        def BATCH_HOOK(visits):
+            # per visit HOOK is applied first
+            assert not any('page6' in v.norm_url for v in visits)
+            lookup = {'demo.com/page1.html': 'patched.com'}
+            return [v._replace(norm_url=lookup.get(v.norm_url, v.norm_url)) for v in visits if 'page2' not in v.norm_url]
+
+    cfg_path = tmp_path / 'config.py'
+    write_config(cfg_path, cfg)
+    do_index(cfg_path)
+
+    visits = get_all_db_visits(tmp_path / 'promnesia.sqlite')
+    assert Counter(v.src for v in visits) == {'demo1': 5, 'demo2': 2}
+    assert sorted(v.norm_url for v in visits if v.src == 'demo1') == [
+        'demo.com/page0.html',
+        'demo.com/page3.html',
+        'demo.com/page4.html',
+        'demo.com/page5.html',
+        'patched.com',
+    ]
+
+    def cfg_crashing() -> None:
+        from promnesia.common import Source
+        from promnesia.sources import demo
+
+        SOURCES = [Source(demo.index, count=7, name='demo1')]  # noqa: F841
+
+        def BATCH_HOOK(visits):
+            raise RuntimeError('boom')
+
+    cfg_path = tmp_path / 'config_crashing.py'
+    write_config(cfg_path, cfg_crashing)
+    errors = do_index(cfg_path, overwrite_db=True)
+    assert len(errors) > 0
+    # crashes on every visit when retried one by one, one error per visit
+    assert Counter(v.src for v in get_all_db_visits(tmp_path / 'promnesia.sqlite')) == {'error': 7}
+
+
+def test_batch_hook_crash_with_inputs(tmp_path: Path) -> None:
+    def cfg(input_file: str, calls_file: str, crash_file: str) -> None:
+        from pathlib import Path
+
+        from promnesia.common import Source
+        from promnesia.sources import demo
+
+        def indexer():
+            with Path(calls_file).open('a') as fo:
+                fo.write('called\n')
+            yield from demo.index(count=7)
+
+        SOURCES = [Source(indexer, name='with_inputs', inputs=[input_file])]  # noqa: F841
+
+        def BATCH_HOOK(visits):
+            if Path(crash_file).exists() and any('page2' in v.norm_url for v in visits):
+                raise RuntimeError('boom')
+            return visits
+
+    input_file = tmp_path / 'input.txt'
+    input_file.write_text('whatever')
+    calls_file = tmp_path / 'calls.txt'
+    crash_file = tmp_path / 'crash'
+    crash_file.touch()
+    cfg_path = tmp_path / 'config.py'
+    write_config(cfg_path, cfg, input_file=input_file, calls_file=calls_file, crash_file=crash_file)
+
+    def index() -> int:
+        do_index(cfg_path)
+        return len(calls_file.read_text().splitlines())
+
+    assert index() == 1
+    # only the visit it crashed on is lost (after retrying visit by visit)
+    assert get_stats(tmp_path) == {'with_inputs': 6, 'error': 1}
+
+    # the source had errors, so it's not skipped even though the inputs didn't change
+    crash_file.unlink()
+    assert index() == 2
+    assert get_stats(tmp_path) == {'with_inputs': 7, 'error': 1}
+
+    assert index() == 2
+
+
 def test_example_config(tmp_path: Path) -> None:
     if _is_windows:
         pytest.skip("doesn't work on Windows: example config references /usr/include paths")
@@ -1,3 +1,4 @@
+import sqlite3
 from datetime import datetime
 from pathlib import Path
 from subprocess import Popen
@@ -28,6 +29,25 @@ def test_status_error() -> None:
         assert 'ERROR' in body['db']  # defensive, it doesn't exist
 
 
+def test_canonify_cache_size(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    from zoneinfo import ZoneInfo
+
+    from ..cannon import DEFAULT_CACHE_SIZE, canonify_cache
+    from ..server import EnvConfig, ServerConfig
+
+    cfg = ServerConfig(db=tmp_path / 'promnesia.sqlite', timezone=ZoneInfo('UTC'), canonify_cache_size=123)
+    assert ServerConfig.from_str(cfg.as_str()) == cfg
+
+    monkeypatch.setenv(EnvConfig.KEY, cfg.as_str())
+    EnvConfig.get.cache_clear()
+    try:
+        assert EnvConfig.get() == cfg
+        assert canonify_cache.maxsize == 123
+    finally:
+        EnvConfig.get.cache_clear()
+        canonify_cache.resize(DEFAULT_CACHE_SIZE)
+
+
 def test_status_ok(tmp_path: Path) -> None:
     def cfg() -> None:
         from promnesia.common import Source
@@ -156,6 +176,13 @@ def test_visited(tmp_path: Path) -> None:
         assert r1['original_url'] == test_url
         assert r2 is None
 
+        # urls that fail to canonify shouldn't break the whole request
+        r = server.post('/visited', json={'urls': ['https://example.com\uff03@bing.com', test_url, test_url]}).json()
+        [r1, r2, r3] = r
+        assert r1 is None
+        assert r2['original_url'] == test_url
+        assert r3 == r2
+
 
 def test_search(tmp_path: Path) -> None:
     # TODO not sure if should index at all here or just insert DbVisits directly?
@@ -207,6 +234,40 @@ def test_search(tmp_path: Path) -> None:
         assert v['context'] == 'perhaps it will help someone else https://wiki.termux.com/wiki/Termux-setup-storage'
 
 
+def test_sharded(tmp_path: Path) -> None:
+    def cfg() -> None:
+        from promnesia.common import Source
+        from promnesia.sources import demo
+
+        SOURCES = [  # noqa: F841
+            Source(demo.index, count=10, base_dt='2000-01-01T00:00:00+03:00', delta=10 * 60, name='demo1'),
+            Source(demo.index, count=20, base_dt='2000-01-01T00:00:00+03:00', delta=10 * 60, name='demo2'),
+        ]
+        SHARDED_DB = True  # noqa: F841
+
+    cfg_path = tmp_path / 'config.py'
+    write_config(cfg_path, cfg)
+    do_index(cfg_path)
+
+    assert len(list((tmp_path / 'promnesia.sqlite.shards').glob('*.sqlite'))) == 2
+
+    with run_server(db=tmp_path / 'promnesia.sqlite') as server:
+        r = server.post('/status').json()
+        assert r['stats'] == {'total_visits': 30}
+
+        r = server.post('/visits', json={'url': 'https://demo.com/page0.html'}).json()
+        assert sorted(v['src'] for v in r['visits']) == ['demo1', 'demo2']
+
+        r = server.post('/visited', json={'urls': ['https://demo.com/page15.html', 'https://demo.com/page1.html']}).json()
+        assert [x is not None for x in r] == [True, True]
+
+        rj = server.post(
+            '/search_around',
+            json={'timestamp': datetime.fromisoformat('2000-01-01T01:00:00+03:00').timestamp()},
+        ).json()
+        assert len(rj['visits']) == 2 * 7  # 3 hours back, both sources
+
+
 def test_search_around(tmp_path: Path) -> None:
     # this should return visits up to 3 hours in the past
     def cfg() -> None:
@@ -238,6 +299,43 @@ def test_search_around(tmp_path: Path) -> None:
         assert visits[-1]['dt'] == '01 Jan 2000 04:50:00 +0300'  # fmt: skip
 
 
+def test_legacy_db(tmp_path: Path) -> None:
+    """
+    Server doesn't migrate databases created by older versions (it's up to the indexer), but still works with them
+    """
+    db_path = tmp_path / 'promnesia.sqlite'
+    with sqlite3.connect(db_path) as conn:
+        conn.execute('CREATE TABLE visits (norm_url, orig_url, dt, locator_title, locator_href, src, context, duration)')
+        conn.executemany(
+            'INSERT INTO visits VALUES (?, ?, ?, NULL, NULL, ?, NULL, NULL)',
+            [
+                ('a.com', 'https://a.com', '2000-01-01T02:00:00+03:00 Europe/Moscow', 'src1'),
+                ('b.com', 'https://b.com', '2000-01-01T03:00:00+03:00', 'src2'),
+                ('c.com', 'https://c.com', '2005-01-01T03:00:00+03:00', 'src2'),
+            ],
+        )
+    conn.close()
+
+    with run_server(db=db_path) as server:
+        assert server.post('/status').json()['stats'] == {'total_visits': 3}
+
+        r = server.post('/visited', json={'urls': ['https://a.com', 'https://z.com']}).json()
+        assert [x is not None for x in r] == [True, False]
+
+        rj = server.post(
+            '/search_around',
+            json={'timestamp': datetime.fromisoformat('2000-01-01T04:00:00+03:00').timestamp()},
+        ).json()
+        assert [v['original_url'] for v in rj['visits']] == ['https://a.com', 'https://b.com']
+
+    with sqlite3.connect(db_path) as conn:
+        columns = [name for (_, name, *_) in conn.execute('PRAGMA table_info(visits)')]
+        tables = {name for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    conn.close()
+    assert 'epoch' not in columns
+    assert 'source_stats' not in tables
+
+
 @pytest.mark.parametrize('mode', ['update', 'overwrite'])
 def test_query_while_indexing(tmp_path: Path, mode: str) -> None:
     overwrite = mode == 'overwrite'